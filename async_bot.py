@@ -0,0 +1,321 @@
+import os
+import json
+import asyncio
+import logging
+import concurrent.futures
+
+import httpx
+
+from bot_deepseek import (DeepSeekPsychoBot, DEEPSEEK_API_KEY, DEEPSEEK_STREAM, DEEPSEEK_MODEL, SYSTEM_PROMPT,
+                          TELEGRAM_TIMEOUT, DEEPSEEK_TIMEOUT)
+from response_cache import ResponseCache
+from streaming import StreamingReply, parse_sse_line
+from http_client import HTTP_CONNECT_TIMEOUT, retry_after
+from telegram_webhook import telegram_webhook
+from dispatcher import chat_key, poll_backoff, UPDATE_QUEUE_SIZE, POLL_TIMEOUT, POLL_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# Потоки для синхронного кода: меню, админ-команды, платежи, SQLite
+ASYNC_BLOCKING_WORKERS = int(os.getenv('ASYNC_BLOCKING_WORKERS', 16))
+# Максимум одновременных HTTP-соединений к Telegram и DeepSeek
+ASYNC_MAX_CONNECTIONS = int(os.getenv('ASYNC_MAX_CONNECTIONS', 200))
+
+
+class AsyncDeepSeekPsychoBot(DeepSeekPsychoBot):
+    """Бот на asyncio: запросы к Telegram и DeepSeek идут через один event loop.
+
+    Ответ AI-психолога - самая долгая часть обработки - выполняется полностью
+    асинхронно, поэтому сотни одновременных запросов к DeepSeek обслуживает
+    один поток. Меню, админ-команды и платежи выполняет прежний синхронный код
+    в небольшом пуле потоков. Обновления одного чата обрабатываются по порядку.
+    """
+
+    def __init__(self, with_knowledge_base=True):
+        super().__init__(with_knowledge_base)
+        self.loop = None
+        self.client = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(ASYNC_BLOCKING_WORKERS, thread_name_prefix="blocking")
+        self.in_flight = 0
+        self._chat_tails = {}
+        self._slots = None
+
+    async def run_blocking(self, func, *args):
+        """Выполнение синхронной функции в пуле потоков"""
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def send_message_async(self, chat_id, text, reply_markup=None, parse_mode="HTML"):
+        """Отправка сообщения в Telegram через общую очередь отправки (лимиты Telegram
+        одни на бота); возвращает message_id или None при ошибке"""
+        data = {
+            "chat_id": chat_id,
+            "text": text
+        }
+        if parse_mode:
+            data["parse_mode"] = parse_mode
+        if reply_markup:
+            data["reply_markup"] = reply_markup.to_json()
+
+        try:
+            response = await asyncio.wrap_future(self.send_queue.submit("sendMessage", data, chat_id))
+            if response.status_code == 200:
+                return response.json().get("result", {}).get("message_id", 0)
+            logger.error(f"Ошибка отправки: {response.text}")
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка отправки сообщения: {e}")
+            return None
+
+    async def edit_message_async(self, chat_id, message_id, text, parse_mode="HTML"):
+        """Редактирование сообщения"""
+        data = {
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "text": text
+        }
+        if parse_mode:
+            data["parse_mode"] = parse_mode
+
+        try:
+            response = await asyncio.wrap_future(self.send_queue.submit("editMessageText", data, chat_id))
+            return response.status_code == 200
+        except Exception as e:
+            logger.error(f"Ошибка редактирования сообщения: {e}")
+            return False
+
+    async def send_chat_action_async(self, chat_id, action="typing"):
+        """Показ действия "печатает" в чате"""
+        try:
+            await self.client.post(f"{self.base_url}/sendChatAction", data={"chat_id": chat_id, "action": action})
+        except Exception as e:
+            logger.error(f"Ошибка отправки действия: {e}")
+
+    async def get_deepseek_response_async(self, user_id, user_message, book_context, chat_history=None, cache_key=None):
+        """Получение ответа от DeepSeek"""
+        try:
+            headers, data = self.build_deepseek_request(user_message, book_context, chat_history)
+            response = await self.client.post(self.deepseek_url, headers=headers, json=data, timeout=DEEPSEEK_TIMEOUT)
+
+            if response.status_code == 200:
+                ai_response = response.json()['choices'][0]['message']['content']
+                await self.run_blocking(self.response_cache.put, cache_key, ai_response)
+                await self.run_blocking(self.sub_manager.save_message, user_id, "assistant", ai_response)
+                return ai_response
+
+            logger.error(f"Ошибка DeepSeek API: {response.text}")
+            return "Извини, произошла ошибка при обработке запроса."
+        except Exception as e:
+            logger.error(f"Ошибка DeepSeek: {e}")
+            return "Извини, я сейчас не могу ответить. Попробуй позже."
+
+    async def stream_deepseek_response_async(self, chat_id, user_id, user_message, book_context, chat_history, reply,
+                                             cache_key=None):
+        """Получение ответа от DeepSeek потоком: текст показывается в чате по мере генерации"""
+        try:
+            headers, data = self.build_deepseek_request(user_message, book_context, chat_history)
+            data["stream"] = True
+
+            async with self.client.stream("POST", self.deepseek_url, headers=headers, json=data,
+                                          timeout=DEEPSEEK_TIMEOUT) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    logger.error(f"Ошибка DeepSeek API: {response.text}")
+                    return "Извини, произошла ошибка при обработке запроса."
+
+                async for line in response.aiter_lines():
+                    done, content = parse_sse_line(line)
+                    if done:
+                        await self.run_blocking(self.response_cache.put, cache_key, reply.text)
+                        break
+                    partial = reply.feed(content)
+                    if partial is None:
+                        continue
+                    # Промежуточный текст без разметки: незакрытый тег сломал бы правку
+                    if reply.message_id is None:
+                        message_id = await self.send_message_async(chat_id, partial, parse_mode=None)
+                        if message_id is not None:
+                            reply.shown(partial, message_id)
+                        else:
+                            reply.fail()
+                    elif await self.edit_message_async(chat_id, reply.message_id, partial, parse_mode=None):
+                        reply.shown(partial)
+                    else:
+                        reply.fail()
+
+        except Exception as e:
+            logger.error(f"Ошибка DeepSeek: {e}")
+            if not reply.text:
+                return "Извини, я сейчас не могу ответить. Попробуй позже."
+
+        ai_response = reply.text
+        if not ai_response:
+            return "Извини, произошла ошибка при обработке запроса."
+
+        await self.run_blocking(self.sub_manager.save_message, user_id, "assistant", ai_response)
+        return ai_response
+
+    async def answer_message_async(self, chat_id, user_id, user_name, text, messages_count, daily_limit, sub_type):
+        """Ответ AI-психолога на сообщение пользователя"""
+        await self.send_chat_action_async(chat_id)
+
+        chat_history, book_context = await self.run_blocking(self.prepare_consultation, user_id, text)
+
+        cache_key = ResponseCache.make_key(DEEPSEEK_MODEL, SYSTEM_PROMPT, book_context, chat_history, text)
+        reply = None
+        deepseek_response = await self.run_blocking(self.response_cache.get, cache_key) if cache_key else None
+        if deepseek_response is not None:
+            print(f"⚡ Ответ для {user_name} взят из кэша")
+            await self.run_blocking(self.sub_manager.save_message, user_id, "assistant", deepseek_response)
+        else:
+            print(f"🤖 Генерирую ответ с анализом книг для {user_name}...")
+            async with self.llm_scheduler.slot_async(sub_type):
+                if DEEPSEEK_STREAM:
+                    reply = StreamingReply()
+                    deepseek_response = await self.stream_deepseek_response_async(
+                        chat_id, user_id, text, book_context, chat_history, reply, cache_key)
+                else:
+                    deepseek_response = await self.get_deepseek_response_async(
+                        user_id, text, book_context, chat_history, cache_key)
+
+        final_response = self.format_reply(deepseek_response, messages_count, daily_limit, sub_type)
+        if reply is not None and reply.message_id is not None and not reply.failed:
+            await self.edit_message_async(chat_id, reply.message_id, final_response)
+        else:
+            await self.send_message_async(chat_id, final_response)
+        print(f"✅ Ответ отправлен пользователю {user_name} ({messages_count}/{daily_limit})")
+
+    def answer_message(self, chat_id, user_id, user_name, text, messages_count, daily_limit, sub_type):
+        """Вызывается из handle_update в пуле потоков: ответ уходит в event loop"""
+        return asyncio.run_coroutine_threadsafe(
+            self.answer_message_async(chat_id, user_id, user_name, text, messages_count, daily_limit, sub_type),
+            self.loop
+        )
+
+    async def handle_update_async(self, update):
+        """Обработка одного обновления: синхронная часть в пуле, ответ DeepSeek - в event loop"""
+        result = await self.run_blocking(self.handle_update, update)
+        if isinstance(result, concurrent.futures.Future):
+            await asyncio.wrap_future(result)
+
+    async def dispatch(self, update):
+        """Постановка обновления в очередь его чата; ждет, если очередь переполнена"""
+        await self._slots.acquire()
+        key = chat_key(update)
+        if key is None:
+            key = ('update', update.get('update_id'))
+        previous = self._chat_tails.get(key)
+        self._chat_tails[key] = asyncio.create_task(self._run_in_order(key, previous, update))
+
+    async def _run_in_order(self, key, previous, update):
+        try:
+            # Следующее обновление чата - только после предыдущего
+            if previous is not None:
+                await asyncio.wait([previous])
+            self.in_flight += 1
+            try:
+                await self.handle_update_async(update)
+            finally:
+                self.in_flight -= 1
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}")
+        finally:
+            self._slots.release()
+            if self._chat_tails.get(key) is asyncio.current_task():
+                del self._chat_tails[key]
+
+    def _start_runtime(self):
+        self.loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(UPDATE_QUEUE_SIZE)
+        limits = httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS, max_keepalive_connections=ASYNC_MAX_CONNECTIONS)
+        self.client = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(TELEGRAM_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT))
+
+        print(f"🔑 DeepSeek API: {'✅ Настроен' if DEEPSEEK_API_KEY else '❌ Не настроен'}")
+        if self.knowledge_base:
+            print(f"📚 Библиотека: {self.knowledge_base.get_library_info()}")
+
+    async def _stop_runtime(self):
+        # Дожидаемся уже принятых обновлений
+        if self._chat_tails:
+            await asyncio.wait(list(self._chat_tails.values()), timeout=60)
+        await self.client.aclose()
+        await self.run_blocking(self.send_queue.close)
+        self.executor.shutdown(wait=True)
+        self.sub_manager.close()
+
+    async def process_updates_async(self):
+        """Основной цикл опроса Telegram в event loop"""
+        self._start_runtime()
+        print("🔄 Начинаю опрос сервера Telegram (asyncio)...")
+
+        # Пока установлен вебхук, getUpdates отвечает 409 Conflict
+        await self.run_blocking(telegram_webhook.delete_webhook, self.base_url)
+
+        last_update_id = 0
+        errors = 0
+        try:
+            while True:
+                try:
+                    params = {
+                        "offset": last_update_id + 1,
+                        "timeout": POLL_TIMEOUT,
+                        "limit": POLL_LIMIT,
+                        "allowed_updates": json.dumps(["message", "callback_query"])
+                    }
+                    response = await self.client.get(f"{self.base_url}/getUpdates", params=params, timeout=POLL_TIMEOUT + 5)
+
+                    if response.status_code == 200:
+                        data = response.json()
+                        if data.get("ok"):
+                            for update in data.get("result", []):
+                                await self.dispatch(update)
+                                last_update_id = update["update_id"]
+                            # Сразу за следующей порцией - long polling сам ждет новых обновлений
+                            errors = 0
+                            continue
+
+                    errors += 1
+                    delay = max(poll_backoff(errors), retry_after(response))
+                    logger.error(f"Ошибка getUpdates ({response.status_code}): {response.text[:200]}")
+                    await asyncio.sleep(delay)
+
+                except httpx.TimeoutException:
+                    # Таймаут - это нормально, продолжаем работу
+                    continue
+                except Exception as e:
+                    errors += 1
+                    delay = poll_backoff(errors)
+                    logger.error(f"Ошибка в основном цикле: {e}")
+                    print(f"⚠️  Ошибка: {e}. Повтор через {delay:.0f} сек...")
+                    await asyncio.sleep(delay)
+        finally:
+            await self._stop_runtime()
+
+    def process_updates(self):
+        asyncio.run(self.process_updates_async())
+
+    def submit_update(self, update, timeout=None):
+        """Передача обновления из вебхука (поток Flask) в event loop; False, если очередь переполнена"""
+        if self.loop is None or self._slots is None or self._slots.locked():
+            return False
+        asyncio.run_coroutine_threadsafe(self.dispatch(update), self.loop)
+        return True
+
+    async def serve_webhook_async(self):
+        """Прием обновлений через вебхук Telegram в event loop"""
+        self._start_runtime()
+        try:
+            telegram_webhook.attach(self)
+            if not await self.run_blocking(telegram_webhook.set_webhook, self.base_url):
+                raise RuntimeError("Не удалось установить вебхук Telegram")
+            # Обновления приходят в health server и передаются в loop через submit_update
+            await asyncio.Event().wait()
+        finally:
+            telegram_webhook.attach(None)
+            await self._stop_runtime()
+
+    def serve_webhook(self):
+        asyncio.run(self.serve_webhook_async())
+
+    def get_runtime_stats(self):
+        stats = super().get_runtime_stats()
+        return stats + f"\n⚡ asyncio: обновлений в работе {self.in_flight}, чатов с очередью {len(self._chat_tails)}"
@@ -0,0 +1,76 @@
+"""Замер запросов к базе бота до и после миграции с индексами.
+
+Запуск: python benchmark_db.py [число сообщений ...]
+Для каждого размера создается временная база со схемой версии 2 (без индексов),
+заполняется историей диалогов и платежами, затем запросы замеряются до и после
+миграции 3. С индексами время запроса почти не зависит от размера таблицы.
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+
+from database import apply_migrations
+
+QUERIES = {
+    'история пользователя': (
+        "SELECT role, content FROM chat_history WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT 4",
+        lambda rows, users: (random.randrange(users),)
+    ),
+    'платеж по ID ЮKassa': (
+        "SELECT user_id, payment_id, tariff_type, status FROM payments WHERE yookassa_payment_id = ? OR payment_id = ?",
+        lambda rows, users: (f"yk-{random.randrange(rows // 10)}",) * 2
+    ),
+    'ожидающие платежи': (
+        "SELECT payment_id, user_id, tariff_type, yookassa_payment_id FROM payments WHERE status = 'pending'",
+        lambda rows, users: ()
+    )
+}
+
+
+def fill(conn, rows):
+    users = max(1, rows // 20)
+    conn.executemany(
+        "INSERT INTO chat_history (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+        ((i % users, 'user' if i % 2 else 'assistant', f"сообщение {i}",
+          time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(1700000000 + i))) for i in range(rows))
+    )
+    conn.executemany(
+        "INSERT INTO payments (user_id, payment_id, yookassa_payment_id, tariff_type, amount, status) "
+        "VALUES (?, ?, ?, 'premium', 139, ?)",
+        ((i % users, f"p-{i}", f"yk-{i}", 'pending' if i % 1000 == 0 else 'succeeded') for i in range(rows // 10))
+    )
+    conn.commit()
+    return users
+
+
+def measure(conn, rows, users, repeat=200):
+    result = {}
+    for name, (sql, make_params) in QUERIES.items():
+        params = [make_params(rows, users) for _ in range(repeat)]
+        started = time.perf_counter()
+        for args in params:
+            conn.execute(sql, args).fetchall()
+        result[name] = (time.perf_counter() - started) / repeat * 1e6
+    return result
+
+
+def main(sizes):
+    print(f"{'сообщений':>10} | {'запрос':<22} | {'без индексов':>14} | {'с индексами':>12}")
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = sqlite3.connect(os.path.join(tmp, 'bench.db'))
+            apply_migrations(conn, target=2)
+            users = fill(conn, rows)
+            before = measure(conn, rows, users)
+            apply_migrations(conn)
+            after = measure(conn, rows, users)
+            conn.close()
+        for name in QUERIES:
+            print(f"{rows:>10} | {name:<22} | {before[name]:>11.1f} мкс | {after[name]:>9.1f} мкс")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000])
@@ -0,0 +1,150 @@
+import os
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
+
+class BookCache:
+    """Дисковый кэш извлеченного текста книг.
+
+    Запись в кэше привязана к пути файла, его размеру, mtime и SHA-1 содержимого.
+    Если размер и mtime совпадают - файл даже не читается. Если отличаются,
+    сверяется хэш: книга переизвлекается только когда содержимое реально изменилось.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.manifest_path = os.path.join(cache_dir, "manifest.json")
+        self.entries = {}
+        self.dirty = False
+        self._load_manifest()
+
+    def _load_manifest(self):
+        """Чтение манифеста кэша"""
+        if not os.path.exists(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('version') == CACHE_VERSION:
+                self.entries = manifest.get('books', {})
+            else:
+                print("🔄 Формат кэша книг устарел - кэш будет пересобран")
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша книг: {e}")
+            self.entries = {}
+
+    @staticmethod
+    def file_hash(file_path):
+        """SHA-1 содержимого файла"""
+        digest = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _text_path(self, sha1):
+        return os.path.join(self.cache_dir, f"{sha1}.txt")
+
+    def _read_text(self, sha1):
+        try:
+            with open(self._text_path(sha1), 'r', encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def fingerprint(self, filename, file_path):
+        """SHA-1 книги, если ее текст уже есть в кэше, иначе None"""
+        stat = os.stat(file_path)
+        entry = self.entries.get(filename)
+
+        if entry and entry['path'] == file_path and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            if os.path.exists(self._text_path(entry['sha1'])):
+                return entry['sha1']
+
+        # Размер или mtime изменились - сверяем содержимое по хэшу
+        sha1 = self.file_hash(file_path)
+        cached = self._find_by_hash(sha1)
+        if cached is None or not os.path.exists(self._text_path(sha1)):
+            return None
+
+        self.entries[filename] = dict(cached, path=file_path, size=stat.st_size, mtime=stat.st_mtime_ns)
+        self.dirty = True
+        return sha1
+
+    def read(self, sha1):
+        """Текст книги из кэша по ее хэшу"""
+        return self._read_text(sha1)
+
+    def signature(self, filenames):
+        """Хэш набора книг: меняется при добавлении, удалении или изменении любой книги"""
+        digest = hashlib.sha1()
+        for filename in filenames:
+            entry = self.entries.get(filename)
+            digest.update(f"{filename}:{entry['sha1'] if entry else ''}\n".encode('utf-8'))
+        return digest.hexdigest()
+
+    def _find_by_hash(self, sha1):
+        for entry in self.entries.values():
+            if entry['sha1'] == sha1:
+                return entry
+        return None
+
+    def put(self, filename, file_path, text):
+        """Сохранение извлеченного текста книги в кэш"""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            stat = os.stat(file_path)
+            sha1 = self.file_hash(file_path)
+
+            tmp_path = self._text_path(sha1) + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, self._text_path(sha1))
+
+            self.entries[filename] = {
+                'path': file_path,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'sha1': sha1
+            }
+            self.dirty = True
+        except Exception as e:
+            logger.error(f"Ошибка записи кэша для {filename}: {e}")
+
+    def prune(self, filenames):
+        """Удаление из кэша книг, которых больше нет в папке"""
+        for filename in list(self.entries):
+            if filename not in filenames:
+                del self.entries[filename]
+                self.dirty = True
+
+        if not os.path.isdir(self.cache_dir):
+            return
+
+        live_hashes = {entry['sha1'] for entry in self.entries.values()}
+        for name in os.listdir(self.cache_dir):
+            # Тексты книг называются по SHA-1, остальные файлы кэша не трогаем
+            if len(name) == 44 and name.endswith('.txt') and name[:-4] not in live_hashes:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+    def save(self):
+        """Атомарная запись манифеста"""
+        if not self.dirty:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = self.manifest_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': CACHE_VERSION, 'books': self.entries}, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.manifest_path)
+            self.dirty = False
+        except Exception as e:
+            logger.error(f"Ошибка записи манифеста кэша книг: {e}")
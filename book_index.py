@@ -0,0 +1,244 @@
+import os
+import re
+import json
+import math
+import time
+import heapq
+import threading
+from array import array
+from collections import Counter, OrderedDict
+
+from russian_stemmer import stem
+from chunk_store import map_readonly, write_atomic
+
+INDEX_FORMAT_VERSION = 1
+INDEX_DATA_FILE = "index.bin"
+INDEX_META_FILE = "index.json"
+
+TOKEN_RE = re.compile(r'[0-9a-zа-яё]+')
+# Слишком короткие слова не индексируются
+MIN_TOKEN_LENGTH = 3
+
+# Служебные слова, которые не несут смысла для поиска
+STOP_WORDS = frozenset("""
+без был была были было быть вам вас ваш вот все всё всех где даже для его ему если есть еще ещё или
+как когда кто меня мне мной мой моя мои может можно над надо нам нас наш него нее неё ней нет них
+нужно она они оно очень перед под после потому почему при про сам сама свой себе себя собой так
+также там тебе тебя тем тоже только тот тут уже чем через что чтобы эта эти это этот
+""".split())
+
+# Параметры BM25
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Словарь "слово -> основа" для всех слов корпуса, заполняется при индексации.
+# Слова запросов, которых нет в корпусе, берутся из кэша функции stem
+STEM_DICTIONARY = {}
+
+
+def normalize_token(token):
+    """Нормализация слова: нижний регистр, ё -> е"""
+    return token.lower().replace('ё', 'е')
+
+
+def stem_token(token):
+    """Основа нормализованного слова"""
+    stemmed = STEM_DICTIONARY.get(token)
+    if stemmed is None:
+        stemmed = stem(token)
+    return stemmed
+
+
+def tokenize(text, learn=False):
+    """Разбиение текста на основы слов (learn=True пополняет словарь основ)"""
+    tokens = []
+    for token in TOKEN_RE.findall(text.lower()):
+        token = normalize_token(token)
+        if len(token) < MIN_TOKEN_LENGTH or token in STOP_WORDS:
+            continue
+        if learn and token not in STEM_DICTIONARY:
+            STEM_DICTIONARY[token] = stem(token)
+        tokens.append(stem_token(token))
+    return tokens
+
+
+class InvertedIndex:
+    """Инвертированный индекс: основа слова -> фрагменты книг, в которых она встречается.
+
+    Номера документов совпадают с номерами фрагментов в ChunkStore, для каждого
+    хранится длина в словах. Списки вхождений - массивы номеров по возрастанию
+    с параллельными массивами частот слова, поэтому стоимость поиска зависит
+    только от размера запроса.
+    """
+
+    def __init__(self):
+        self.doc_length = array('I')
+        self.total_length = 0
+        self.postings = {}
+        self.frequencies = {}
+
+    def add(self, text):
+        """Индексация очередного фрагмента; возвращает его номер"""
+        doc_id = len(self.doc_length)
+        tokens = tokenize(text, learn=True)
+        self.doc_length.append(len(tokens))
+        self.total_length += len(tokens)
+
+        for token, count in Counter(tokens).items():
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[token] = array('I')
+                self.frequencies[token] = array('I')
+            posting.append(doc_id)
+            self.frequencies[token].append(count)
+
+        return doc_id
+
+    def search(self, query):
+        """Фрагменты, содержащие слова запроса: {doc_id: множество совпавших слов}"""
+        matches = {}
+        for token in set(tokenize(query)):
+            for doc_id in self.postings.get(token, ()):
+                matches.setdefault(doc_id, set()).add(token)
+        return matches
+
+    def rank(self, query, top_k=5):
+        """BM25-ранжирование фрагментов: список (score, doc_id), лучшие первыми"""
+        total = len(self.doc_length)
+        if not total:
+            return []
+
+        avg_length = self.total_length / total or 1
+        scores = {}
+
+        for token in set(tokenize(query)):
+            posting = self.postings.get(token)
+            if not posting:
+                continue
+
+            idf = math.log(1 + (total - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, tf in zip(posting, self.frequencies[token]):
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_length[doc_id] / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+        return heapq.nlargest(top_k, ((score, doc_id) for doc_id, score in scores.items()))
+
+    def save(self, directory, signature):
+        """Запись индекса на диск: списки вхождений одним бинарным файлом, словарь - в JSON"""
+        os.makedirs(directory, exist_ok=True)
+        vocabulary = sorted(self.postings)
+        docs = array('I')
+        freqs = array('I')
+        for token in vocabulary:
+            docs.extend(self.postings[token])
+            freqs.extend(self.frequencies[token])
+
+        meta = {
+            'version': INDEX_FORMAT_VERSION,
+            'signature': signature,
+            'documents': len(self.doc_length),
+            'total_length': self.total_length,
+            'postings': len(docs),
+            'vocabulary': vocabulary,
+            'sizes': [len(self.postings[token]) for token in vocabulary],
+            'stems': STEM_DICTIONARY
+        }
+        write_atomic(os.path.join(directory, INDEX_DATA_FILE), (docs + freqs + self.doc_length).tobytes())
+        write_atomic(os.path.join(directory, INDEX_META_FILE), json.dumps(meta, ensure_ascii=False).encode('utf-8'))
+
+    @classmethod
+    def open(cls, directory, signature):
+        """Загрузка индекса с диска через mmap; None, если индекса нет или он устарел"""
+        meta_path = os.path.join(directory, INDEX_META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('version') != INDEX_FORMAT_VERSION or meta.get('signature') != signature:
+                return None
+
+            total, documents = meta['postings'], meta['documents']
+            data = map_readonly(os.path.join(directory, INDEX_DATA_FILE))
+            if len(data) != (2 * total + documents) * array('I').itemsize:
+                return None
+
+            index = cls()
+            if len(data):
+                data = data.cast('I')
+                index.doc_length = data[2 * total:]
+                start = 0
+                for token, size in zip(meta['vocabulary'], meta['sizes']):
+                    index.postings[token] = data[start:start + size]
+                    index.frequencies[token] = data[total + start:total + start + size]
+                    start += size
+            index.total_length = meta['total_length']
+            STEM_DICTIONARY.update(meta['stems'])
+            return index
+        except (OSError, ValueError, KeyError) as e:
+            print(f"❌ Ошибка загрузки индекса книг: {e}")
+            return None
+
+    def __len__(self):
+        return len(self.doc_length)
+
+
+class QueryCache:
+    """LRU-кэш результатов поиска с ограничением по времени жизни.
+
+    Ключ - множество основ слов запроса, поэтому "мне тревожно"
+    и "Тревожно мне!" попадают в одну запись. Кэш привязан к подписи корпуса
+    и очищается сам, как только корпус книг меняется.
+    """
+
+    def __init__(self, max_size=1024, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.signature = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(query, *extra):
+        return (frozenset(tokenize(query)),) + extra
+
+    def get(self, key, signature):
+        with self._lock:
+            if signature != self.signature:
+                self._entries.clear()
+                self.signature = signature
+
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, signature, value):
+        with self._lock:
+            if signature != self.signature:
+                return
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'hit_rate': self.hits / total if total else 0.0
+        }
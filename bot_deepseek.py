@@ -1,14 +1,22 @@
 import os
+import signal
 import logging
 import requests
 import time
+import http_client
 from dotenv import load_dotenv
 from flask import jsonify
 from database import SubscriptionManager
 from interface import BotInterface
-from knowledge_base import PsychologyKnowledgeBase
 from payment_handler import PaymentHandler
-from datetime import datetime, timedelta
+from streaming import StreamingReply, parse_sse_line
+from telegram_webhook import telegram_webhook, TELEGRAM_MODE, TELEGRAM_WEBHOOK_SECRET
+from response_cache import ResponseCache
+from prompt_budget import PromptBudget, format_context
+from llm_scheduler import LLMScheduler, TIER_PREMIUM, TIER_FREE
+from send_queue import SendQueue, PRIORITY_REPLY, PRIORITY_BULK
+from dispatcher import UpdateDispatcher, UPDATE_WORKERS, POLL_TIMEOUT, POLL_LIMIT, poll_backoff
+from datetime import datetime
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 # Загружаем переменные окружения
@@ -25,136 +33,176 @@ logger = logging.getLogger(__name__)
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY')
 
+# Таймауты ожидания ответа (секунды)
+TELEGRAM_TIMEOUT = float(os.getenv('TELEGRAM_TIMEOUT', 15))
+DEEPSEEK_TIMEOUT = float(os.getenv('DEEPSEEK_TIMEOUT', 30))
+# Потоковые ответы DeepSeek: текст появляется в чате по мере генерации
+DEEPSEEK_STREAM = os.getenv('DEEPSEEK_STREAM', '1') == '1'
+
+# Режим работы: threads - пул потоков, asyncio - один event loop (async_bot.py)
+BOT_RUNTIME = os.getenv('BOT_RUNTIME', 'threads')
+
+DEEPSEEK_MODEL = "deepseek-chat"
+
+# Системный промпт AI-психолога
+SYSTEM_PROMPT = """Ты - практичный психологический помощник, который ОБЯЗАТЕЛЬНО использует информацию из предоставленных психологических книг.
+
+ИНСТРУКЦИЯ:
+1. ОСНОВЫВАЙ ответ на информации из книг выше 
+2. Давай ответ простым и понятным языком, человеку, который не понимает ничего в психологии
+3. Не придумывай методы, которых нет в книгах
+4. Цитируй конкретные техники и подходы из литературы, но не указывай конкретные источники
+5. Поддержи если сильно необходимо и добавь 1 эмодзи
+6. Старайся не уходить от темы, помоги до конца разобраться в ситуации
+7. Если пользователь запутался или не понимает, дай подробный ответ на заданную тему, но не более 9-10 предложений
+8. Если пользователь говорит, что у него получилось и ему помогло заканчивай диалог кратким советом на будущее
+9. Помни контекст предыдущих сообщений
+10.Продолжай диалог естественно
+
+Формат ответа:
+💭Краткий анализ на основе книг, без указания источника и без слов "Из книги"
+
+💡Конкретная техника/совет из книг понятным языком"""
+
+BOOK_CONTEXT_PROMPT = "ДОПОЛНИТЕЛЬНАЯ ИНФОРМАЦИЯ ИЗ ПСИХОЛОГИЧЕСКИХ КНИГ:\n{book_context}\n\nИспользуй эту информацию в ответе если она релевантна запросу пользователя."
+
+# Команды которые НЕ считаются за сообщения
+NON_MESSAGE_COMMANDS = [
+    '/start', '/menu', '/mystatus', '/myid', '/premium', '/help',
+    '/psychologists', '/mystats', '/buy_premium', '/buy_premium_annual'
+]
+
 class DeepSeekPsychoBot:    
-    def __init__(self):
+    def __init__(self, with_knowledge_base=True):
         self.base_url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
         self.deepseek_url = "https://api.deepseek.com/v1/chat/completions"
         self.sub_manager = SubscriptionManager()
         self.interface = BotInterface(self.sub_manager)
-        self.knowledge_base = PsychologyKnowledgeBase(self.sub_manager)
+        self.knowledge_base = None
+        if with_knowledge_base:
+            # Импорт здесь: процессам без поиска по книгам не нужны PyPDF2 и docx
+            from knowledge_base import PsychologyKnowledgeBase
+            self.knowledge_base = PsychologyKnowledgeBase(self.sub_manager)
+        self.send_queue = SendQueue(self.base_url, timeout=TELEGRAM_TIMEOUT)
+        self.llm_scheduler = LLMScheduler()
+        self.response_cache = ResponseCache(self.sub_manager.db_path)
+        self.prompt_budget = PromptBudget()
         self.payment_handler = PaymentHandler(self)
+        self.dispatcher = None
         print("🤖 Улучшенный DeepSeek Бот с библиотекой инициализирован!")
 
-    def send_message(self, chat_id, text, reply_markup=None):
+    def send_message(self, chat_id, text, reply_markup=None, priority=PRIORITY_REPLY):
         """Отправка сообщения в Telegram"""
         print(f"🔵 DEBUG: send_message вызван с reply_markup типа: {type(reply_markup)}")
-    
-        url = f"{self.base_url}/sendMessage"
+        if reply_markup:
+            print(f"🔵 DEBUG: reply_markup = {reply_markup}")
+        return self.send_message_with_id(chat_id, text, reply_markup, priority=priority) is not None
+
+    def send_message_with_id(self, chat_id, text, reply_markup=None, parse_mode="HTML", priority=PRIORITY_REPLY):
+        """Отправка сообщения в Telegram через очередь отправки; возвращает message_id или None при ошибке"""
         data = {
             "chat_id": chat_id,
-            "text": text,
-            "parse_mode": "HTML"
+            "text": text
         }
+        if parse_mode:
+            data["parse_mode"] = parse_mode
 
         if reply_markup:
-            print(f"🔵 DEBUG: reply_markup = {reply_markup}")
             data["reply_markup"] = reply_markup.to_json()          
       
         try:
-            response = requests.post(url, json=data)
+            response = self.send_queue.call("sendMessage", data, chat_id, priority)
             if response.status_code == 200:
-                return True
+                return response.json().get("result", {}).get("message_id", 0)
             else:
                 logger.error(f"Ошибка отправки: {response.text}")
-                return False
+                return None
         except Exception as e:
             logger.error(f"Ошибка отправки сообщения: {e}")
-            return False
+            return None
 
     def send_menu_message(self, chat_id, user_id, username="", first_name=""):
         """Отправка главного меню пользователю"""
         text, keyboard = self.interface.get_main_menu(user_id, username, first_name)
         return self.send_message(chat_id, text, keyboard)
 
-    def edit_message(self, chat_id, message_id, text, keyboard=None):
+    def edit_message(self, chat_id, message_id, text, keyboard=None, parse_mode="HTML"):
         """Редактирование сообщения"""
-        url = f"{self.base_url}/editMessageText"
         data = {
             "chat_id": chat_id,
             "message_id": message_id,
-            "text": text,
-            "parse_mode": "HTML"
+            "text": text
         }
+        if parse_mode:
+            data["parse_mode"] = parse_mode
 
         if keyboard:
             data["reply_markup"] = keyboard.to_json()
 
         try:
-            response = requests.post(url, json=data)
+            response = self.send_queue.call("editMessageText", data, chat_id)
             return response.status_code == 200
         except Exception as e:
             logger.error(f"Ошибка редактирования сообщения: {e}")
             return False
 
-    def get_deepseek_response(self, user_id, user_message, book_context, chat_history=None):
-        """Получение ответа от DeepSeek"""
-        try:
-            headers = {
-                "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-                "Content-Type": "application/json"
-            }
+    def build_deepseek_request(self, user_message, book_context, chat_history=None):
+        """Заголовки и тело запроса к DeepSeek"""
+        headers = {
+            "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+            "Content-Type": "application/json"
+        }
 
-            messages = []   
+        messages = []
 
-            # ОБЫЧНЫЙ ПРОМПТ
-            system_prompt = """Ты - практичный психологический помощник, который ОБЯЗАТЕЛЬНО использует информацию из предоставленных психологических книг.
+        # ОБЫЧНЫЙ ПРОМПТ
+        messages.append({"role": "system", "content": SYSTEM_PROMPT})
 
-ИНСТРУКЦИЯ:
-1. ОСНОВЫВАЙ ответ на информации из книг выше 
-2. Давай ответ простым и понятным языком, человеку, который не понимает ничего в психологии
-3. Не придумывай методы, которых нет в книгах
-4. Цитируй конкретные техники и подходы из литературы, но не указывай конкретные источники
-5. Поддержи если сильно необходимо и добавь 1 эмодзи
-6. Старайся не уходить от темы, помоги до конца разобраться в ситуации
-7. Если пользователь запутался или не понимает, дай подробный ответ на заданную тему, но не более 9-10 предложений
-8. Если пользователь говорит, что у него получилось и ему помогло заканчивай диалог кратким советом на будущее
-9. Помни контекст предыдущих сообщений
-10.Продолжай диалог естественно
+        if book_context and book_context.strip():
+            messages.append({
+                "role": "system", 
+                "content": BOOK_CONTEXT_PROMPT.format(book_context=book_context)
+            })
+            print(f"🔵 DEBUG: Добавлен контекст из книг ({len(book_context)} символов)")
 
-Формат ответа:
-💭Краткий анализ на основе книг, без указания источника и без слов "Из книги"
+        # ДОБАВЛЯЕМ ИСТОРИЮ ДИАЛОГА
+        if chat_history:
+            for role, content in chat_history:
+                messages.append({"role": role, "content": content})
+                print(f"🔵 DEBUG: Добавлена история - {role}: {content[:50]}...")
+            print(f"🔵 DEBUG: Всего в истории: {len(chat_history)} сообщений")
 
-💡Конкретная техника/совет из книг понятным языком"""
+        # ДОБАВЛЯЕМ ТЕКУЩИЙ ЗАПРОС
+        messages.append({"role": "user", "content": user_message})
+        print(f"🔵 DEBUG: Всего сообщений в промпте: {len(messages)}")
 
-            messages.append({"role": "system", "content": system_prompt})
-
-            if book_context and book_context.strip():
-                messages.append({
-                    "role": "system", 
-                    "content": f"ДОПОЛНИТЕЛЬНАЯ ИНФОРМАЦИЯ ИЗ ПСИХОЛОГИЧЕСКИХ КНИГ:\n{book_context}\n\nИспользуй эту информацию в ответе если она релевантна запросу пользователя."
-                })
-                print(f"🔵 DEBUG: Добавлен контекст из книг ({len(book_context)} символов)")
-
-            # ДОБАВЛЯЕМ ИСТОРИЮ ДИАЛОГА
-            if chat_history:
-                for role, content in chat_history:
-                    messages.append({"role": role, "content": content})
-                    print(f"🔵 DEBUG: Добавлена история - {role}: {content[:50]}...")
-                print(f"🔵 DEBUG: Всего в истории: {len(chat_history)} сообщений")
-
-            # ДОБАВЛЯЕМ ТЕКУЩИЙ ЗАПРОС
-            messages.append({"role": "user", "content": user_message})
-            print(f"🔵 DEBUG: Всего сообщений в промпте: {len(messages)}")
-    
 
-            data = {                
-                "model": "deepseek-chat",
-                "messages": messages,
-                "max_tokens": 500,
-                "temperature": 0.7,
-                "stream": False        
-            }
+        data = {                
+            "model": DEEPSEEK_MODEL,
+            "messages": messages,
+            "max_tokens": 500,
+            "temperature": 0.7,
+            "stream": False        
+        }
+
+        return headers, data
 
-            response = requests.post(
+    def get_deepseek_response(self, user_id, user_message, book_context, chat_history=None, cache_key=None):
+        """Получение ответа от DeepSeek (успешный ответ запоминается в кэше под cache_key)"""
+        try:
+            headers, data = self.build_deepseek_request(user_message, book_context, chat_history)
+
+            response = http_client.post(
                 self.deepseek_url,
                 headers=headers,
                 json=data,
-                timeout=30
+                timeout=DEEPSEEK_TIMEOUT
             )
 
             if response.status_code == 200:
                 result = response.json()
                 ai_response = result['choices'][0]['message']['content']
+                self.response_cache.put(cache_key, ai_response)
 
                 # СОХРАНЯЕМ ОТВЕТ В ИСТОРИЮ (если есть sub_manager)
                 if hasattr(self, 'sub_manager'):
@@ -168,6 +216,194 @@ class DeepSeekPsychoBot:
             logger.error(f"Ошибка DeepSeek: {e}")
             return "Извини, я сейчас не могу ответить. Попробуй позже."
 
+    def stream_deepseek_response(self, chat_id, user_id, user_message, book_context, chat_history, reply, cache_key=None):
+        """Получение ответа от DeepSeek потоком: текст показывается в чате по мере генерации"""
+        try:
+            headers, data = self.build_deepseek_request(user_message, book_context, chat_history)
+            data["stream"] = True
+
+            with http_client.post(self.deepseek_url, headers=headers, json=data,
+                                  timeout=DEEPSEEK_TIMEOUT, stream=True) as response:
+                if response.status_code != 200:
+                    logger.error(f"Ошибка DeepSeek API: {response.text}")
+                    return "Извини, произошла ошибка при обработке запроса."
+
+                for line in response.iter_lines():
+                    done, content = parse_sse_line(line)
+                    if done:
+                        # Ответ получен целиком - его можно отдавать из кэша
+                        self.response_cache.put(cache_key, reply.text)
+                        break
+                    partial = reply.feed(content)
+                    if partial is None:
+                        continue
+                    # Промежуточный текст без разметки: незакрытый тег сломал бы правку
+                    if reply.message_id is None:
+                        message_id = self.send_message_with_id(chat_id, partial, parse_mode=None)
+                        if message_id is not None:
+                            reply.shown(partial, message_id)
+                        else:
+                            reply.fail()
+                    elif self.edit_message(chat_id, reply.message_id, partial, parse_mode=None):
+                        reply.shown(partial)
+                    else:
+                        reply.fail()
+
+        except Exception as e:
+            logger.error(f"Ошибка DeepSeek: {e}")
+            if not reply.text:
+                return "Извини, я сейчас не могу ответить. Попробуй позже."
+
+        ai_response = reply.text
+        if not ai_response:
+            return "Извини, произошла ошибка при обработке запроса."
+
+        # СОХРАНЯЕМ ОТВЕТ В ИСТОРИЮ
+        self.sub_manager.save_message(user_id, "assistant", ai_response)
+        return ai_response
+
+    def send_chat_action(self, chat_id, action="typing"):
+        """Показ действия "печатает" в чате"""
+        try:
+            http_client.post(
+                f"{self.base_url}/sendChatAction",
+                data={"chat_id": chat_id, "action": action},
+                timeout=TELEGRAM_TIMEOUT
+            )
+        except Exception as e:
+            logger.error(f"Ошибка отправки действия: {e}")
+
+    def prepare_consultation(self, user_id, text):
+        """История диалога и контекст из книг для ответа; сообщение пользователя сохраняется в историю"""
+        chat_history = self.sub_manager.get_chat_history(user_id, limit=4)
+        print(f"🔵 DEBUG: История диалога - {len(chat_history)} сообщений")
+
+        # Получаем отрывки из книг и оставляем то, что влезает в бюджет токенов
+        excerpts = self.knowledge_base.get_excerpts_for_ai(text) if self.knowledge_base else ()
+        excerpts, chat_history = self.prompt_budget.fit(
+            [SYSTEM_PROMPT, BOOK_CONTEXT_PROMPT.format(book_context=""), text], excerpts, chat_history
+        )
+        book_context = format_context(excerpts)
+
+        # СОХРАНЯЕМ СООБЩЕНИЕ ПОЛЬЗОВАТЕЛЯ В ИСТОРИЮ (только реальные сообщения)
+        self.sub_manager.save_message(user_id, "user", text)
+        return chat_history, book_context
+
+    @staticmethod
+    def format_reply(deepseek_response, messages_count, daily_limit, sub_type):
+        """Ответ DeepSeek с информацией о лимитах для бесплатных пользователей"""
+        final_response = f"{deepseek_response}"
+        if sub_type != 'premium':
+            final_response += f"\n\n---\n📊 <i>Сообщений сегодня: {messages_count}/{daily_limit}</i>"
+        return final_response
+
+    def answer_message(self, chat_id, user_id, user_name, text, messages_count, daily_limit, sub_type):
+        """Ответ AI-психолога на сообщение пользователя"""
+        # Показываем действие "печатает"
+        self.send_chat_action(chat_id)
+
+        chat_history, book_context = self.prepare_consultation(user_id, text)
+
+        # Одинаковые первые вопросы получают готовый ответ без запроса к API
+        cache_key = ResponseCache.make_key(DEEPSEEK_MODEL, SYSTEM_PROMPT, book_context, chat_history, text)
+        deepseek_response = self.response_cache.get(cache_key)
+        if deepseek_response is not None:
+            print(f"⚡ Ответ для {user_name} взят из кэша")
+            self.sub_manager.save_message(user_id, "assistant", deepseek_response)
+            self.send_answer(chat_id, user_name, None, deepseek_response, messages_count, daily_limit, sub_type)
+            return None
+
+        # Генерируем ответ DeepSeek
+        print(f"🤖 Генерирую ответ с анализом книг для {user_name}...")
+        # Место в очереди к DeepSeek: премиум-пользователи проходят раньше. Ответ
+        # генерируется в потоке планировщика, поэтому поток обработки обновлений не
+        # ждет очереди и сразу берет меню и сообщения других чатов; этот чат остается
+        # занятым, пока Future не завершится
+        return self.llm_scheduler.submit(sub_type, self.generate_answer, chat_id, user_id, user_name, text,
+                                         messages_count, daily_limit, sub_type, chat_history, book_context, cache_key)
+
+    def generate_answer(self, chat_id, user_id, user_name, text, messages_count, daily_limit, sub_type,
+                        chat_history, book_context, cache_key):
+        """Ответ DeepSeek и его отправка (выполняется, когда планировщик выдал место)"""
+        reply = None
+        if DEEPSEEK_STREAM:
+            reply = StreamingReply()
+            deepseek_response = self.stream_deepseek_response(chat_id, user_id, text, book_context,
+                                                              chat_history, reply, cache_key)
+        else:
+            deepseek_response = self.get_deepseek_response(user_id, text, book_context, chat_history, cache_key)
+        self.send_answer(chat_id, user_name, reply, deepseek_response, messages_count, daily_limit, sub_type)
+
+    def send_answer(self, chat_id, user_name, reply, deepseek_response, messages_count, daily_limit, sub_type):
+        """Отправка готового ответа: правка потокового сообщения или новое сообщение"""
+        final_response = self.format_reply(deepseek_response, messages_count, daily_limit, sub_type)
+        if reply is not None and reply.message_id is not None and not reply.failed:
+            # Последняя правка: полный ответ с HTML-разметкой и счетчиком сообщений
+            self.edit_message(chat_id, reply.message_id, final_response)
+        else:
+            # ОТПРАВЛЯЕМ ОДНО СООБЩЕНИЕ
+            self.send_message(chat_id, final_response)
+        print(f"✅ Ответ отправлен пользователю {user_name} ({messages_count}/{daily_limit})")
+
+    def get_runtime_stats(self):
+        """Текст с метриками бота для /admin_stats"""
+        lines = ["📈 <b>Метрики бота</b>", ""]
+        if self.knowledge_base:
+            lines.append(self.knowledge_base.get_cache_stats())
+        else:
+            lines.append("📚 Библиотека не загружена в этом процессе")
+        if self.dispatcher:
+            stats = self.dispatcher.stats()
+            lines.append(
+                f"📨 Обновления: в очереди {stats['pending']} (чатов {stats['chats']}), "
+                f"обработано {stats['processed']}, ошибок {stats['failed']}\n"
+                f"⏱ Ожидание в очереди: среднее {stats['wait_avg'] * 1000:.0f} мс, "
+                f"p99 {stats['wait_p99'] * 1000:.0f} мс"
+            )
+        stats = self.sub_manager.history_writer.stats()
+        lines.append(
+            f"🗂 История диалогов: ждут записи {stats['pending']}, записано {stats['written']} "
+            f"за {stats['batches']} транзакций, повторов {stats['retries']}, потеряно {stats['failed']}"
+        )
+        stats = self.sub_manager.state_cache.stats()
+        lines.append(
+            f"👤 Кэш подписок: {stats['hits']} попаданий, {stats['misses']} промахов "
+            f"({stats['hit_rate']:.0%}), пользователей: {stats['size']}"
+        )
+        stats = self.response_cache.stats()
+        lines.append(
+            f"💬 Кэш ответов: {stats['hits']} попаданий (из базы {stats['disk_hits']}), "
+            f"{stats['misses']} промахов ({stats['hit_rate']:.0%}), в памяти: {stats['size']}"
+        )
+        stats = self.prompt_budget.stats()
+        lines.append(
+            f"🧾 Промпт: в среднем промпт и вопрос {stats['fixed_avg']:.0f}, книги {stats['books_avg']:.0f}, "
+            f"история {stats['history_avg']:.0f} токенов из {stats['budget']}; "
+            f"обрезано {stats['trimmed']} из {stats['prompts']}"
+        )
+        stats = self.llm_scheduler.stats()
+        lines.append(
+            f"🤖 DeepSeek: запросов {stats['active']}/{stats['max_concurrent']}\n"
+            f"   💎 премиум: в очереди {stats[TIER_PREMIUM]['queued']}, "
+            f"ожидание p99 {stats[TIER_PREMIUM]['wait_p99'] * 1000:.0f} мс\n"
+            f"   🆓 бесплатные: в очереди {stats[TIER_FREE]['queued']}, "
+            f"ожидание p99 {stats[TIER_FREE]['wait_p99'] * 1000:.0f} мс"
+        )
+        stats = self.send_queue.stats()
+        lines.append(
+            f"📤 Отправка: в очереди {stats['pending']}, отправлено {stats['sent']}, "
+            f"повторов после 429 {stats['retried']}, ошибок {stats['failed']}\n"
+            f"⏱ Ожидание отправки p99: ответы {stats['reply_wait_p99'] * 1000:.0f} мс, "
+            f"рассылки {stats['bulk_wait_p99'] * 1000:.0f} мс"
+        )
+        if TELEGRAM_MODE == 'webhook':
+            stats = telegram_webhook.stats()
+            lines.append(
+                f"🪝 Вебхук: принято {stats['received']}, отклонено {stats['rejected']}, "
+                f"повторов {stats['duplicates']}"
+            )
+        return "\n".join(lines)
+
     def handle_callback(self, update):
         """Обработка нажатий на кнопки меню"""
         callback_query = update.get("callback_query", {})
@@ -301,100 +537,69 @@ class DeepSeekPsychoBot:
             
             self.send_message(chat_id, message, InlineKeyboardMarkup(keyboard))    
 
-    def process_updates(self):
-        """Основной цикл обработки сообщений"""
-        last_update_id = 0
-        print("🔄 Начинаю опрос сервера Telegram...")
-        print(f"🔑 DeepSeek API: {'✅ Настроен' if DEEPSEEK_API_KEY else '❌ Не настроен'}")
-        print(f"📚 Библиотека: {self.knowledge_base.get_library_info()}")
-
-        # Команды которые НЕ считаются за сообщения
-        NON_MESSAGE_COMMANDS = [
-            '/start', '/menu', '/mystatus', '/myid', '/premium', '/help',
-            '/psychologists', '/mystats', '/buy_premium', '/buy_premium_annual'
-        ]
-
-        while True:
-            try:
-                # Получаем обновления
-                url = f"{self.base_url}/getUpdates"
-                params = {
-                    "offset": last_update_id + 1,
-                    "timeout": 25,
-                    "allowed_updates": ["message", "callback_query"]
-                }
-
-                response = requests.get(url, params=params, timeout=30)
+    def handle_update(self, update):
+        """Обработка одного обновления Telegram"""
+        if "message" in update:
+            message = update["message"]
+            chat_id = message["chat"]["id"]
+            user_id = message["from"]["id"]
+            text = message.get("text", "")
+            user_name = message["chat"].get("first_name", "Пользователь")
+            username = message["from"].get("username", "")
 
-                if response.status_code == 200:
-                    data = response.json()
-                    if data.get("ok"):
-                        updates = data.get("result", [])
+            print(f"📨 Сообщение от {user_name} (ID: {user_id}): {text}")
 
-                        for update in updates:
-                            last_update_id = update["update_id"]
 
-                            if "message" in update:
-                                message = update["message"]
-                                chat_id = message["chat"]["id"]
-                                user_id = message["from"]["id"]
-                                text = message.get("text", "")
-                                user_name = message["chat"].get("first_name", "Пользователь")
-                                username = message["from"].get("username", "")
+            # Проверяем тип команды
+            if text in NON_MESSAGE_COMMANDS:
+                print(f"🔵 DEBUG: Это меню команда: {text}")
+            else:
+                print(f"🔵 DEBUG: Это реальное сообщение: {text}")
 
-                                print(f"📨 Сообщение от {user_name} (ID: {user_id}): {text}")
+            if text == "/start" or text == "/menu":
 
-                                
-                                # Проверяем тип команды
-                                if text in NON_MESSAGE_COMMANDS:
-                                    print(f"🔵 DEBUG: Это меню команда: {text}")
-                                else:
-                                    print(f"🔵 DEBUG: Это реальное сообщение: {text}")
+                can_send, messages_count, daily_limit, sub_type, days_left = self.sub_manager.can_send_message(user_id, is_menu_action=True)
 
-                                if text == "/start" or text == "/menu":
+                menu_text, keyboard = self.interface.get_main_menu(user_id, username, user_name)
 
-                                    can_send, messages_count, daily_limit, sub_type, days_left = self.sub_manager.can_send_message(user_id, is_menu_action=True)
+                # Отправляем меню вместо простого текста
+                success = self.send_menu_message(chat_id, user_id, username, user_name)
+                if success:
+                    print(f"✅ Отправлено меню пользователю {user_name}")
+                else:
+                    print(f"❌ Ошибка отправки меню пользователю {user_name}")
 
-                                    menu_text, keyboard = self.interface.get_main_menu(user_id, username, user_name)
+            elif text and text != "/start" and text != "/menu":
 
-                                    # Отправляем меню вместо простого текста
-                                    success = self.send_menu_message(chat_id, user_id, username, user_name)
-                                    if success:
-                                        print(f"✅ Отправлено меню пользователю {user_name}")
-                                    else:
-                                        print(f"❌ Ошибка отправки меню пользователю {user_name}")
+                # СПИСОК АДМИНОВ - ДОБАВЬТЕ В НАЧАЛО ЭТОГО БЛОКА
+                ADMIN_IDS = [309524694]  # Замените на ваш ID 309524694
 
-                                elif text and text != "/start" and text != "/menu":
-                                    
-                                    # СПИСОК АДМИНОВ - ДОБАВЬТЕ В НАЧАЛО ЭТОГО БЛОКА
-                                    ADMIN_IDS = [309524694]  # Замените на ваш ID 309524694
-                                    
-                                    # Обработка админ-команд (не считаются за сообщения)
-                                    if text.startswith("/admin") or text.startswith("/add_premium") or text.startswith("/remove_premium") or text.startswith("/debug") or text.startswith("/reset_counter") or text.startswith("/setup_webhook") or text.startswith("/webhook_status") or text.startswith("/payment_info"):
-                                        if user_id not in ADMIN_IDS:
-                                            self.send_message(chat_id, "❌ У вас нет прав админа")
-                                            continue
+                # Обработка админ-команд (не считаются за сообщения)
+                if text.startswith("/admin") or text.startswith("/add_premium") or text.startswith("/remove_premium") or text.startswith("/debug") or text.startswith("/reset_counter") or text.startswith("/setup_webhook") or text.startswith("/webhook_status") or text.startswith("/payment_info"):
+                    if user_id not in ADMIN_IDS:
+                        self.send_message(chat_id, "❌ У вас нет прав админа")
+                        return
 
-                                        parts = text.split()
-                                        command = parts[0] if parts else ""
+                    parts = text.split()
+                    command = parts[0] if parts else ""
 
-                                        # ОБРАБОТКА АДМИН КОМАНД ДО ПРОВЕРКИ ЛИМИТОВ
-                                        if command == "/admin_users":
-                                            # Получаем список всех пользователей
-                                            users_list = self.sub_manager.get_all_users_info()
-                                            users_count = self.sub_manager.get_users_count_by_type()
+                    # ОБРАБОТКА АДМИН КОМАНД ДО ПРОВЕРКИ ЛИМИТОВ
+                    if command == "/admin_users":
+                        # Получаем список всех пользователей
+                        users_list = self.sub_manager.get_all_users_info()
+                        users_count = self.sub_manager.get_users_count_by_type()
 
-                                            if not users_list:
-                                                self.send_message(chat_id, "📭 В базе нет пользователей")
-                                                continue
+                        if not users_list:
+                            self.send_message(chat_id, "📭 В базе нет пользователей")
+                            return
 
-                                            # Разбиваем на части (Telegram ограничение 4096 символов)
-                                            total_users = len(users_list)
-                                            premium_count = users_count.get('premium', 0)
-                                            free_count = users_count.get('free', 0)
-                                            trial_count = users_count.get('trial', 0)
+                        # Разбиваем на части (Telegram ограничение 4096 символов)
+                        total_users = len(users_list)
+                        premium_count = users_count.get('premium', 0)
+                        free_count = users_count.get('free', 0)
+                        trial_count = users_count.get('trial', 0)
 
-                                            header = f"""📊 <b>Список пользователей</b>
+                        header = f"""📊 <b>Список пользователей</b>
 
                                 👥 Всего: {total_users} пользователей
                                 💎 Премиум: {premium_count}
@@ -403,181 +608,184 @@ class DeepSeekPsychoBot:
 
                                 """
 
-                                            # Формируем список пользователей
-                                            user_lines = []
-                                            for i, user in enumerate(users_list, 1):
-                                                username_display = f"@{user['username']}" if user['username'] and user['username'] != "N/A" else "без username"
-                                                user_line = f"{i}. <code>{user['user_id']}</code> - {username_display} - {user['subscription_info']}"
-                                                user_lines.append(user_line)
-
-                                            # Разбиваем на сообщения по 20 пользователей в каждом
-                                            chunk_size = 20
-                                            total_pages = (len(user_lines) + chunk_size - 1) // chunk_size
-                                            
-                                            for i in range(0, len(user_lines), chunk_size):
-                                                chunk = user_lines[i:i + chunk_size]
-                                                current_page = (i // chunk_size) + 1
-                                                
-                                                # Для первого сообщения добавляем заголовок
-                                                if i == 0:
-                                                    message_text = header + "\n".join(chunk)
-                                                else:
-                                                    message_text = "\n".join(chunk)
-
-                                                # Добавляем пагинацию если больше одной страницы
-                                                if total_pages > 1:
-                                                    message_text += f"\n\n📄 Страница {current_page}/{total_pages}"
-
-                                                # Отправляем сообщение
-                                                success = self.send_message(chat_id, message_text)
-                                                
-                                                if not success:
-                                                    self.send_message(chat_id, "❌ Ошибка отправки списка пользователей")
-                                                    break
-                                                    
-                                                # Задержка между сообщениями
-                                                if i + chunk_size < len(user_lines):
-                                                    time.sleep(1.5)
-                                            continue  # Важно: продолжаем цикл, чтобы не проверять лимиты
-
-                                        elif command == "/reset_counter":
-                                            #Обнуление счетчика сообщений у пользователя
-                                            if len(parts) < 2:
-                                                self.send_message(chat_id, "❌ Использование: /reset_counter <user_id> [date=today]")
-                                                continue
-                                            
-                                            try:
-                                                target_id = int(parts[1])
-                                                date = parts[2] if len(parts) > 2 else None
-                                                
-                                                if self.sub_manager.reset_message_count(target_id, date):
-                                                    if date:
-                                                        self.send_message(chat_id, f"✅ Счетчик пользователя {target_id} обнулен за {date}")
-                                                    else:
-                                                        self.send_message(chat_id, f"✅ Счетчик пользователя {target_id} обнулен за сегодня")
-                                                else:
-                                                    self.send_message(chat_id, f"❌ Ошибка обнуления счетчика пользователя {target_id}")
-                                                    
-                                            except ValueError:
-                                                self.send_message(chat_id, "❌ Неверный формат user_id")
-                                            continue
-
-                                        elif command == "/admin_user_info":
-                                            # Детальная информация о пользователе
-                                            if len(parts) < 2:
-                                                self.send_message(chat_id, "❌ Использование: /admin_user_info <user_id>")
-                                                continue
-                                            
-                                            try:
-                                                target_id = int(parts[1])
-                                                user_info = self.sub_manager.get_detailed_user_info(target_id)
-                                                self.send_message(chat_id, user_info)
-                                                
-                                            except ValueError:
-                                                self.send_message(chat_id, "❌ Неверный формат user_id. Используйте: /admin_user_info <user_id>")
-                                            except Exception as e:
-                                                self.send_message(chat_id, f"❌ Ошибка при получении информации: {e}")
-                                            continue  # Важно: продолжаем цикл
-
-                                        elif command == "/add_premium":
-                                            if len(parts) < 2:
-                                                self.send_message(chat_id, "❌ Использование: /add_premium <user_id> [days=30]")
-                                                continue
-                                            
-                                            try:
-                                                target_id = int(parts[1])
-                                                days = int(parts[2]) if len(parts) > 2 else 30
-                                                
-                                                # ИСПОЛЬЗУЕМ ПРАВИЛЬНЫЙ МЕТОД
-                                                if self.sub_manager.add_premium_user(target_id, days):
-                                                    self.send_message(chat_id, f"✅ Пользователю {target_id} добавлен премиум на {days} дней")
-                                                else:
-                                                    self.send_message(chat_id, f"❌ Ошибка добавления премиума пользователю {target_id}")
-
-                                            except ValueError:
-                                                self.send_message(chat_id, "❌ Неверный формат user_id или days")
-                                            except Exception as e:
-                                                self.send_message(chat_id, f"❌ Ошибка: {e}")
-                                            continue  # Важно: продолжаем цикл
-
-                                        elif command == "/remove_premium":
-                                            if len(parts) < 2:
-                                                self.send_message(chat_id, "❌ Использование: /remove_premium <user_id>")
-                                                continue
-                                            
-                                            try:
-                                                target_user_id = int(parts[1])
-                                                print(f"🔵 DEBUG: Вызов remove_premium для {target_user_id}")
-                                                
-                                                if self.sub_manager.remove_premium(target_user_id):
-                                                    self.send_message(chat_id, f"✅ Пользователь {target_user_id} исключен из премиума")
-                                                else:
-                                                    self.send_message(chat_id, f"❌ Ошибка исключения пользователя {target_user_id} из премиума")
-
-                                            except ValueError:
-                                                self.send_message(chat_id, "❌ Неверный формат user_id")
-                                            continue  # Важно: продолжаем цикл
-
-                                        elif command == "/force_remove_premium":
-                                            if len(parts) < 2:
-                                                self.send_message(chat_id, "❌ Использование: /force_remove_premium <user_id>")
-                                                continue
-                                            
-                                            try:
-                                                target_user_id = int(parts[1])
-                                                
-                                                # Принудительно обновляем обе таблицы напрямую
-                                                cursor = self.sub_manager.conn.cursor()
-                                                
-                                                # 1. subscriptions
-                                                cursor.execute(
-                                                    "UPDATE subscriptions SET subscription_type = 'free', expiry_date = NULL WHERE user_id = ?",
-                                                    (target_user_id,)
-                                                )
-                                                sub_updated = cursor.rowcount
-                                                
-                                                # 2. users
-                                                cursor.execute(
-                                                    "UPDATE users SET subscription_type = 'free', subscription_end = NULL WHERE user_id = ?",
-                                                    (target_user_id,)
-                                                )
-                                                users_updated = cursor.rowcount
-                                                
-                                                self.sub_manager.conn.commit()
-                                                
-                                                self.send_message(chat_id, 
-                                                    f"🔧 <b>Принудительное обновление завершено!</b>\n\n"
-                                                    f"🆔 User ID: {target_user_id}\n"
-                                                    f"📊 Обновлено записей: {sub_updated + users_updated}"
-                                                )
-                                                
-                                            except ValueError:
-                                                self.send_message(chat_id, "❌ Неверный формат user_id")
-                                            except Exception as e:
-                                                self.send_message(chat_id, f"❌ Ошибка принудительного обновления: {e}")
-                                            continue  # Важно: продолжаем цикл
-
-                                        elif command == "/payment_info":
-                                            """Информация о платеже"""
-                                            if len(parts) < 2:
-                                                self.send_message(chat_id, "❌ Использование: /payment_info <payment_id>")
-                                                continue
-                                            
-                                            payment_id = parts[1]
-                                            
-                                            try:
-                                                cursor = self.sub_manager.conn.cursor()
-                                                cursor.execute("""
+                        # Формируем список пользователей
+                        user_lines = []
+                        for i, user in enumerate(users_list, 1):
+                            username_display = f"@{user['username']}" if user['username'] and user['username'] != "N/A" else "без username"
+                            user_line = f"{i}. <code>{user['user_id']}</code> - {username_display} - {user['subscription_info']}"
+                            user_lines.append(user_line)
+
+                        # Разбиваем на сообщения по 20 пользователей в каждом
+                        chunk_size = 20
+                        total_pages = (len(user_lines) + chunk_size - 1) // chunk_size
+
+                        for i in range(0, len(user_lines), chunk_size):
+                            chunk = user_lines[i:i + chunk_size]
+                            current_page = (i // chunk_size) + 1
+
+                            # Для первого сообщения добавляем заголовок
+                            if i == 0:
+                                message_text = header + "\n".join(chunk)
+                            else:
+                                message_text = "\n".join(chunk)
+
+                            # Добавляем пагинацию если больше одной страницы
+                            if total_pages > 1:
+                                message_text += f"\n\n📄 Страница {current_page}/{total_pages}"
+
+                            # Отправляем сообщение: паузы между страницами выдерживает очередь
+                            # отправки, а ответы пользователям идут вне очереди рассылок
+                            success = self.send_message(chat_id, message_text, priority=PRIORITY_BULK)
+
+                            if not success:
+                                self.send_message(chat_id, "❌ Ошибка отправки списка пользователей")
+                                break
+                        return  # Важно: выходим, чтобы не проверять лимиты
+
+                    elif command == "/admin_stats":
+                        # Метрики кэшей и очередей бота
+                        self.send_message(chat_id, self.get_runtime_stats())
+                        return
+
+                    elif command == "/reset_counter":
+                        #Обнуление счетчика сообщений у пользователя
+                        if len(parts) < 2:
+                            self.send_message(chat_id, "❌ Использование: /reset_counter <user_id> [date=today]")
+                            return
+
+                        try:
+                            target_id = int(parts[1])
+                            date = parts[2] if len(parts) > 2 else None
+
+                            if self.sub_manager.reset_message_count(target_id, date):
+                                if date:
+                                    self.send_message(chat_id, f"✅ Счетчик пользователя {target_id} обнулен за {date}")
+                                else:
+                                    self.send_message(chat_id, f"✅ Счетчик пользователя {target_id} обнулен за сегодня")
+                            else:
+                                self.send_message(chat_id, f"❌ Ошибка обнуления счетчика пользователя {target_id}")
+
+                        except ValueError:
+                            self.send_message(chat_id, "❌ Неверный формат user_id")
+                        return
+
+                    elif command == "/admin_user_info":
+                        # Детальная информация о пользователе
+                        if len(parts) < 2:
+                            self.send_message(chat_id, "❌ Использование: /admin_user_info <user_id>")
+                            return
+
+                        try:
+                            target_id = int(parts[1])
+                            user_info = self.sub_manager.get_detailed_user_info(target_id)
+                            self.send_message(chat_id, user_info)
+
+                        except ValueError:
+                            self.send_message(chat_id, "❌ Неверный формат user_id. Используйте: /admin_user_info <user_id>")
+                        except Exception as e:
+                            self.send_message(chat_id, f"❌ Ошибка при получении информации: {e}")
+                        return  # Важно: дальше не обрабатываем
+
+                    elif command == "/add_premium":
+                        if len(parts) < 2:
+                            self.send_message(chat_id, "❌ Использование: /add_premium <user_id> [days=30]")
+                            return
+
+                        try:
+                            target_id = int(parts[1])
+                            days = int(parts[2]) if len(parts) > 2 else 30
+
+                            # ИСПОЛЬЗУЕМ ПРАВИЛЬНЫЙ МЕТОД
+                            if self.sub_manager.add_premium_user(target_id, days):
+                                self.send_message(chat_id, f"✅ Пользователю {target_id} добавлен премиум на {days} дней")
+                            else:
+                                self.send_message(chat_id, f"❌ Ошибка добавления премиума пользователю {target_id}")
+
+                        except ValueError:
+                            self.send_message(chat_id, "❌ Неверный формат user_id или days")
+                        except Exception as e:
+                            self.send_message(chat_id, f"❌ Ошибка: {e}")
+                        return  # Важно: дальше не обрабатываем
+
+                    elif command == "/remove_premium":
+                        if len(parts) < 2:
+                            self.send_message(chat_id, "❌ Использование: /remove_premium <user_id>")
+                            return
+
+                        try:
+                            target_user_id = int(parts[1])
+                            print(f"🔵 DEBUG: Вызов remove_premium для {target_user_id}")
+
+                            if self.sub_manager.remove_premium(target_user_id):
+                                self.send_message(chat_id, f"✅ Пользователь {target_user_id} исключен из премиума")
+                            else:
+                                self.send_message(chat_id, f"❌ Ошибка исключения пользователя {target_user_id} из премиума")
+
+                        except ValueError:
+                            self.send_message(chat_id, "❌ Неверный формат user_id")
+                        return  # Важно: дальше не обрабатываем
+
+                    elif command == "/force_remove_premium":
+                        if len(parts) < 2:
+                            self.send_message(chat_id, "❌ Использование: /force_remove_premium <user_id>")
+                            return
+
+                        try:
+                            target_user_id = int(parts[1])
+
+                            # Принудительно обновляем обе таблицы напрямую
+                            cursor = self.sub_manager.conn.cursor()
+
+                            # 1. subscriptions
+                            cursor.execute(
+                                "UPDATE subscriptions SET subscription_type = 'free', expiry_date = NULL WHERE user_id = ?",
+                                (target_user_id,)
+                            )
+                            sub_updated = cursor.rowcount
+
+                            # 2. users
+                            cursor.execute(
+                                "UPDATE users SET subscription_type = 'free', subscription_end = NULL WHERE user_id = ?",
+                                (target_user_id,)
+                            )
+                            users_updated = cursor.rowcount
+
+                            self.sub_manager.conn.commit()
+                            self.sub_manager.state_cache.invalidate(target_user_id)
+
+                            self.send_message(chat_id, 
+                                f"🔧 <b>Принудительное обновление завершено!</b>\n\n"
+                                f"🆔 User ID: {target_user_id}\n"
+                                f"📊 Обновлено записей: {sub_updated + users_updated}"
+                            )
+
+                        except ValueError:
+                            self.send_message(chat_id, "❌ Неверный формат user_id")
+                        except Exception as e:
+                            self.send_message(chat_id, f"❌ Ошибка принудительного обновления: {e}")
+                        return  # Важно: дальше не обрабатываем
+
+                    elif command == "/payment_info":
+                        """Информация о платеже"""
+                        if len(parts) < 2:
+                            self.send_message(chat_id, "❌ Использование: /payment_info <payment_id>")
+                            return
+
+                        payment_id = parts[1]
+
+                        try:
+                            cursor = self.sub_manager.conn.cursor()
+                            cursor.execute("""
                                                     SELECT user_id, tariff_type, status, amount, created_at, yookassa_payment_id 
                                                     FROM payments 
                                                     WHERE payment_id = ? OR yookassa_payment_id = ?
                                                 """, (payment_id, payment_id))
-                                                
-                                                payment = cursor.fetchone()
-                                                
-                                                if payment:
-                                                    user_id, tariff_type, status, amount, created_at, yookassa_id = payment
-                                                    text = f"""💳 <b>Информация о платеже</b>
+
+                            payment = cursor.fetchone()
+
+                            if payment:
+                                user_id, tariff_type, status, amount, created_at, yookassa_id = payment
+                                text = f"""💳 <b>Информация о платеже</b>
 
                                         🆔 <b>Payment ID:</b> <code>{payment_id}</code>
                                         👤 <b>User ID:</b> <code>{user_id}</code>
@@ -586,86 +794,86 @@ class DeepSeekPsychoBot:
                                         📊 <b>Статус:</b> {status}
                                         🕒 <b>Создан:</b> {created_at}
                                         🔗 <b>ЮKassa ID:</b> {yookassa_id or 'N/A'}"""
-                                                else:
-                                                    text = f"❌ Платеж {payment_id} не найден"
-                                                
-                                                self.send_message(chat_id, text)
-                                                
-                                            except Exception as e:
-                                                self.send_message(chat_id, f"❌ Ошибка: {e}")
-
-                                        elif command == "/setup_webhook":
-                                            if user_id not in ADMIN_IDS:
-                                                self.send_message(chat_id, "❌ У вас нет прав админа")
-                                                continue
-                                            
-                                            self.send_message(chat_id, "🔧 Настраиваю вебхуки в ЮKassa...")
-                                            success = self.payment_handler.setup_webhook()
-                                            if success:
-                                                self.send_message(chat_id, 
-                                                    "✅ Вебхуки успешно настроены!\n\n"
-                                                    "🔗 URL: https://yookassa-webhook-gstx.onrender.com/webhook/yookassa\n"
-                                                    "🎯 Событие: payment.succeeded\n\n"
-                                                    "Теперь оплаты будут активироваться автоматически!"
-                                                )
-                                            else:
-                                                self.send_message(chat_id, 
-                                                    "❌ Ошибка настройки вебхуков\n\n"
-                                                    "Проверьте:\n"
-                                                    "1. Ключи API ЮKassa в .env\n"
-                                                    "2. Что сервер доступен по ссылке\n"
-                                                    "3. Логи для деталей ошибки"
-                                                )
-                                            continue
-
-                                        elif command == "/webhook_status":
-                                            if user_id not in ADMIN_IDS:
-                                                self.send_message(chat_id, "❌ У вас нет прав админа")
-                                                continue
-                                            
-                                            # Проверяем статус вебхук-сервера
-                                            try:
-                                                # Используем тот же requests что и в других методах
-                                                response = requests.get("https://yookassa-webhook-gstx.onrender.com/health", timeout=10)
-                                                if response.status_code == 200:
-                                                    data = response.json()
-                                                    status = "✅ Активен"
-                                                    additional_info = f"Время: {data.get('timestamp', 'N/A')}"
-                                                else:
-                                                    status = "❌ Ошибка"
-                                                    additional_info = f"Код: {response.status_code}"
-                                                
-                                                self.send_message(chat_id, 
-                                                    f"🌐 Статус вебхук-сервера: {status}\n"
-                                                    f"🔗 URL: https://yookassa-webhook-gstx.onrender.com/webhook/yookassa\n"
-                                                    f"📊 {additional_info}"
-                                                )
-                                            except Exception as e:
-                                                self.send_message(chat_id, f"❌ Ошибка проверки статуса: {e}")
-                                            continue
-
-                                        elif command == "/debug_user":
-                                            if len(parts) < 2:
-                                                self.send_message(chat_id, "❌ Использование: /debug_user <user_id>")
-                                                continue
-                                            
-                                            try:
-                                                target_id = int(parts[1])
-                                                cursor = self.sub_manager.conn.cursor()
-                                                
-                                                # Проверяем subscriptions
-                                                cursor.execute("SELECT subscription_type, expiry_date FROM subscriptions WHERE user_id = ?", (target_id,))
-                                                sub_data = cursor.fetchone()
-                                                
-                                                # Проверяем users
-                                                cursor.execute("SELECT subscription_type, subscription_end, username, first_name FROM users WHERE user_id = ?", (target_id,))
-                                                user_data = cursor.fetchone()
-                                                
-                                                # Проверяем message_stats за сегодня
-                                                cursor.execute("SELECT message_count FROM message_stats WHERE user_id = ? AND date = date('now')", (target_id,))
-                                                stats_data = cursor.fetchone()
-                                                
-                                                debug_text = f"""🔍 <b>Отладка пользователя {target_id}</b>
+                            else:
+                                text = f"❌ Платеж {payment_id} не найден"
+
+                            self.send_message(chat_id, text)
+
+                        except Exception as e:
+                            self.send_message(chat_id, f"❌ Ошибка: {e}")
+
+                    elif command == "/setup_webhook":
+                        if user_id not in ADMIN_IDS:
+                            self.send_message(chat_id, "❌ У вас нет прав админа")
+                            return
+
+                        self.send_message(chat_id, "🔧 Настраиваю вебхуки в ЮKassa...")
+                        success = self.payment_handler.setup_webhook()
+                        if success:
+                            self.send_message(chat_id, 
+                                "✅ Вебхуки успешно настроены!\n\n"
+                                "🔗 URL: https://yookassa-webhook-gstx.onrender.com/webhook/yookassa\n"
+                                "🎯 Событие: payment.succeeded\n\n"
+                                "Теперь оплаты будут активироваться автоматически!"
+                            )
+                        else:
+                            self.send_message(chat_id, 
+                                "❌ Ошибка настройки вебхуков\n\n"
+                                "Проверьте:\n"
+                                "1. Ключи API ЮKassa в .env\n"
+                                "2. Что сервер доступен по ссылке\n"
+                                "3. Логи для деталей ошибки"
+                            )
+                        return
+
+                    elif command == "/webhook_status":
+                        if user_id not in ADMIN_IDS:
+                            self.send_message(chat_id, "❌ У вас нет прав админа")
+                            return
+
+                        # Проверяем статус вебхук-сервера
+                        try:
+                            # Используем тот же пул соединений что и в других методах
+                            response = http_client.get("https://yookassa-webhook-gstx.onrender.com/health", timeout=10)
+                            if response.status_code == 200:
+                                data = response.json()
+                                status = "✅ Активен"
+                                additional_info = f"Время: {data.get('timestamp', 'N/A')}"
+                            else:
+                                status = "❌ Ошибка"
+                                additional_info = f"Код: {response.status_code}"
+
+                            self.send_message(chat_id, 
+                                f"🌐 Статус вебхук-сервера: {status}\n"
+                                f"🔗 URL: https://yookassa-webhook-gstx.onrender.com/webhook/yookassa\n"
+                                f"📊 {additional_info}"
+                            )
+                        except Exception as e:
+                            self.send_message(chat_id, f"❌ Ошибка проверки статуса: {e}")
+                        return
+
+                    elif command == "/debug_user":
+                        if len(parts) < 2:
+                            self.send_message(chat_id, "❌ Использование: /debug_user <user_id>")
+                            return
+
+                        try:
+                            target_id = int(parts[1])
+                            cursor = self.sub_manager.conn.cursor()
+
+                            # Проверяем subscriptions
+                            cursor.execute("SELECT subscription_type, expiry_date FROM subscriptions WHERE user_id = ?", (target_id,))
+                            sub_data = cursor.fetchone()
+
+                            # Проверяем users
+                            cursor.execute("SELECT subscription_type, subscription_end, username, first_name FROM users WHERE user_id = ?", (target_id,))
+                            user_data = cursor.fetchone()
+
+                            # Проверяем message_stats за сегодня
+                            cursor.execute("SELECT message_count FROM message_stats WHERE user_id = ? AND date = date('now')", (target_id,))
+                            stats_data = cursor.fetchone()
+
+                            debug_text = f"""🔍 <b>Отладка пользователя {target_id}</b>
 
                                 📋 <b>Таблица subscriptions:</b>
                                 Тип: {sub_data[0] if sub_data else 'N/A'}
@@ -680,29 +888,29 @@ class DeepSeekPsychoBot:
                                 📊 <b>Статистика за сегодня:</b>
                                 Сообщений: {stats_data[0] if stats_data else '0'}"""
 
-                                                self.send_message(chat_id, debug_text)
-                                                
-                                            except ValueError:
-                                                self.send_message(chat_id, "❌ Неверный формат user_id")
-                                            except Exception as e:
-                                                self.send_message(chat_id, f"❌ Ошибка отладки: {e}")
-                                            continue  # Важно: продолжаем цикл
-
-                                    # ТЕПЕРЬ ПРОВЕРЯЕМ ЛИМИТЫ ТОЛЬКО ДЛЯ ОБЫЧНЫХ СООБЩЕНИЙ
-                                    # Проверяем является ли команда "меню действием"
-                                    is_menu_action = (text in NON_MESSAGE_COMMANDS or 
-                                                    text.startswith('/debug') or 
-                                                    text.startswith('/sync') or 
-                                                    text.startswith('/check') or 
-                                                    text.startswith('/find_user'))
-
-                                    # Проверяем лимиты подписки (передаем флаг is_menu_action)
-                                    can_send, messages_count, daily_limit, sub_type, days_left = self.sub_manager.can_send_message(user_id, is_menu_action)
-
-                                    # Кризисные ситуации обрабатываем всегда
-                                    crisis_words = ['суицид', 'самоубийство', 'умру', 'покончить с собой', 'надоело жить']
-                                    if any(word in text.lower() for word in crisis_words):
-                                        crisis_text = """🚨 <b>Мне очень важно, чтобы ты был в безопасности!</b>
+                            self.send_message(chat_id, debug_text)
+
+                        except ValueError:
+                            self.send_message(chat_id, "❌ Неверный формат user_id")
+                        except Exception as e:
+                            self.send_message(chat_id, f"❌ Ошибка отладки: {e}")
+                        return  # Важно: дальше не обрабатываем
+
+                # ТЕПЕРЬ ПРОВЕРЯЕМ ЛИМИТЫ ТОЛЬКО ДЛЯ ОБЫЧНЫХ СООБЩЕНИЙ
+                # Проверяем является ли команда "меню действием"
+                is_menu_action = (text in NON_MESSAGE_COMMANDS or 
+                                text.startswith('/debug') or 
+                                text.startswith('/sync') or 
+                                text.startswith('/check') or 
+                                text.startswith('/find_user'))
+
+                # Проверяем лимиты подписки (передаем флаг is_menu_action)
+                can_send, messages_count, daily_limit, sub_type, days_left = self.sub_manager.can_send_message(user_id, is_menu_action)
+
+                # Кризисные ситуации обрабатываем всегда
+                crisis_words = ['суицид', 'самоубийство', 'умру', 'покончить с собой', 'надоело жить']
+                if any(word in text.lower() for word in crisis_words):
+                    crisis_text = """🚨 <b>Мне очень важно, чтобы ты был в безопасности!</b>
 
     Пожалуйста, немедленно свяжись со специалистами:
 
@@ -710,29 +918,29 @@ class DeepSeekPsychoBot:
     🏥 <b>Экстренная помощь</b>: 112 или 103
 
     <b>Ты не один, помощь всегда рядом!</b>"""
-                                        self.send_message(chat_id, crisis_text)
-                                        print(f"🚨 Кризисное сообщение от {user_name}")
-                                        continue
-                                                                        
-                                    # Обработка обычных команд (не считаются за сообщения)
-                                    elif text in NON_MESSAGE_COMMANDS:
-                                        
-                                        can_send, messages_count, daily_limit, sub_type, days_left = self.sub_manager.can_send_message(user_id, is_menu_action=True)
-
-                                        if text == "/mystatus":
-                                            text, keyboard = self.interface.get_stats_message(user_id)
-                                            self.send_message(chat_id, text, keyboard)                                           
-                                            
-                                        elif text == "/premium":
-                                            text, keyboard = self.interface.get_subscription_menu(user_id)
-                                            self.send_message(chat_id, text, keyboard)
-
-                                        elif text == "/help":
-                                            text, keyboard = self.interface.get_help_message(user_id)
-                                            self.send_message(chat_id, text, keyboard)
-
-                                        elif text == "/myid":
-                                            user_info = f"""📋 <b>Ваши данные:</b>
+                    self.send_message(chat_id, crisis_text)
+                    print(f"🚨 Кризисное сообщение от {user_name}")
+                    return
+
+                # Обработка обычных команд (не считаются за сообщения)
+                elif text in NON_MESSAGE_COMMANDS:
+
+                    can_send, messages_count, daily_limit, sub_type, days_left = self.sub_manager.can_send_message(user_id, is_menu_action=True)
+
+                    if text == "/mystatus":
+                        text, keyboard = self.interface.get_stats_message(user_id)
+                        self.send_message(chat_id, text, keyboard)                                           
+
+                    elif text == "/premium":
+                        text, keyboard = self.interface.get_subscription_menu(user_id)
+                        self.send_message(chat_id, text, keyboard)
+
+                    elif text == "/help":
+                        text, keyboard = self.interface.get_help_message(user_id)
+                        self.send_message(chat_id, text, keyboard)
+
+                    elif text == "/myid":
+                        user_info = f"""📋 <b>Ваши данные:</b>
 
     🆔 <b>User ID:</b> <code>{user_id}</code>
     👤 <b>Имя:</b> {user_name}
@@ -744,16 +952,16 @@ class DeepSeekPsychoBot:
     • Для идентификации в системе
 
     <b>Сохраните ваш User ID!</b> 📝"""
-                
-                                            self.send_message(chat_id, user_info)
 
-                                        elif text == "/buy_premium":
-                                            tariff_info = self.sub_manager.get_user_tariff_info(user_id)
-                                            
-                                            if tariff_info['sub_type'].startswith('premium'):
-                                                self.send_message(chat_id, "✅ У вас уже активирован премиум тариф!")
-                                            else:
-                                                payment_text = f"""💎 <b>Оформление Premium подписки</b>
+                        self.send_message(chat_id, user_info)
+
+                    elif text == "/buy_premium":
+                        tariff_info = self.sub_manager.get_user_tariff_info(user_id)
+
+                        if tariff_info['sub_type'].startswith('premium'):
+                            self.send_message(chat_id, "✅ У вас уже активирован премиум тариф!")
+                        else:
+                            payment_text = f"""💎 <b>Оформление Premium подписки</b>
 
     Тариф: {self.sub_manager.tariff_plans['premium']['name']}
     Стоимость: {self.sub_manager.tariff_plans['premium']['price']}₽
@@ -766,16 +974,16 @@ class DeepSeekPsychoBot:
 
     После оплаты отправьте скриншот @danilskopov
     Активация в течение 1 часа ⏱️"""
-                                                
-                                                self.send_message(chat_id, payment_text)
 
-                                        elif text == "/buy_premium_annual":
-                                            tariff_info = self.sub_manager.get_user_tariff_info(user_id)
-                                            
-                                            if tariff_info['sub_type'] == 'premium_annual':
-                                                self.send_message(chat_id, "✅ У вас уже активирован годовой премиум!")
-                                            else:
-                                                payment_text = f"""💎 <b>Оформление Годовой Premium подписки</b>
+                            self.send_message(chat_id, payment_text)
+
+                    elif text == "/buy_premium_annual":
+                        tariff_info = self.sub_manager.get_user_tariff_info(user_id)
+
+                        if tariff_info['sub_type'] == 'premium_annual':
+                            self.send_message(chat_id, "✅ У вас уже активирован годовой премиум!")
+                        else:
+                            payment_text = f"""💎 <b>Оформление Годовой Premium подписки</b>
 
     Тариф: {self.sub_manager.tariff_plans['premium_annual']['name']}
     Стоимость: {self.sub_manager.tariff_plans['premium_annual']['price']}₽
@@ -789,108 +997,172 @@ class DeepSeekPsychoBot:
 
     После оплаты отправьте скриншот @danilskopov
     Активация в течение 1 часа ⏱️"""
-                                                
-                                                self.send_message(chat_id, payment_text)
-
-                                        elif text == "/psychologists":
-                                            psychologists = self.sub_manager.get_available_psychologists(user_id)
-                                            
-                                            if psychologists is None:
-                                                self.send_message(chat_id, "❌ Выбор психолога доступен только для премиум пользователей\n\nИспользуйте /premium чтобы узнать больше")
-                                            else:
-                                                psych_text = "🤝 <b>Доступные психологи</b>\n\n"
-                                                for psych in psychologists:
-                                                    psych_text += f"<b>{psych['name']}</b>\n"
-                                                    psych_text += f"Специализация: {psych['specialization']}\n"
-                                                    psych_text += f"Опыт: {psych['experience']}\n\n"
-                                                
-                                                psych_text += "💡 <b>Чтобы выбрать психолога:</b>\nНапишите 'Хочу психолога [имя]' в чат"
-                                                self.send_message(chat_id, psych_text)
-
-                                        elif text == "/mystats":
-                                            stats = self.sub_manager.get_detailed_stats(user_id)
-                                            
-                                            if 'error' in stats:
-                                                self.send_message(chat_id, f"❌ {stats['error']}")
-                                            else:
-                                                stats_text = f"""📊 <b>Ваша статистика</b>
+
+                            self.send_message(chat_id, payment_text)
+
+                    elif text == "/psychologists":
+                        psychologists = self.sub_manager.get_available_psychologists(user_id)
+
+                        if psychologists is None:
+                            self.send_message(chat_id, "❌ Выбор психолога доступен только для премиум пользователей\n\nИспользуйте /premium чтобы узнать больше")
+                        else:
+                            psych_text = "🤝 <b>Доступные психологи</b>\n\n"
+                            for psych in psychologists:
+                                psych_text += f"<b>{psych['name']}</b>\n"
+                                psych_text += f"Специализация: {psych['specialization']}\n"
+                                psych_text += f"Опыт: {psych['experience']}\n\n"
+
+                            psych_text += "💡 <b>Чтобы выбрать психолога:</b>\nНапишите 'Хочу психолога [имя]' в чат"
+                            self.send_message(chat_id, psych_text)
+
+                    elif text == "/mystats":
+                        stats = self.sub_manager.get_detailed_stats(user_id)
+
+                        if 'error' in stats:
+                            self.send_message(chat_id, f"❌ {stats['error']}")
+                        else:
+                            stats_text = f"""📊 <b>Ваша статистика</b>
 
     💬 Всего сообщений: {stats['total_messages']}
     📈 Активных дней: {len(stats['daily_activity'])}
     🔥 Использовано премиум-функций: {stats['premium_features_used']}
 
     <b>Последняя активность:</b>"""
-                                                
-                                                for day in stats['daily_activity'][:5]:  # Последние 5 дней
-                                                    stats_text += f"\n• {day['date']}: {day['message_count']} сообщ."
-                                                
-                                                self.send_message(chat_id, stats_text)
 
-                                        continue
+                            for day in stats['daily_activity'][:5]:  # Последние 5 дней
+                                stats_text += f"\n• {day['date']}: {day['message_count']} сообщ."
+
+                            self.send_message(chat_id, stats_text)
 
-                                    # Проверяем лимит для реальных сообщений
-                                    if not can_send and not is_menu_action:
-                                        limit_text = f"""❌ <b>Лимит сообщений исчерпан</b>
+                    return
+
+                # Проверяем лимит для реальных сообщений
+                if not can_send and not is_menu_action:
+                    limit_text = f"""❌ <b>Лимит сообщений исчерпан</b>
 
     Вы использовали {messages_count-1}/{daily_limit} сообщений сегодня.
 
     💎 Перейдите на Premium подписку для безлимитного общения!"""
-                                        self.send_message(chat_id, limit_text)
-                                        print(f"📊 Лимит исчерпан для {user_name}")
-                                    else:
-                                        # Обработка реальных сообщений пользователя (считаются за сообщения)
-                                        if not is_menu_action:
-                                            # Показываем действие "печатает"
-                                            requests.post(
-                                                f"{self.base_url}/sendChatAction",
-                                                data={"chat_id": chat_id, "action": "typing"}
-                                            )
+                    self.send_message(chat_id, limit_text)
+                    print(f"📊 Лимит исчерпан для {user_name}")
+                else:
+                    # Обработка реальных сообщений пользователя (считаются за сообщения)
+                    if not is_menu_action:
+                        return self.answer_message(chat_id, user_id, user_name, text, messages_count, daily_limit, sub_type)
 
-                                            chat_history = self.sub_manager.get_chat_history(user_id, limit=4)
-                                            print(f"🔵 DEBUG: История диалога - {len(chat_history)} сообщений")
+        elif "callback_query" in update:
+            # Обработка нажатий на кнопки меню (НЕ считаются за сообщения)
+            self.handle_callback(update)
 
-                                            # Получаем контекст из книг
-                                            book_context = self.knowledge_base.get_context_for_ai(text)
+    def process_updates(self):
+        """Основной цикл опроса Telegram: обновления раздаются диспетчеру"""
+        last_update_id = 0
+        print("🔄 Начинаю опрос сервера Telegram...")
+        print(f"🔑 DeepSeek API: {'✅ Настроен' if DEEPSEEK_API_KEY else '❌ Не настроен'}")
+        if self.knowledge_base:
+            print(f"📚 Библиотека: {self.knowledge_base.get_library_info()}")
 
-                                            # СОХРАНЯЕМ СООБЩЕНИЕ ПОЛЬЗОВАТЕЛЯ В ИСТОРИЮ (только реальные сообщения)
-                                            self.sub_manager.save_message(user_id, "user", text)
+        self.dispatcher = UpdateDispatcher(self.handle_update)
+        print(f"🧵 Обработчиков обновлений: {UPDATE_WORKERS}")
 
-                                            # Генерируем ответ DeepSeek
-                                            print(f"🤖 Генерирую ответ с анализом книг для {user_name}...")                                      
-                                            deepseek_response = self.get_deepseek_response(user_id, text, book_context, chat_history)
+        # Пока установлен вебхук, getUpdates отвечает 409 Conflict
+        telegram_webhook.delete_webhook(self.base_url)
 
-                                            # СОЗДАЕМ ОДНО СООБЩЕНИЕ
-                                            final_response = f"{deepseek_response}"
+        errors = 0
+        while True:
+            try:
+                # Получаем обновления
+                url = f"{self.base_url}/getUpdates"
+                params = {
+                    "offset": last_update_id + 1,
+                    "timeout": POLL_TIMEOUT,
+                    "limit": POLL_LIMIT,
+                    "allowed_updates": ["message", "callback_query"]
+                }
 
-                                            # Добавляем информацию о лимитах для бесплатных пользователей
-                                            if sub_type != 'premium':
-                                                final_response += f"\n\n---\n📊 <i>Сообщений сегодня: {messages_count}/{daily_limit}</i>"
+                response = http_client.get(url, params=params, timeout=POLL_TIMEOUT + 5)
+
+                if response.status_code == 200:
+                    data = response.json()
+                    if data.get("ok"):
+                        updates = data.get("result", [])
 
-                                            # ОТПРАВЛЯЕМ ОДНО СООБЩЕНИЕ
-                                            self.send_message(chat_id, final_response)
-                                            print(f"✅ Ответ отправлен пользователю {user_name} ({messages_count}/{daily_limit})")
+                        for update in updates:
+                            # Блокируется, если очередь переполнена: новые обновления
+                            # не запрашиваются, пока обработчики не разберут старые
+                            self.dispatcher.submit(update)
+                            last_update_id = update["update_id"]
 
-                            elif "callback_query" in update:
-                                # Обработка нажатий на кнопки меню (НЕ считаются за сообщения)
-                                self.handle_callback(update)
+                        # Сразу запрашиваем следующую порцию: если обновлений нет,
+                        # Telegram сам подержит запрос до POLL_TIMEOUT секунд
+                        errors = 0
+                        continue
 
-                # Небольшая пауза между запросами
-                time.sleep(1)
+                # Ошибка API: ждем с нарастающей паузой или сколько попросил Telegram
+                errors += 1
+                delay = max(poll_backoff(errors), http_client.retry_after(response))
+                logger.error(f"Ошибка getUpdates ({response.status_code}): {response.text[:200]}")
+                time.sleep(delay)
 
             except KeyboardInterrupt:
-                print("\n\n🛑 Бот остановлен пользователем")
-                break
+                self.dispatcher.shutdown()
+                self.send_queue.close()
+                http_client.close_all()
+                self.sub_manager.close()
+                # Дальше - в main: без этого main создал бы бота заново
+                raise
             except requests.exceptions.Timeout:
                 # Таймаут - это нормально, продолжаем работу
                 continue
             except Exception as e:
+                errors += 1
+                delay = poll_backoff(errors)
                 logger.error(f"Ошибка в основном цикле: {e}")
-                print(f"⚠️  Ошибка: {e}. Продолжаю работу...")
-                time.sleep(5)
+                print(f"⚠️  Ошибка: {e}. Повтор через {delay:.0f} сек...")
+                time.sleep(delay)
+
+    def submit_update(self, update, timeout=None):
+        """Передача обновления из вебхука диспетчеру; False, если очередь переполнена"""
+        return self.dispatcher is not None and self.dispatcher.submit(update, timeout)
+
+    def serve_webhook(self):
+        """Прием обновлений через вебхук Telegram (TELEGRAM_MODE=webhook) вместо опроса"""
+        print(f"🔑 DeepSeek API: {'✅ Настроен' if DEEPSEEK_API_KEY else '❌ Не настроен'}")
+        if self.knowledge_base:
+            print(f"📚 Библиотека: {self.knowledge_base.get_library_info()}")
+
+        self.dispatcher = UpdateDispatcher(self.handle_update)
+        print(f"🧵 Обработчиков обновлений: {UPDATE_WORKERS}")
+
+        try:
+            telegram_webhook.attach(self)
+            if not telegram_webhook.set_webhook(self.base_url):
+                raise RuntimeError("Не удалось установить вебхук Telegram")
+
+            # Обновления приходят в health server, основной поток просто ждет остановки
+            while True:
+                time.sleep(3600)
+        finally:
+            # И при остановке, и перед перезапуском после ошибки: иначе каждый
+            # перезапуск оставлял бы работающий пул обработчиков
+            telegram_webhook.attach(None)
+            self.dispatcher.shutdown()
+            self.send_queue.close()
+            http_client.close_all()
+            self.sub_manager.close()
 
               
 
+
+def stop_on_sigterm(signum, frame):
+    # Render останавливает процесс сигналом SIGTERM: обрабатываем его как Ctrl+C,
+    # чтобы бот штатно остановился и дописал историю диалогов в базу
+    raise KeyboardInterrupt
+
+
 def main():
+    signal.signal(signal.SIGTERM, stop_on_sigterm)
+
     # Проверяем токены
     if not TELEGRAM_TOKEN or TELEGRAM_TOKEN == "ваш_telegram_токен":
         print("❌ ОШИБКА: Замени TELEGRAM_TOKEN в файле .env на реальный токен!")
@@ -900,6 +1172,10 @@ def main():
         print("❌ ОШИБКА: Замени DEEPSEEK_API_KEY в файле .env на реальный ключ!")
         return
 
+    if TELEGRAM_MODE == 'webhook' and not TELEGRAM_WEBHOOK_SECRET:
+        print("❌ ОШИБКА: Для TELEGRAM_MODE=webhook задай TELEGRAM_WEBHOOK_SECRET в файле .env (один на все экземпляры)!")
+        return
+
     print("=" * 50)
     print("🤖 DEEPSEEK ПСИХОЛОГИЧЕСКИЙ БОТ ЗАПУЩЕН")
     print("=" * 50)
@@ -912,8 +1188,15 @@ def main():
     restart_count = 0
     while restart_count < 10:
         try:
-            bot = DeepSeekPsychoBot()
-            bot.process_updates()
+            if BOT_RUNTIME == 'asyncio':
+                from async_bot import AsyncDeepSeekPsychoBot
+                bot = AsyncDeepSeekPsychoBot()
+            else:
+                bot = DeepSeekPsychoBot()
+            if TELEGRAM_MODE == 'webhook':
+                bot.serve_webhook()
+            else:
+                bot.process_updates()
         except KeyboardInterrupt:
             print("\n🛑 Бот остановлен пользователем")
             break
@@ -926,7 +1209,7 @@ def main():
     print("🔴 Бот остановлен")
 
 import threading
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import BaseHTTPRequestHandler
 
 class HealthHandler(BaseHTTPRequestHandler):
     def do_GET(self):
@@ -946,6 +1229,8 @@ from flask import Flask
 def start_health_server():
     """Простой HTTP сервер для удовлетворения Render"""
     app = Flask(__name__)
+    # Вебхук Telegram обслуживается этим же сервером (TELEGRAM_MODE=webhook)
+    telegram_webhook.register(app)
     
     @app.route('/health')
     def health():
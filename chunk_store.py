@@ -0,0 +1,208 @@
+import os
+import re
+import json
+import mmap
+import logging
+from array import array
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина фрагмента книги в символах
+CHUNK_MAX_CHARS = int(os.getenv('CHUNK_MAX_CHARS', 500))
+
+CORPUS_FORMAT_VERSION = 1
+CORPUS_TEXT_FILE = "corpus.txt"
+CORPUS_INDEX_FILE = "corpus.idx"
+CORPUS_META_FILE = "corpus.json"
+
+SENTENCE_END_RE = re.compile(r'(?<=[.!?…])\s+|\n')
+
+
+def clean_text(text):
+    """Очистка текста от лишних пробелов и переносов"""
+    text = re.sub(r'\n+', '\n', text)
+    text = re.sub(r' +', ' ', text)
+    return text.strip()
+
+
+def split_paragraph(paragraph, max_chars=CHUNK_MAX_CHARS):
+    """Разбиение очищенного параграфа на куски не длиннее max_chars по границам предложений"""
+    if len(paragraph) <= max_chars:
+        return [paragraph]
+
+    pieces = []
+    current = ""
+    for sentence in SENTENCE_END_RE.split(paragraph):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+
+        # Слишком длинное предложение режем по пробелам
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(' ', 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            pieces.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def iter_chunks(text, max_chars=CHUNK_MAX_CHARS):
+    """Фрагменты книги: (смещение исходного параграфа, очищенный текст фрагмента)"""
+    offset = 0
+    for paragraph in text.split('\n\n'):
+        cleaned = clean_text(paragraph)
+        if cleaned:
+            for piece in split_paragraph(cleaned, max_chars):
+                yield offset, piece
+        offset += len(paragraph) + 2
+
+
+def map_readonly(path):
+    """Отображение файла в память только для чтения"""
+    if os.path.getsize(path) == 0:
+        return memoryview(b"")
+    with open(path, 'rb') as f:
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def write_atomic(path, payload):
+    """Запись файла через временный файл и os.replace"""
+    with open(path + ".tmp", 'wb') as f:
+        f.write(payload)
+    os.replace(path + ".tmp", path)
+
+
+class ChunkStore:
+    """Хранилище подготовленных фрагментов книг.
+
+    Тексты всех фрагментов склеены в один UTF-8 файл corpus.txt, а номер книги,
+    байтовые границы фрагмента и смещение в исходном тексте книги лежат
+    в таблице смещений corpus.idx. Оба файла отображаются в память только
+    для чтения, поэтому все процессы бота делят одни и те же страницы кэша ОС.
+
+    Номер фрагмента стабилен для одного и того же набора книг: книги
+    добавляются в отсортированном порядке, фрагменты - по порядку в книге.
+    """
+
+    def __init__(self, max_chars=CHUNK_MAX_CHARS):
+        self.max_chars = max_chars
+        self.books = []
+        self.book_first_chunk = array('I')
+        self.chunk_book = array('I')
+        self.chunk_start = array('I')
+        self.chunk_end = array('I')
+        self.source_offset = array('I')
+        self.meta = {}
+        self.data = b""
+        self._parts = []
+        self._length = 0
+        self._maps = []
+
+    def add_book(self, book_name, content):
+        """Разбиение книги на фрагменты (тексты доступны после freeze)"""
+        book_id = len(self.books)
+        self.books.append(book_name)
+        self.book_first_chunk.append(len(self.chunk_book))
+
+        for offset, piece in iter_chunks(content, self.max_chars):
+            encoded = piece.encode('utf-8')
+            self.chunk_book.append(book_id)
+            self.chunk_start.append(self._length)
+            self.chunk_end.append(self._length + len(encoded))
+            self.source_offset.append(offset)
+            self._parts.append(encoded)
+            self._length += len(encoded)
+
+    def freeze(self):
+        """Склеивание текстов фрагментов после загрузки всех книг"""
+        self.data = b"".join(self._parts)
+        self._parts = []
+
+    def save(self, directory, meta):
+        """Запись корпуса и таблицы смещений на диск (атомарно, через временные файлы)"""
+        os.makedirs(directory, exist_ok=True)
+        meta = dict(
+            meta,
+            version=CORPUS_FORMAT_VERSION,
+            max_chars=self.max_chars,
+            books=self.books,
+            book_first_chunk=list(self.book_first_chunk),
+            chunks=len(self)
+        )
+
+        table = array('I')
+        for column in (self.chunk_book, self.chunk_start, self.chunk_end, self.source_offset):
+            table.extend(column)
+
+        write_atomic(os.path.join(directory, CORPUS_TEXT_FILE), self.data)
+        write_atomic(os.path.join(directory, CORPUS_INDEX_FILE), table.tobytes())
+        # Метаданные пишутся последними: по ним проверяется целостность корпуса
+        write_atomic(os.path.join(directory, CORPUS_META_FILE), json.dumps(meta, ensure_ascii=False).encode('utf-8'))
+
+    @classmethod
+    def open(cls, directory, signature=None):
+        """Отображение сохраненного корпуса в память; None, если корпуса нет или он устарел"""
+        meta_path = os.path.join(directory, CORPUS_META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('version') != CORPUS_FORMAT_VERSION:
+                return None
+            if signature is not None and meta.get('signature') != signature:
+                return None
+
+            store = cls(meta['max_chars'])
+            store.meta = meta
+            store.books = meta['books']
+            store.book_first_chunk = array('I', meta['book_first_chunk'])
+
+            count = meta['chunks']
+            table = store._map(os.path.join(directory, CORPUS_INDEX_FILE))
+            if len(table) != count * 4 * array('I').itemsize:
+                return None
+            if count:
+                table = table.cast('I')
+                store.chunk_book = table[0:count]
+                store.chunk_start = table[count:2 * count]
+                store.chunk_end = table[2 * count:3 * count]
+                store.source_offset = table[3 * count:4 * count]
+
+            store.data = store._map(os.path.join(directory, CORPUS_TEXT_FILE))
+            return store
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Ошибка открытия корпуса книг: {e}")
+            return None
+
+    def _map(self, path):
+        mapped = map_readonly(path)
+        self._maps.append(mapped)
+        return mapped
+
+    def chunk_text(self, chunk_id):
+        return bytes(self.data[self.chunk_start[chunk_id]:self.chunk_end[chunk_id]]).decode('utf-8')
+
+    def book_of(self, chunk_id):
+        return self.books[self.chunk_book[chunk_id]]
+
+    def chunk_key(self, chunk_id):
+        """Стабильный идентификатор фрагмента: (книга, номер фрагмента в книге)"""
+        book_id = self.chunk_book[chunk_id]
+        return self.books[book_id], chunk_id - self.book_first_chunk[book_id]
+
+    def __len__(self):
+        return len(self.chunk_book)
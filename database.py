@@ -1,118 +1,172 @@
-import sqlite3
 from datetime import datetime, timedelta
 import logging
+from db_pool import get_pool, DB_PATH
+from subscription_cache import SubscriptionCache, UserState
+from history_writer import HistoryWriter
 
 logger = logging.getLogger(__name__)
 
+# ИСХОДНАЯ СХЕМА
+SCHEMA_V1 = [
+    '''
+    CREATE TABLE IF NOT EXISTS subscriptions (
+        user_id INTEGER PRIMARY KEY,
+        subscription_type TEXT NOT NULL DEFAULT 'free',
+        expiry_date TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    # ТАБЛИЦА ДЛЯ ИСТОРИИ ДИАЛОГА
+    '''
+    CREATE TABLE IF NOT EXISTS chat_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    # ТАБЛИЦА ДЛЯ СТАТИСТИКИ СООБЩЕНИЙ
+    '''
+    CREATE TABLE IF NOT EXISTS message_stats (
+        user_id INTEGER,
+        date TEXT,
+        message_count INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, date)
+    )
+    ''',
+    # ТАБЛИЦА ДЛЯ ПЛАТЕЖЕЙ
+    '''
+    CREATE TABLE IF NOT EXISTS payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        payment_id TEXT UNIQUE,
+        yookassa_payment_id TEXT,
+        tariff_type TEXT,
+        amount REAL,
+        status TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES subscriptions(user_id)
+    )
+    ''',
+    # ТАБЛИЦА USERS (для совместимости)
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        subscription_type TEXT DEFAULT 'free',
+        subscription_end DATETIME,
+        messages_today INTEGER DEFAULT 0,
+        last_message_date DATE,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    '''
+]
+
+
+def add_missing_payment_columns(conn):
+    """Старый init_database создавал payments без полей ЮKassa - добавляем их"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(payments)")}
+    for name, column_type in (('payment_id', 'TEXT'), ('yookassa_payment_id', 'TEXT'),
+                              ('tariff_type', 'TEXT'), ('updated_at', 'TIMESTAMP')):
+        if name not in columns:
+            conn.execute(f"ALTER TABLE payments ADD COLUMN {name} {column_type}")
+    if 'payment_id' not in columns:
+        # UNIQUE нельзя добавить через ALTER TABLE - вместо него уникальный индекс
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_payment_id ON payments(payment_id)")
+
+
+# Миграции схемы: (версия, описание, шаги). Шаг - SQL или функция от соединения.
+# Текущая версия хранится в PRAGMA user_version; новые изменения схемы -
+# только новой миграцией в конце списка
+MIGRATIONS = [
+    (1, "исходная схема", SCHEMA_V1),
+    (2, "поля ЮKassa в старой таблице payments", [add_missing_payment_columns]),
+    (3, "индексы для истории диалога и поиска платежей", [
+        # История пользователя по времени: WHERE user_id = ? ORDER BY timestamp DESC
+        "CREATE INDEX IF NOT EXISTS idx_chat_history_user_time ON chat_history(user_id, timestamp)",
+        # Поиск платежа по ID ЮKassa (payment_id уже уникален)
+        "CREATE INDEX IF NOT EXISTS idx_payments_yookassa_id ON payments(yookassa_payment_id)",
+        # Проверка ожидающих платежей: WHERE status = 'pending'
+        "CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status, created_at)"
+    ]),
+    (4, "кэш ответов DeepSeek", [
+        '''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+        '''
+    ])
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def apply_migrations(conn, target=SCHEMA_VERSION):
+    """Обновление схемы до версии target; возвращает версию после обновления"""
+    for version, description, steps in MIGRATIONS:
+        if version > target:
+            break
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+            continue
+        # BEGIN IMMEDIATE: бот и вебхук-сервер не выполнят одну миграцию дважды
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                conn.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"✅ Миграция базы данных {version}: {description}")
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
 class SubscriptionManager:
-    def __init__(self, db_path='psychology_bot.db'):
+    def __init__(self, db_path=DB_PATH):
         self.db_path = db_path
-        self.conn = sqlite3.connect(db_path)  # Добавь эту строку!
+        # У каждого потока свое соединение из общего пула (WAL, busy_timeout)
+        self.pool = get_pool(db_path)
+        # Подписки и счетчики активных пользователей в памяти (сквозная запись)
+        self.state_cache = SubscriptionCache()
         self.create_tables()
+        # История диалога пишется в фоне пачками, без commit на каждое сообщение
+        self.history_writer = HistoryWriter(self.pool)
         print("✅ Database manager initialized")
 
+    def close(self):
+        """Запись накопленной истории и закрытие соединений (при остановке бота)"""
+        self.history_writer.close()
+        self.pool.close_all()
+
+    @property
+    def conn(self):
+        """Соединение SQLite текущего потока"""
+        return self.pool.connection()
+
     def create_tables(self):
-        """Создание таблиц если их нет"""
-        cursor = self.conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                user_id INTEGER PRIMARY KEY,
-                subscription_type TEXT NOT NULL DEFAULT 'free',
-                expiry_date TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # ТАБЛИЦА ДЛЯ ИСТОРИИ ДИАЛОГА
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS chat_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            role TEXT NOT NULL,
-            content TEXT NOT NULL,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        # ТАБЛИЦА ДЛЯ СТАТИСТИКИ СООБЩЕНИЙ
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS message_stats (
-            user_id INTEGER,
-            date TEXT,
-            message_count INTEGER DEFAULT 0,
-            PRIMARY KEY (user_id, date)
-        )
-        ''')
-        
-        # ОБНОВЛЕННАЯ ТАБЛИЦА ДЛЯ ПЛАТЕЖЕЙ
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            payment_id TEXT UNIQUE,
-            yookassa_payment_id TEXT,
-            tariff_type TEXT,
-            amount REAL,
-            status TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES subscriptions(user_id)
-        )
-        ''')
-        
-        # ТАБЛИЦА USERS (для совместимости)
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            subscription_type TEXT DEFAULT 'free',
-            subscription_end DATETIME,
-            messages_today INTEGER DEFAULT 0,
-            last_message_date DATE,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        self.conn.commit()
-        print("✅ Все таблицы базы данных созданы/проверены")
+        """Создание таблиц если их нет и обновление схемы до последней версии"""
+        version = apply_migrations(self.conn)
+        print(f"✅ Все таблицы базы данных созданы/проверены (версия схемы {version})")
     
     def init_database(self):
         """Инициализация базы данных подписок"""
-        conn = sqlite3.connect('psychology_bot.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                subscription_type TEXT DEFAULT 'trial',
-                subscription_end DATETIME,
-                messages_today INTEGER DEFAULT 0,
-                last_message_date DATE,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                amount REAL,
-                status TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        self.create_tables()
         print("✅ База данных подписок инициализирована")
     
     def get_user_status(self, user_id, username="", first_name=""):
         """Получение статуса пользователя"""
-        conn = sqlite3.connect('psychology_bot.db')
+        conn = self.conn
         cursor = conn.cursor()
         
         cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
@@ -126,11 +180,8 @@ class SubscriptionManager:
                 VALUES (?, ?, ?, 'trial', ?)
             ''', (user_id, username, first_name, trial_end))
             conn.commit()
-            conn.close()
             return 'trial', trial_end, 0, 7
         
-        conn.close()
-        
         sub_type = user[3]
         sub_end = datetime.fromisoformat(user[4]) if user[4] else None
         messages_today = user[5] or 0
@@ -144,6 +195,53 @@ class SubscriptionManager:
         
         return sub_type, sub_end, messages_today, days_left
     
+    def _load_state(self, user_id, now, today):
+        """Чтение подписки и счетчика из базы в кэш.
+
+        Обычно это один SELECT без блокировки записи; запись идет только для
+        нового пользователя (создается free) и для истекшего премиума.
+        """
+        generation = self.state_cache.generation()
+        conn = self.conn
+        query = (
+            "SELECT s.subscription_type, s.expiry_date, m.message_count FROM subscriptions s "
+            "LEFT JOIN message_stats m ON m.user_id = s.user_id AND m.date = ? "
+            "WHERE s.user_id = ?"
+        )
+        try:
+            row = conn.execute(query, (today, user_id)).fetchone()
+            if row is None:
+                # Новый пользователь - запись free (другой процесс мог создать ее раньше)
+                conn.execute("INSERT OR IGNORE INTO subscriptions (user_id, subscription_type) VALUES (?, 'free')", (user_id,))
+                row = conn.execute(query, (today, user_id)).fetchone()
+            sub_type, expiry_date, message_count = row
+            expiry = datetime.fromisoformat(expiry_date) if expiry_date else None
+            
+            # Проверяем не истекла ли подписка
+            if sub_type == 'premium' and expiry and now > expiry:
+                print(f"🔵 DEBUG: Подписка истекла! Понижаем до free")
+                sub_type = 'free'
+                conn.execute("UPDATE subscriptions SET subscription_type = 'free' WHERE user_id = ?", (user_id,))
+            
+            if conn.in_transaction:
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        
+        state = UserState(sub_type, expiry, today, message_count or 0)
+        self.state_cache.put(user_id, state, generation)
+        return state
+
+    def get_subscription_state(self, user_id):
+        """Подписка с учетом срока, дата окончания и сообщений сегодня - для меню и статистики"""
+        now = datetime.now()
+        today = now.strftime('%Y-%m-%d')
+        state = self.state_cache.get(user_id, today)
+        if state is None:
+            state = self._load_state(user_id, now, today)
+        return state.effective_type(now), state.expiry, state.count
+
     def can_send_message(self, user_id, is_menu_action=None):
         """Упрощенная проверка может ли пользователь отправить сообщение"""
     
@@ -160,85 +258,64 @@ class SubscriptionManager:
             print(f"🔵 DEBUG: Админ {user_id} - безлимитный доступ")
             return True, 0, float('inf'), 'premium', 365
         
+        conn = None
         try:
-            cursor = self.conn.cursor()
+            now = datetime.now()
+            today = now.strftime('%Y-%m-%d')
             
-            # 1. Получаем информацию о подписке
-            cursor.execute("SELECT subscription_type, expiry_date FROM subscriptions WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
+            # Активный пользователь: подписка и счетчик уже в кэше
+            state = self.state_cache.get(user_id, today)
+            cached = state is not None and not state.is_expired(now)
+            if not cached:
+                state = self._load_state(user_id, now, today)
             
-            if result:
-                sub_type, expiry_date = result
-                # Проверяем не истекла ли подписка                
-                if expiry_date and datetime.now() > datetime.fromisoformat(expiry_date):
-                    print(f"🔵 DEBUG: Подписка истекла! Понижаем до free")
-                    sub_type = 'free'
-                    cursor.execute(
-                        "UPDATE subscriptions SET subscription_type = 'free' WHERE user_id = ?",
-                        (user_id,)
-                    )
-                    self.conn.commit()
-            else:
-                print(f"🔵 DEBUG: Подписка не найдена! Создаем free запись")
-                sub_type = 'free'
-                cursor.execute(
-                    "INSERT INTO subscriptions (user_id, subscription_type) VALUES (?, 'free')",
-                    (user_id,)
-                )
-                self.conn.commit()
-            
-            # 2. Получаем тарифный план           
-            daily_limit = 5 if sub_type != 'premium' else float('inf')
-            
-            # 3. Получаем статистику сообщений за сегодня
-            today = datetime.now().strftime('%Y-%m-%d')
-            cursor.execute(
-                "SELECT message_count FROM message_stats WHERE user_id = ? AND date = ?", 
-                (user_id, today)
-            )
-            result = cursor.fetchone()
-            messages_today = result[0] if result else 0
-            
-            print(f"🔵 DEBUG: Текущее состояние - подписка: {sub_type}, сообщений сегодня: {messages_today}, лимит: {daily_limit}")
-            
-            # 4. ЕСЛИ ЭТО МЕНЮ ДЕЙСТВИЕ - НЕ УВЕЛИЧИВАЕМ СЧЕТЧИК
+            # ЕСЛИ ЭТО МЕНЮ ДЕЙСТВИЕ - НЕ УВЕЛИЧИВАЕМ СЧЕТЧИК
             if is_menu_action:
-                print(f"🔵 DEBUG: Меню действие - не увеличиваем счетчик")
-                can_send = True
-                messages_display = messages_today  # Показываем текущее количество
-            else:
-                # РЕАЛЬНОЕ СООБЩЕНИЕ - проверяем лимит и увеличиваем счетчик
-                can_send = messages_today < daily_limit if daily_limit != float('inf') else True
+                print(f"🔵 DEBUG: Меню действие - не увеличиваем счетчик ({state.count})")
+                daily_limit = 5 if state.sub_type != 'premium' else float('inf')
+                return True, state.count, daily_limit, state.sub_type, state.days_left(now)
+            
+            while True:
+                sub_type = state.sub_type
+                daily_limit = 5 if sub_type != 'premium' else float('inf')
+                days_left = state.days_left(now)
                 
-                if can_send:
-                    # Увеличиваем счетчик только для реальных сообщений
-                    if result:
-                        cursor.execute(
-                            "UPDATE message_stats SET message_count = message_count + 1 WHERE user_id = ? AND date = ?",
-                            (user_id, today)
-                        )
-                    else:
-                        cursor.execute(
-                            "INSERT INTO message_stats (user_id, date, message_count) VALUES (?, ?, 1)",
-                            (user_id, today)
-                        )
-                    self.conn.commit()
-                    messages_display = messages_today + 1
-                    print(f"🔵 DEBUG: Реальное сообщение - увеличили счетчик до {messages_display}")
+                # Лимит уже исчерпан - отвечаем без увеличения счетчика
+                if state.count >= daily_limit:
+                    can_send, messages_display = False, state.count
                 else:
-                    messages_display = messages_today
-                    print(f"🔵 DEBUG: Лимит исчерпан - {messages_today}/{daily_limit}")
-            
-            # 5. Вычисляем оставшиеся дни
-            days_left = 0
-            if sub_type == 'premium' and expiry_date:
-                days_left = max(0, (datetime.fromisoformat(expiry_date) - datetime.now()).days)
+                    # РЕАЛЬНОЕ СООБЩЕНИЕ - счетчик увеличивается атомарно, только если лимит
+                    # не исчерпан: одновременные сообщения одного пользователя (в том числе
+                    # из другого процесса) не превысят лимит. Один оператор - один commit
+                    conn = self.conn
+                    result = conn.execute(
+                        "INSERT INTO message_stats (user_id, date, message_count) VALUES (:user_id, :date, 1) "
+                        "ON CONFLICT(user_id, date) DO UPDATE SET message_count = message_count + 1 "
+                        "WHERE :limit IS NULL OR message_count < :limit "
+                        "RETURNING message_count",
+                        {'user_id': user_id, 'date': today, 'limit': None if daily_limit == float('inf') else daily_limit}
+                    ).fetchone()
+                    conn.commit()
+                    
+                    can_send = result is not None
+                    messages_display = result[0] if can_send else daily_limit
+                    self.state_cache.set_count(user_id, today, messages_display)
+                
+                if can_send or not cached:
+                    break
+                # Перед отказом перечитываем подписку из базы: премиум мог выдать
+                # вебхук-сервер ЮKassa - другой процесс, чей сброс кэша сюда не доходит
+                print(f"🔵 DEBUG: Лимит исчерпан по кэшу - перечитываем подписку из базы")
+                state = self._load_state(user_id, now, today)
+                cached = False
             
             print(f"🔵 DEBUG: Итог - можно отправить: {can_send}, показываем: {messages_display}/{daily_limit}")
             
             return can_send, messages_display, daily_limit, sub_type, days_left
             
         except Exception as e:
+            if conn is not None:
+                conn.rollback()
             print(f"❌ Ошибка в can_send_message: {e}")
             import traceback
             print(f"❌ Подробности: {traceback.format_exc()}")
@@ -248,7 +325,7 @@ class SubscriptionManager:
         """Апгрейд подписки"""
         sub_end = datetime.now() + timedelta(days=days)
         
-        conn = sqlite3.connect('psychology_bot.db')
+        conn = self.conn
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -258,7 +335,6 @@ class SubscriptionManager:
         ''', (sub_type, sub_end, user_id))
         
         conn.commit()
-        conn.close()
         return True
     
     def debug_user_status(self, user_id):
@@ -285,30 +361,28 @@ class SubscriptionManager:
             return None, None
         
     def save_message(self, user_id, role, content):
-        """Сохранить сообщение в историю"""
+        """Сохранить сообщение в историю (запись в базу - пачкой в фоне)"""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-            "INSERT INTO chat_history (user_id, role, content) VALUES (?, ?, ?)",
-            (user_id, role, content)
-            )
-            self.conn.commit()
+            self.history_writer.save(user_id, role, content)
             return True
         except Exception as e:
             print(f"❌ Ошибка сохранения истории: {e}")
             return False
 
+    def _read_chat_history(self, user_id, limit):
+        cursor = self.conn.cursor()
+        cursor.execute(
+        "SELECT role, content FROM chat_history WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+        (user_id, limit)
+        )
+        history = cursor.fetchall()
+        # Возвращаем в правильном порядке (от старых к новым)
+        return list(reversed(history))
+
     def get_chat_history(self, user_id, limit=6):
-        """Получить историю диалога (последние N сообщений)"""
+        """Получить историю диалога (последние N сообщений, включая еще не записанные)"""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(
-            "SELECT role, content FROM chat_history WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?",
-            (user_id, limit)
-            )
-            history = cursor.fetchall()
-        # Возвращаем в правильном порядке (от старых к новым)
-            return list(reversed(history))
+            return self.history_writer.recent(user_id, limit, lambda n: self._read_chat_history(user_id, n))
         except Exception as e:
             print(f"❌ Ошибка получения истории: {e}")
             return []
@@ -316,15 +390,18 @@ class SubscriptionManager:
     def clear_chat_history(self, user_id):
 
         """Очистить историю диалога"""
-        try:
+        def delete_saved():
             cursor = self.conn.cursor()
             cursor.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
             self.conn.commit()
             return True
+
+        try:
+            return self.history_writer.clear(user_id, delete_saved)
         except Exception as e:
             print(f"❌ Ошибка очистки истории: {e}")
-            return False    
-        
+            return False
+
     def remove_premium(self, user_id):
         """Исключить пользователя из премиума"""
         try:
@@ -347,6 +424,7 @@ class SubscriptionManager:
             print(f"🔵 DEBUG: Обновлено записей в users: {users_updated}")
             
             self.conn.commit()
+            self.state_cache.invalidate(user_id)
             
             # ПРОВЕРЯЕМ РЕЗУЛЬТАТ
             cursor.execute("SELECT subscription_type FROM subscriptions WHERE user_id = ?", (user_id,))
@@ -410,6 +488,7 @@ class SubscriptionManager:
                 )
             
             self.conn.commit()
+            self.state_cache.set_subscription(user_id, 'premium', expiry_date)
             print(f"✅ Пользователь {user_id} установлен в premium на {days} дней")
             return True
             
@@ -675,6 +754,7 @@ class SubscriptionManager:
             )
             
             self.conn.commit()
+            self.state_cache.invalidate(user_id)
             print(f"✅ Счетчик сообщений пользователя {user_id} обнулен за {date}")
             return True
             
@@ -0,0 +1,90 @@
+import os
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Файл базы данных бота
+DB_PATH = os.getenv('DB_PATH', 'psychology_bot.db')
+# Сколько миллисекунд ждать снятия блокировки записи вместо ошибки "database is locked"
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))
+# Кэш страниц на соединение (КБ) и размер отображения файла в память (байты)
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', 8192))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 64 * 1024 * 1024))
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """Соединения SQLite по одному на поток.
+
+    Все соединения работают в режиме WAL: читатели не ждут писателя и не
+    мешают ему, а бот и вебхук-сервер могут одновременно работать с одним
+    файлом. Конкурирующие записи ждут друг друга до busy_timeout вместо
+    немедленной ошибки. synchronous=NORMAL в WAL не рискует целостностью
+    базы и избавляет от fsync на каждый commit.
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self.opened = 0
+        self._local = threading.local()
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # check_same_thread=False только ради close_all из другого потока
+        conn = sqlite3.connect(self.db_path, timeout=SQLITE_BUSY_TIMEOUT / 1000, check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT}")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+        return conn
+
+    def connection(self):
+        """Соединение текущего потока (создается при первом обращении)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            with self._lock:
+                self._close_dead_threads()
+                self._connections[threading.current_thread()] = conn
+                self.opened += 1
+        return conn
+
+    def _close_dead_threads(self):
+        # Потоки Flask живут один запрос - их соединения закрываем сразу после завершения
+        for thread in [thread for thread in self._connections if not thread.is_alive()]:
+            try:
+                self._connections.pop(thread).close()
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка закрытия соединения SQLite: {e}")
+
+    def close_all(self):
+        """Закрытие всех соединений (при остановке процесса)"""
+        with self._lock:
+            for conn in self._connections.values():
+                try:
+                    conn.close()
+                except sqlite3.Error as e:
+                    logger.error(f"Ошибка закрытия соединения SQLite: {e}")
+            self._connections.clear()
+        self._local = threading.local()
+
+    def stats(self):
+        with self._lock:
+            return {'open': len(self._connections), 'opened': self.opened}
+
+
+def get_pool(db_path=DB_PATH):
+    """Общий пул соединений для файла базы данных"""
+    key = os.path.abspath(db_path)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(db_path)
+        return pool
@@ -0,0 +1,168 @@
+import os
+import time
+import logging
+import threading
+import concurrent.futures
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Количество потоков обработки обновлений (почти все время они ждут сеть)
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 64))
+# Максимум необработанных обновлений; при переполнении прием новых приостанавливается
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+
+# Сколько секунд Telegram держит запрос getUpdates, если новых обновлений нет
+POLL_TIMEOUT = int(os.getenv('POLL_TIMEOUT', 25))
+# Максимум обновлений за один запрос getUpdates (Telegram допускает 1-100)
+POLL_LIMIT = int(os.getenv('POLL_LIMIT', 100))
+# Пауза после ошибки опроса удваивается с каждой ошибкой подряд до POLL_MAX_BACKOFF
+POLL_BACKOFF = float(os.getenv('POLL_BACKOFF', 1))
+POLL_MAX_BACKOFF = float(os.getenv('POLL_MAX_BACKOFF', 30))
+
+
+def poll_backoff(errors):
+    """Пауза перед следующим getUpdates после errors ошибок подряд"""
+    if errors <= 0:
+        return 0.0
+    return min(POLL_MAX_BACKOFF, POLL_BACKOFF * 2 ** (errors - 1))
+
+
+def chat_key(update):
+    """Чат, к которому относится обновление; обновления одного чата обрабатываются по порядку"""
+    if "message" in update:
+        return update["message"].get("chat", {}).get("id")
+    callback_query = update.get("callback_query")
+    if callback_query:
+        chat_id = callback_query.get("message", {}).get("chat", {}).get("id")
+        return chat_id or callback_query.get("from", {}).get("id")
+    return None
+
+
+class UpdateDispatcher:
+    """Параллельная обработка обновлений Telegram с сохранением порядка внутри чата.
+
+    У каждого чата своя очередь, и в любой момент ее обрабатывает не больше
+    одного потока: сообщения одного пользователя идут строго по порядку, а долгий
+    ответ DeepSeek одному пользователю не задерживает меню остальным.
+    Общее число ожидающих обновлений ограничено - submit блокируется, пока
+    не освободится место, и опрос Telegram сам притормаживает.
+    Если обработчик вернул Future (ответ DeepSeek ждет места у планировщика),
+    поток сразу берет следующее обновление, а чат остается занятым, пока
+    Future не завершится: порядок внутри чата сохраняется, а потоки не
+    простаивают в очереди к DeepSeek.
+    """
+
+    def __init__(self, handler, workers=UPDATE_WORKERS, max_pending=UPDATE_QUEUE_SIZE):
+        self.handler = handler
+        self.max_pending = max_pending
+        self.processed = 0
+        self.failed = 0
+        self._chats = {}
+        self._ready = deque()
+        self._pending = 0
+        self._running = True
+        self._waits = deque(maxlen=1000)
+        self._lock = threading.Lock()
+        self._has_work = threading.Condition(self._lock)
+        self._has_room = threading.Condition(self._lock)
+        self._threads = []
+        for i in range(max(1, workers)):
+            thread = threading.Thread(target=self._worker, name=f"update-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, update, timeout=None):
+        """Постановка обновления в очередь его чата; False, если места не дождались"""
+        key = chat_key(update)
+        if key is None:
+            key = ('update', update.get('update_id'))
+
+        with self._lock:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while self._pending >= self.max_pending and self._running:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._has_room.wait(remaining)
+            if not self._running:
+                return False
+
+            self._pending += 1
+            queue = self._chats.get(key)
+            if queue is None:
+                # Чат не обрабатывается и не ждет - ставим его в очередь готовых
+                self._chats[key] = deque([(update, time.monotonic())])
+                self._ready.append(key)
+                self._has_work.notify()
+            else:
+                queue.append((update, time.monotonic()))
+            return True
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                # После остановки ждем и обновления, которые еще доделываются вне потоков
+                while not self._ready and (self._running or self._pending):
+                    self._has_work.wait()
+                if not self._ready:
+                    return
+                key = self._ready.popleft()
+                update, enqueued_at = self._chats[key].popleft()
+                self._waits.append(time.monotonic() - enqueued_at)
+
+            try:
+                result = self.handler(update)
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}")
+                self._finish(key, True)
+                continue
+
+            if isinstance(result, concurrent.futures.Future):
+                result.add_done_callback(lambda future, key=key, update=update: self._finish_future(key, update, future))
+            else:
+                self._finish(key, False)
+
+    def _finish_future(self, key, update, future):
+        error = future.exception() if not future.cancelled() else None
+        if error is not None:
+            logger.error(f"Ошибка обработки обновления {update.get('update_id')}: {error}")
+        self._finish(key, error is not None)
+
+    def _finish(self, key, failed):
+        with self._lock:
+            self._pending -= 1
+            self.processed += 1
+            self.failed += failed
+            self._has_room.notify()
+            # Следующее обновление этого чата - только после текущего
+            if self._chats[key]:
+                self._ready.append(key)
+                self._has_work.notify()
+            else:
+                del self._chats[key]
+                if not self._running and not self._pending:
+                    self._has_work.notify_all()
+
+    def shutdown(self, wait=True):
+        """Остановка приема; уже принятые обновления дорабатываются"""
+        with self._lock:
+            self._running = False
+            self._has_work.notify_all()
+            self._has_room.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                'pending': self._pending,
+                'chats': len(self._chats),
+                'workers': len(self._threads),
+                'processed': self.processed,
+                'failed': self.failed,
+                'wait_avg': sum(waits) / len(waits) if waits else 0.0,
+                'wait_p99': waits[int(len(waits) * 0.99)] if waits else 0.0
+            }
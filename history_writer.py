@@ -0,0 +1,167 @@
+import os
+import time
+import atexit
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Не дольше скольких миллисекунд сообщение ждет записи в chat_history
+HISTORY_FLUSH_INTERVAL_MS = int(os.getenv('HISTORY_FLUSH_INTERVAL_MS', 200))
+# Сколько сообщений записывать одной транзакцией (при наборе - запись сразу)
+HISTORY_FLUSH_ROWS = int(os.getenv('HISTORY_FLUSH_ROWS', 100))
+# Пауза перед повтором неудачной записи (секунды, удваивается до максимума)
+HISTORY_RETRY_DELAY = float(os.getenv('HISTORY_RETRY_DELAY', 0.5))
+HISTORY_RETRY_MAX_DELAY = float(os.getenv('HISTORY_RETRY_MAX_DELAY', 10))
+# Сколько попыток записи делает close, прежде чем отбросить очередь
+HISTORY_CLOSE_RETRIES = int(os.getenv('HISTORY_CLOSE_RETRIES', 5))
+
+
+class HistoryWriter:
+    """Отложенная запись истории диалога пачками.
+
+    save ставит сообщение в очередь и сразу возвращается - ответ пользователю
+    не ждет fsync. Фоновый поток пишет накопленное одной транзакцией раз в
+    interval мс или как только набралось max_rows сообщений. Пока сообщения
+    не записаны, recent добавляет их к прочитанному из базы, поэтому история
+    видна сразу. При остановке процесса очередь дописывается (close, atexit).
+    Пачка, которую не удалось записать (например, "database is locked"),
+    возвращается в начало очереди и пишется повторно с нарастающей паузой;
+    сообщения отбрасываются только в close после последней неудачной попытки.
+    """
+
+    def __init__(self, pool, interval_ms=HISTORY_FLUSH_INTERVAL_MS, max_rows=HISTORY_FLUSH_ROWS):
+        self.pool = pool
+        self.interval = interval_ms / 1000
+        self.max_rows = max(1, max_rows)
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+        self.retries = 0
+        self._delay = 0
+        # Очередь на запись и пачка, которая пишется прямо сейчас
+        self._queue = []
+        self._writing = []
+        self._running = True
+        self._lock = threading.Lock()
+        self._has_rows = threading.Condition(self._lock)
+        # Запись пачки и чтение истории не пересекаются: иначе только что
+        # записанное сообщение было бы видно и в базе, и в очереди
+        self._commit_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def save(self, user_id, role, content):
+        # Время фиксируется при постановке в очередь, в формате CURRENT_TIMESTAMP (UTC)
+        row = (user_id, role, content, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+        with self._lock:
+            running = self._running
+            if running:
+                self._queue.append(row)
+                if len(self._queue) >= self.max_rows:
+                    self._has_rows.notify()
+        if not running:
+            # После остановки фонового потока пишем сразу
+            with self._commit_lock:
+                conn = self.pool.connection()
+                conn.execute("INSERT INTO chat_history (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)", row)
+                conn.commit()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._running and len(self._queue) < self.max_rows:
+                    self._has_rows.wait(self.interval)
+                if not self._running:
+                    # Остаток очереди дописывает close
+                    return
+                if not self._queue:
+                    continue
+            if not self.flush():
+                # Пауза перед повтором: close прерывает ее
+                retry_at = time.monotonic() + self._delay
+                with self._lock:
+                    while self._running and time.monotonic() < retry_at:
+                        self._has_rows.wait(retry_at - time.monotonic())
+
+    def flush(self):
+        """Запись всего, что накопилось, одной транзакцией; False - пачка вернулась в очередь"""
+        with self._commit_lock:
+            with self._lock:
+                if not self._queue:
+                    return True
+                self._writing, self._queue = self._queue, []
+            batch = self._writing
+
+            conn = self.pool.connection()
+            try:
+                conn.executemany(
+                    "INSERT INTO chat_history (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+                    batch
+                )
+                conn.commit()
+                self.written += len(batch)
+                self.batches += 1
+                self._delay = 0
+                return True
+            except sqlite3.Error as e:
+                conn.rollback()
+                self.retries += 1
+                self._delay = min(HISTORY_RETRY_MAX_DELAY, self._delay * 2 or HISTORY_RETRY_DELAY)
+                logger.error(f"Ошибка записи истории диалога ({len(batch)} сообщений), "
+                             f"повтор через {self._delay:.1f} с: {e}")
+                with self._lock:
+                    # Порядок сообщений сохраняется: неудачная пачка снова первая
+                    self._queue = batch + self._queue
+                return False
+            finally:
+                with self._lock:
+                    self._writing = []
+
+    def recent(self, user_id, limit, read_saved):
+        """Последние limit сообщений пользователя: read_saved(limit) из базы плюс еще не записанные"""
+        with self._commit_lock:
+            saved = read_saved(limit)
+            with self._lock:
+                unsaved = [(role, content) for uid, role, content, _ in self._writing + self._queue if uid == user_id]
+        history = saved + unsaved
+        return history[-limit:] if limit else []
+
+    def clear(self, user_id, delete_saved):
+        """Очистка истории пользователя: незаписанные сообщения и delete_saved() для базы"""
+        with self._commit_lock:
+            with self._lock:
+                self._queue = [row for row in self._queue if row[0] != user_id]
+            return delete_saved()
+
+    def close(self, timeout=30):
+        """Остановка с записью всей очереди"""
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            self._has_rows.notify()
+        self._thread.join(timeout)
+        for attempt in range(HISTORY_CLOSE_RETRIES):
+            if attempt:
+                time.sleep(self._delay)
+            if self.flush():
+                return
+        with self._lock:
+            lost, self._queue = self._queue, []
+        self.failed += len(lost)
+        logger.error(f"История диалога не записана после {HISTORY_CLOSE_RETRIES} попыток, "
+                     f"потеряно сообщений: {len(lost)}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._queue) + len(self._writing),
+                'written': self.written,
+                'batches': self.batches,
+                'retries': self.retries,
+                'failed': self.failed
+            }
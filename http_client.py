@@ -0,0 +1,93 @@
+import os
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Таймауты по умолчанию: установка соединения и ожидание ответа (секунды)
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 30))
+# Максимум keep-alive соединений к одному хосту (не меньше числа обработчиков обновлений)
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 64))
+# Повторы при ошибках соединения (любой запрос) и ответах 502/503/504 (только GET и другие идемпотентные)
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 2))
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def _make_session():
+    # Повторяем только то, что точно не было обработано сервером: сбой
+    # установки соединения. Ответ шлюза 502/503/504 на POST не значит, что
+    # запрос не дошел - sendMessage ушел бы дважды, а вызов DeepSeek оплачен
+    # дважды, поэтому по статусу повторяются только идемпотентные методы
+    # (getUpdates). Таймаут чтения не повторяется
+    retry = Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=0,
+        status=HTTP_RETRIES,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        backoff_factor=0.3,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(url):
+    """Общая сессия с пулом keep-alive соединений для хоста из url"""
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    session = _sessions.get(key)
+    if session is None:
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _sessions[key] = _make_session()
+    return session
+
+
+def request(method, url, timeout=None, **kwargs):
+    """HTTP-запрос через пул соединений хоста; timeout - время ожидания ответа или пара (connect, read)"""
+    if timeout is None:
+        timeout = HTTP_READ_TIMEOUT
+    if not isinstance(timeout, tuple):
+        timeout = (HTTP_CONNECT_TIMEOUT, timeout)
+    return get_session(url).request(method, url, timeout=timeout, **kwargs)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def close_all():
+    """Закрытие всех соединений (при остановке процесса)"""
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def retry_after(response):
+    """Сколько секунд сервер просит подождать (429 от Telegram или заголовок Retry-After)"""
+    try:
+        seconds = response.json().get("parameters", {}).get("retry_after")
+    except (ValueError, AttributeError):
+        seconds = None
+    if seconds is None:
+        seconds = response.headers.get("Retry-After")
+    try:
+        return max(0.0, float(seconds)) if seconds is not None else 0.0
+    except ValueError:
+        return 0.0
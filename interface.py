@@ -8,29 +8,8 @@ class BotInterface:
     def get_main_menu(self, user_id, username="", first_name=""):
         """Главное меню бота"""
         try:
-            # НЕ вызываем can_send_message здесь - только получаем текущий статус
-            cursor = self.sub_manager.conn.cursor()
-            
-            # Получаем информацию о подписке напрямую
-            cursor.execute("SELECT subscription_type, expiry_date FROM subscriptions WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
-            
-            if result:
-                sub_type, expiry_date = result
-                # Проверяем не истекла ли подписка                
-                if expiry_date and datetime.now() > datetime.fromisoformat(expiry_date):
-                    sub_type = 'free'
-            else:
-                sub_type = 'free'
-            
-            # Получаем статистику сообщений за сегодня
-            today = datetime.now().strftime('%Y-%m-%d')
-            cursor.execute(
-                "SELECT message_count FROM message_stats WHERE user_id = ? AND date = ?", 
-                (user_id, today)
-            )
-            result = cursor.fetchone()
-            messages_today = result[0] if result else 0
+            # НЕ вызываем can_send_message здесь - только получаем текущий статус (из кэша подписок)
+            sub_type, expiry_date, messages_today = self.sub_manager.get_subscription_state(user_id)
             
             # Текст статуса
             if sub_type == 'premium':
@@ -316,36 +295,15 @@ class BotInterface:
     def get_stats_message(self, user_id):
         """Сообщение со статистикой БЕЗ проверки лимитов"""
         try:
-            # Получаем данные напрямую из БД
-            cursor = self.sub_manager.conn.cursor()
-            
-            # Получаем информацию о подписке
-            cursor.execute("SELECT subscription_type, expiry_date FROM subscriptions WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
-            
-            if result:
-                sub_type, expiry_date = result
-                # Проверяем не истекла ли подписка                
-                if expiry_date and datetime.now() > datetime.fromisoformat(expiry_date):
-                    sub_type = 'free'
-            else:
-                sub_type = 'free'
-            
-            # Получаем статистику сообщений
-            today = datetime.now().strftime('%Y-%m-%d')
-            cursor.execute(
-                "SELECT message_count FROM message_stats WHERE user_id = ? AND date = ?", 
-                (user_id, today)
-            )
-            result = cursor.fetchone()
-            messages_today = result[0] if result else 0
+            # Подписка (с учетом срока) и сообщения за сегодня из кэша подписок
+            sub_type, expiry_date, messages_today = self.sub_manager.get_subscription_state(user_id)
             
             # Формируем текст
             if sub_type == 'premium':
                 sub_info = "Подписка: 💎 Premium"
                 # Вычисляем дни подписки
                 if expiry_date:
-                    days_left = max(0, (datetime.fromisoformat(expiry_date) - datetime.now()).days)
+                    days_left = max(0, (expiry_date - datetime.now()).days)
                     limit_info = f"📅 Дней осталось: {days_left}"
                 else:
                     limit_info = "📅 Срок: бессрочно"
@@ -410,25 +368,13 @@ class BotInterface:
     def get_subscription_menu(self, user_id):
         """Меню подписок"""
         try:
-            # Получаем данные напрямую из БД
-            cursor = self.sub_manager.conn.cursor()
-            
-            # Получаем информацию о подписке
-            cursor.execute("SELECT subscription_type, expiry_date FROM subscriptions WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
-            
-            if result:
-                sub_type, expiry_date = result
-                # Проверяем не истекла ли подписка                
-                if expiry_date and datetime.now() > datetime.fromisoformat(expiry_date):
-                    sub_type = 'free'
-            else:
-                sub_type = 'free'
+            # Подписка с учетом срока из кэша подписок
+            sub_type, expiry_date, _ = self.sub_manager.get_subscription_state(user_id)
             
             # Формируем текст статуса
             if sub_type == 'premium':
                 if expiry_date:
-                    days_left = max(0, (datetime.fromisoformat(expiry_date) - datetime.now()).days)
+                    days_left = max(0, (expiry_date - datetime.now()).days)
                     status_text = f"💎 Premium подписка ({days_left} дней)"
                 else:
                     status_text = "💎 Premium подписка"
@@ -483,21 +429,8 @@ class BotInterface:
     def get_consultation_menu(self, user_id):
         """Меню консультации"""
         try:
-            # Получаем данные напрямую из БД
-            cursor = self.sub_manager.conn.cursor()
-            
-            cursor.execute("SELECT subscription_type FROM subscriptions WHERE user_id = ?", (user_id,))
-            result = cursor.fetchone()
-            sub_type = result[0] if result else 'free'
-            
-            # Получаем статистику сообщений
-            today = datetime.now().strftime('%Y-%m-%d')
-            cursor.execute(
-                "SELECT message_count FROM message_stats WHERE user_id = ? AND date = ?", 
-                (user_id, today)
-            )
-            result = cursor.fetchone()
-            messages_today = result[0] if result else 0
+            # Подписка и сообщения за сегодня из кэша подписок
+            sub_type, _, messages_today = self.sub_manager.get_subscription_state(user_id)
             
             if sub_type == 'premium':
                 status_info = "💎 Premium - безлимитные сообщения"
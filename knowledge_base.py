@@ -1,27 +1,94 @@
 import os
+import time
 import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import PyPDF2
 import docx
 from database import SubscriptionManager
+from book_cache import BookCache
+from book_index import InvertedIndex, QueryCache, tokenize
+from chunk_store import ChunkStore, CHUNK_MAX_CHARS, clean_text
+import vector_index
+from prompt_budget import format_context
 
 logger = logging.getLogger(__name__)
 
+BOOKS_DIR = "./books"
+BOOKS_CACHE_DIR = os.getenv('BOOKS_CACHE_DIR', './books_cache')
+# Количество процессов для извлечения текста (1 - без пула процессов)
+BOOKS_WORKERS = int(os.getenv('BOOKS_WORKERS', os.cpu_count() or 1))
+# Большие PDF режутся на диапазоны страниц, чтобы их тоже извлекать параллельно
+PDF_PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', 40))
+# Загружать книги при первом обращении, а не при создании объекта
+BOOKS_LAZY_LOAD = os.getenv('BOOKS_LAZY_LOAD', '0') == '1'
+# Сколько лучших отрывков отправлять в DeepSeek
+CONTEXT_MAX_EXCERPTS = int(os.getenv('CONTEXT_MAX_EXCERPTS', 4))
+# Кэш контекста для повторяющихся запросов
+CONTEXT_CACHE_SIZE = int(os.getenv('CONTEXT_CACHE_SIZE', 1024))
+CONTEXT_CACHE_TTL = int(os.getenv('CONTEXT_CACHE_TTL', 3600))
+# Семантический поиск (нужен numpy), если ключевые слова не нашли достаточно отрывков
+SEMANTIC_SEARCH = os.getenv('SEMANTIC_SEARCH', '1') == '1'
+
+
+def _extract_book(file_path):
+    """Извлечение книги целиком (выполняется в процессе пула)"""
+    return PsychologyKnowledgeBase.extract_text(file_path)
+
+
+def _extract_pdf_pages(file_path, start, end):
+    """Извлечение диапазона страниц PDF (выполняется в процессе пула)"""
+    pages = []
+    with open(file_path, 'rb') as file:
+        reader = PyPDF2.PdfReader(file)
+        for page_num in range(start, end):
+            pages.append(reader.pages[page_num].extract_text() or "")
+    return pages
+
+
+def _pdf_page_count(file_path):
+    """Количество страниц PDF или None, если файл не читается PyPDF2"""
+    try:
+        with open(file_path, 'rb') as file:
+            return len(PyPDF2.PdfReader(file).pages)
+    except Exception:
+        return None
+
+
 class PsychologyKnowledgeBase:
-    def __init__(self, subscription_manager):
+    def __init__(self, subscription_manager, workers=None, lazy=BOOKS_LAZY_LOAD):
         self.sub_manager = subscription_manager
+        self.workers = workers or BOOKS_WORKERS
         self.knowledge_base = {}
-        self.load_books()
+        self.chunks = ChunkStore()
+        self.index = InvertedIndex()
+        self.vectors = None
+        self.corpus_signature = None
+        self.context_cache = QueryCache(CONTEXT_CACHE_SIZE, CONTEXT_CACHE_TTL)
+        self._loaded = False
+        self._load_lock = threading.Lock()
+        if not lazy:
+            self.ensure_loaded()
+
+    def ensure_loaded(self):
+        """Загрузка книг при первом использовании (один раз на процесс)"""
+        if self._loaded:
+            return
+        with self._load_lock:
+            if not self._loaded:
+                self.load_books()
+                self._loaded = True
     
     def load_books(self):
         """Загрузка книг из папки books"""
-        books_dir = "./books"
+        books_dir = BOOKS_DIR
         if not os.path.exists(books_dir):
             os.makedirs(books_dir)
             print("📁 Создана папка 'books'. Добавьте туда книги в формате PDF, TXT или DOCX!")
             return
         
         supported_files = []
-        for filename in os.listdir(books_dir):
+        for filename in sorted(os.listdir(books_dir)):
             if filename.lower().endswith(('.pdf', '.txt', '.docx')):
                 supported_files.append(filename)
         
@@ -30,31 +97,166 @@ class PsychologyKnowledgeBase:
             return
         
         print(f"📖 Найдено книг: {len(supported_files)}")
+        started = time.time()
+        cache = BookCache(BOOKS_CACHE_DIR)
         
+        fingerprints = {}
+        missing = []
         for filename in supported_files:
-            file_path = os.path.join(books_dir, filename)
             try:
-                if filename.lower().endswith('.pdf'):
-                    text = self.read_pdf(file_path)
-                elif filename.lower().endswith('.docx'):
-                    text = self.read_docx(file_path)
-                else:  # txt
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        text = f.read()
-                
+                sha1 = cache.fingerprint(filename, os.path.join(books_dir, filename))
+            except Exception as e:
+                print(f"❌ Ошибка чтения кэша {filename}: {e}")
+                sha1 = None
+            if sha1:
+                fingerprints[filename] = sha1
+            else:
+                missing.append(filename)
+
+        extracted = {}
+        if missing:
+            print(f"🔄 Извлекаю текст из {len(missing)} книг (процессов: {self.workers})...")
+            extracted = self.extract_books(books_dir, missing)
+            for filename, text in extracted.items():
                 if text:
-                    self.knowledge_base[filename] = {
-                        'content': text,
-                        'type': filename.split('.')[-1].upper()
-                    }
-                    print(f"✅ Загружена: {filename} ({len(text)} символов)")
+                    cache.put(filename, os.path.join(books_dir, filename), text)
+
+        cache.prune(supported_files)
+        cache.save()
+
+        loaded = [f for f in supported_files if f in fingerprints or extracted.get(f)]
+        signature = f"{cache.signature(loaded)}:{CHUNK_MAX_CHARS}"
+
+        # Корпус уже собран для этого набора книг - просто отображаем его в память
+        chunks = ChunkStore.open(BOOKS_CACHE_DIR, signature)
+        if chunks is None:
+            chunks = self.build_corpus(cache, loaded, extracted, signature)
+
+        book_chars = chunks.meta.get('book_chars', {})
+        for filename in supported_files:
+            if filename in book_chars:
+                self.knowledge_base[filename] = {
+                    'type': filename.split('.')[-1].upper(),
+                    'chars': book_chars[filename]
+                }
+                print(f"✅ Загружена: {filename} ({book_chars[filename]} символов)")
+            else:
+                print(f"❌ Не удалось прочитать: {filename}")
+
+        self.chunks = chunks
+        self.corpus_signature = chunks.meta.get('signature')
+        self.build_index()
+        self.build_vectors()
+        print(f"⚡ Книги загружены за {time.time() - started:.2f} сек (из кэша: {len(fingerprints)}/{len(supported_files)})")
+
+    def build_corpus(self, cache, filenames, extracted, signature):
+        """Нарезка книг на фрагменты и запись корпуса на диск"""
+        chunks = ChunkStore()
+        book_chars = {}
+        for filename in filenames:
+            text = extracted.get(filename) or cache.read(cache.entries[filename]['sha1'])
+            if not text:
+                continue
+            chunks.add_book(filename, text)
+            book_chars[filename] = len(text)
+        chunks.freeze()
+        chunks.meta = {'signature': signature, 'book_chars': book_chars}
+
+        try:
+            chunks.save(BOOKS_CACHE_DIR, chunks.meta)
+            # Перечитываем корпус через mmap, чтобы не держать его копию в памяти процесса
+            return ChunkStore.open(BOOKS_CACHE_DIR, signature) or chunks
+        except OSError as e:
+            logger.error(f"Ошибка записи корпуса книг: {e}")
+            return chunks
+
+    def build_index(self):
+        """Построение инвертированного индекса по фрагментам книг (или загрузка готового)"""
+        started = time.time()
+        index = InvertedIndex.open(BOOKS_CACHE_DIR, self.corpus_signature)
+        if index is None:
+            index = InvertedIndex()
+            for chunk_id in range(len(self.chunks)):
+                index.add(self.chunks.chunk_text(chunk_id))
+            try:
+                index.save(BOOKS_CACHE_DIR, self.corpus_signature)
+            except OSError as e:
+                logger.error(f"Ошибка записи индекса книг: {e}")
+        self.index = index
+        print(f"🗂 Индекс готов: {len(self.chunks)} фрагментов, {len(index.postings)} слов ({time.time() - started:.2f} сек)")
+
+    def build_vectors(self):
+        """Загрузка или построение семантического индекса фрагментов"""
+        if not SEMANTIC_SEARCH or not len(self.chunks):
+            return
+        if not vector_index.is_available():
+            print("⚠️ numpy не установлен - семантический поиск по книгам отключен")
+            return
+        try:
+            self.vectors = vector_index.VectorIndex.load_or_build(BOOKS_CACHE_DIR, self.corpus_signature, self.index)
+        except Exception as e:
+            logger.error(f"Ошибка построения семантического индекса: {e}")
+            self.vectors = None
+
+    def extract_books(self, books_dir, filenames):
+        """Параллельное извлечение текста книг: по книгам и по диапазонам страниц PDF"""
+        if self.workers <= 1:
+            texts = {}
+            for filename in filenames:
+                try:
+                    texts[filename] = self.extract_text(os.path.join(books_dir, filename))
+                except Exception as e:
+                    print(f"❌ Ошибка загрузки {filename}: {e}")
+                    texts[filename] = ""
+            return texts
+
+        texts = {}
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            book_futures = {}
+            page_futures = {}
+            for filename in filenames:
+                file_path = os.path.join(books_dir, filename)
+                page_count = _pdf_page_count(file_path) if filename.lower().endswith('.pdf') else None
+
+                if page_count and page_count > PDF_PAGES_PER_TASK:
+                    page_futures[filename] = [
+                        pool.submit(_extract_pdf_pages, file_path, start, min(start + PDF_PAGES_PER_TASK, page_count))
+                        for start in range(0, page_count, PDF_PAGES_PER_TASK)
+                    ]
                 else:
-                    print(f"❌ Не удалось прочитать: {filename}")
-                    
-            except Exception as e:
-                print(f"❌ Ошибка загрузки {filename}: {e}")
+                    book_futures[filename] = pool.submit(_extract_book, file_path)
+
+            for filename, futures in page_futures.items():
+                try:
+                    pages = [page for future in futures for page in future.result()]
+                    texts[filename] = "".join(page + "\n" for page in pages if page)
+                except Exception as e:
+                    # Диапазон не прочитался - повторяем книгу целиком с запасным методом
+                    print(f"Ошибка чтения страниц PDF {filename}: {e}")
+                    book_futures[filename] = pool.submit(_extract_book, os.path.join(books_dir, filename))
+
+            for filename, future in book_futures.items():
+                try:
+                    texts[filename] = future.result()
+                except Exception as e:
+                    print(f"❌ Ошибка загрузки {filename}: {e}")
+                    texts[filename] = ""
+
+        return texts
+
+    @staticmethod
+    def extract_text(file_path):
+        """Извлечение текста из файла книги"""
+        if file_path.lower().endswith('.pdf'):
+            return PsychologyKnowledgeBase.read_pdf(file_path)
+        elif file_path.lower().endswith('.docx'):
+            return PsychologyKnowledgeBase.read_docx(file_path)
+        else:  # txt
+            with open(file_path, 'r', encoding='utf-8') as f:
+                return f.read()
     
-    def read_pdf(self, file_path):
+    @staticmethod
+    def read_pdf(file_path):
         """Чтение PDF файлов с обработкой ошибок"""
         text = ""
         try:
@@ -82,7 +284,8 @@ class PsychologyKnowledgeBase:
         
         return text
     
-    def read_docx(self, file_path):
+    @staticmethod
+    def read_docx(file_path):
         """Чтение DOCX файлов"""
         text = ""
         try:
@@ -97,35 +300,35 @@ class PsychologyKnowledgeBase:
     
     def search_in_books(self, query, max_results=3):
         """Поиск релевантной информации в книгах"""
+        self.ensure_loaded()
         if not self.knowledge_base:
             return "📚 Библиотека пуста. Добавьте книги в папку 'books'."
         
         query_lower = query.lower()
+        query_words = set(tokenize(query))
         relevant_results = []
+        found_books = set()
         
-        for book_name, book_data in self.knowledge_base.items():
-            content = book_data['content']
-            content_lower = content.lower()
+        # Кандидаты - фрагменты, содержащие все слова запроса; фразу проверяем только в них
+        matches = self.index.search(query)
+        for chunk_id in sorted(matches):
+            if len(matches[chunk_id]) < len(query_words):
+                continue
             
-            # Ищем вхождения запроса
-            if query_lower in content_lower:
-                # Находим позицию первого вхождения
-                index = content_lower.find(query_lower)
-
-                # Берем контекст вокруг найденного фрагмента
-                start = max(0, index - 150)
-                end = min(len(content), index + 350)
-                
-                excerpt = content[start:end]
-                
-                # Очищаем и форматируем текст
-                excerpt = self.clean_text(excerpt)
-                
-                relevant_results.append({
-                    'book': book_name,
-                    'excerpt': excerpt,
-                    'position': index
-                })
+            book_name = self.chunks.book_of(chunk_id)
+            if book_name in found_books:
+                continue
+            
+            excerpt = self.chunks.chunk_text(chunk_id)
+            if query_lower not in excerpt.lower():
+                continue
+            
+            found_books.add(book_name)
+            relevant_results.append({
+                'book': book_name,
+                'excerpt': excerpt,
+                'position': self.chunks.source_offset[chunk_id]
+            })
             
             if len(relevant_results) >= max_results:
                 break
@@ -143,14 +346,11 @@ class PsychologyKnowledgeBase:
     
     def clean_text(self, text):
         """Очистка текста от лишних пробелов и переносов"""
-        # Заменяем множественные переносы и пробелы
-        import re
-        text = re.sub(r'\n+', '\n', text)
-        text = re.sub(r' +', ' ', text)
-        return text.strip()
+        return clean_text(text)
     
     def get_library_info(self):
         """Информация о библиотеке"""
+        self.ensure_loaded()
         if not self.knowledge_base:
             return "📚 Библиотека пуста"
         
@@ -165,51 +365,43 @@ class PsychologyKnowledgeBase:
         
         return f"📚 Библиотека: {total_books} книг ({type_info})"
     
-    def get_context_for_ai(self, query, max_excerpts=18):
+    def get_context_for_ai(self, query, max_excerpts=CONTEXT_MAX_EXCERPTS):
         """Получение релевантного контекста из книг для AI"""
+        return format_context(self.get_excerpts_for_ai(query, max_excerpts))
+
+    def get_excerpts_for_ai(self, query, max_excerpts=CONTEXT_MAX_EXCERPTS):
+        """Отрывки для AI: кортеж (книга, текст) по убыванию релевантности"""
+        self.ensure_loaded()
         if not self.knowledge_base:
-            return ""
+            return ()
         
-        query_lower = query.lower()
-        query_words = [word for word in query_lower.split() if len(word) > 3]  # Фильтруем короткие слова
-        relevant_excerpts = []
+        cache_key = QueryCache.make_key(query, max_excerpts)
+        cached = self.context_cache.get(cache_key, self.corpus_signature)
+        if cached is not None:
+            return cached
         
-        for book_name, book_data in self.knowledge_base.items():
-            content = book_data['content']
-            content_lower = content.lower()
-            
-            # Считаем релевантность по ключевым словам
-            relevance_score = sum(1 for word in query_words if word in content_lower)
-            
-            if relevance_score > 0:
-                # Находим наиболее релевантный отрывок
-                paragraphs = content.split('\n\n')  # Разделяем на параграфы
-                
-                for paragraph in paragraphs:
-                    if any(word in paragraph.lower() for word in query_words):
-                        # Ограничиваем длину отрывка
-                        if len(paragraph) > 500:
-                            paragraph = paragraph[:500] + "..."
-                        
-                        relevant_excerpts.append({
-                            'book': book_name,
-                            'text': paragraph.strip(),
-                            'score': relevance_score
-                        })
-                        break  # Берем только один отрывок из каждой книги
-            
-            if len(relevant_excerpts) >= max_excerpts:
-                break
-        
-        # Сортируем по релевантности
-        relevant_excerpts.sort(key=lambda x: x['score'], reverse=True)
+        excerpts = self._find_excerpts(query, max_excerpts)
+        self.context_cache.put(cache_key, self.corpus_signature, excerpts)
+        return excerpts
+
+    def _find_excerpts(self, query, max_excerpts):
+        """Поиск отрывков для AI"""
+        # Лучшие фрагменты по BM25, отобранные кучей из индекса
+        ranked = self.index.rank(query, max_excerpts)
         
-        # Форматируем для AI
-        if relevant_excerpts:
-            context_text = "РЕЛЕВАНТНАЯ ИНФОРМАЦИЯ ИЗ ПСИХОЛОГИЧЕСКОЙ ЛИТЕРАТУРЫ:\n\n"
-            for excerpt in relevant_excerpts:
-                context_text += f"📖 Из книги '{excerpt['book']}':\n{excerpt['text']}\n\n"
-            
-            return context_text.strip()
+        # Если ключевых слов не хватило (перефразированный вопрос) - добираем по смыслу
+        if len(ranked) < max_excerpts and self.vectors is not None:
+            found = {chunk_id for _, chunk_id in ranked}
+            for score, chunk_id in self.vectors.search(query, max_excerpts):
+                if chunk_id not in found and len(ranked) < max_excerpts:
+                    ranked.append((score, chunk_id))
         
-        return ""
\ No newline at end of file
+        return tuple(
+            (self.chunks.book_of(chunk_id), self.chunks.chunk_text(chunk_id))
+            for score, chunk_id in ranked
+        )
+
+    def get_cache_stats(self):
+        """Статистика кэша контекста"""
+        stats = self.context_cache.stats()
+        return f"🧠 Кэш контекста: {stats['hits']} попаданий, {stats['misses']} промахов ({stats['hit_rate']:.0%}), записей: {stats['size']}"
@@ -0,0 +1,160 @@
+import os
+import time
+import asyncio
+import threading
+import concurrent.futures
+from collections import deque
+from contextlib import asynccontextmanager
+
+# Максимум одновременных запросов к DeepSeek (лимиты API и стоимость)
+LLM_MAX_CONCURRENT = int(os.getenv('LLM_MAX_CONCURRENT', 32))
+# Сколько премиум-запросов пропускается на один бесплатный, когда ждут оба тарифа
+LLM_PREMIUM_WEIGHT = int(os.getenv('LLM_PREMIUM_WEIGHT', 4))
+
+TIER_PREMIUM = 'premium'
+TIER_FREE = 'free'
+TIERS = (TIER_PREMIUM, TIER_FREE)
+
+
+def tier_for(sub_type):
+    """Очередь для типа подписки: premium и premium_annual - премиум, остальное - бесплатная"""
+    return TIER_PREMIUM if sub_type and sub_type.startswith('premium') else TIER_FREE
+
+
+class LLMTicket:
+    __slots__ = ('tier', 'wake', 'created')
+
+    def __init__(self, tier, wake):
+        self.tier = tier
+        self.wake = wake
+        self.created = time.monotonic()
+
+
+class LLMScheduler:
+    """Ограничение одновременных запросов к DeepSeek с приоритетом премиум-тарифа.
+
+    Пока есть свободные места, запрос проходит сразу. Иначе он ждет в очереди
+    своего тарифа, а освободившееся место получает следующий по взвешенной
+    очереди: weight премиум-запросов на один бесплатный, поэтому всплеск
+    бесплатного трафика не увеличивает ожидание премиум-пользователей, а
+    бесплатные все равно не ждут бесконечно. Для потоков submit запускает
+    функцию в собственном пуле планировщика, когда освободится место, -
+    ожидающий запрос не занимает поток; в event loop - slot_async.
+    """
+
+    def __init__(self, max_concurrent=LLM_MAX_CONCURRENT, weight=LLM_PREMIUM_WEIGHT):
+        self.max_concurrent = max(1, max_concurrent)
+        self.weight = max(1, weight)
+        self.active = 0
+        self.completed = {tier: 0 for tier in TIERS}
+        self._queues = {tier: deque() for tier in TIERS}
+        self._waits = {tier: deque(maxlen=1000) for tier in TIERS}
+        self._premium_streak = 0
+        self._lock = threading.Lock()
+        # Потоков ровно столько, сколько мест: выданное место сразу получает поток
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.max_concurrent, thread_name_prefix="llm")
+
+    def _grant(self, ticket):
+        self.active += 1
+        self._waits[ticket.tier].append(time.monotonic() - ticket.created)
+
+    def _next_ticket(self):
+        premium, free = self._queues[TIER_PREMIUM], self._queues[TIER_FREE]
+        if premium and (not free or self._premium_streak < self.weight):
+            self._premium_streak += 1
+            return premium.popleft()
+        if free:
+            self._premium_streak = 0
+            return free.popleft()
+        return None
+
+    def _acquire(self, tier, wake):
+        """Место сразу (True) или ожидание в очереди (False, позже будет вызван wake)"""
+        with self._lock:
+            ticket = LLMTicket(tier, wake)
+            if self.active < self.max_concurrent and not self._queues[TIER_PREMIUM] and not self._queues[TIER_FREE]:
+                self._grant(ticket)
+                return True, ticket
+            self._queues[tier].append(ticket)
+            return False, ticket
+
+    def _cancel(self, ticket):
+        """Отказ от ожидания; False, если место уже выдано"""
+        with self._lock:
+            try:
+                self._queues[ticket.tier].remove(ticket)
+                return True
+            except ValueError:
+                return False
+
+    def release(self, tier):
+        with self._lock:
+            self.active -= 1
+            self.completed[tier] += 1
+            ticket = self._next_ticket()
+            if ticket is not None:
+                self._grant(ticket)
+        if ticket is not None:
+            ticket.wake()
+
+    def submit(self, sub_type, func, *args):
+        """Вызов func(*args) в потоке планировщика, когда освободится место; возвращает Future"""
+        tier = tier_for(sub_type)
+        future = concurrent.futures.Future()
+
+        def run():
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        result = func(*args)
+                    except BaseException as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(result)
+            finally:
+                self.release(tier)
+
+        def start():
+            self._executor.submit(run)
+
+        granted, ticket = self._acquire(tier, start)
+        if granted:
+            start()
+        return future
+
+    @asynccontextmanager
+    async def slot_async(self, sub_type):
+        """Место для запроса к DeepSeek из event loop"""
+        tier = tier_for(sub_type)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        granted, ticket = self._acquire(tier, wake)
+        if not granted:
+            try:
+                await future
+            except asyncio.CancelledError:
+                if not self._cancel(ticket):
+                    # Место уже выдано - возвращаем его следующему
+                    self.release(tier)
+                raise
+        try:
+            yield
+        finally:
+            self.release(tier)
+
+    def stats(self):
+        with self._lock:
+            result = {'active': self.active, 'max_concurrent': self.max_concurrent}
+            for tier in TIERS:
+                waits = sorted(self._waits[tier])
+                result[tier] = {
+                    'queued': len(self._queues[tier]),
+                    'completed': self.completed[tier],
+                    'wait_avg': sum(waits) / len(waits) if waits else 0.0,
+                    'wait_p99': waits[int(len(waits) * 0.99)] if waits else 0.0
+                }
+            return result
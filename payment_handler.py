@@ -5,6 +5,7 @@ from datetime import datetime, timedelta
 from yookassa import Configuration, Payment
 from yookassa.domain.notification import WebhookNotification
 import uuid
+import http_client
 
 logger = logging.getLogger(__name__)
 
@@ -438,8 +439,7 @@ class PaymentHandler:
             
             # Проверяем доступность вебхук-сервера
             try:
-                import requests
-                response = requests.get("https://yookassa-webhook-gstx.onrender.com/health", timeout=10)
+                response = http_client.get("https://yookassa-webhook-gstx.onrender.com/health", timeout=10)
                 print(f"🌐 Проверка сервера: код {response.status_code}")
                 if response.status_code != 200:
                     print("❌ Вебхук-сервер недоступен")
@@ -0,0 +1,157 @@
+import os
+import re
+import math
+import threading
+
+# Сколько токенов можно потратить на промпт DeepSeek (без учета ответа)
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 3000))
+# Доля свободного бюджета, которую история диалога получает раньше отрывков из книг
+PROMPT_HISTORY_SHARE = float(os.getenv('PROMPT_HISTORY_SHARE', 0.4))
+# Отрывок обрезается, только если в него влезает хотя бы столько токенов
+PROMPT_MIN_EXCERPT_TOKENS = int(os.getenv('PROMPT_MIN_EXCERPT_TOKENS', 60))
+
+# Служебные токены на каждое сообщение в запросе (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+CONTEXT_HEADER = "РЕЛЕВАНТНАЯ ИНФОРМАЦИЯ ИЗ ПСИХОЛОГИЧЕСКОЙ ЛИТЕРАТУРЫ:"
+
+TOKEN_PIECE_RE = re.compile(r'[a-zA-Z]+|[а-яА-ЯёЁ]+|\d+|\S')
+
+
+def estimate_tokens(text):
+    """Оценка числа токенов без токенизатора DeepSeek.
+
+    BPE режет латиницу примерно по 4 символа, кириллицу - по 3, числа - по 3;
+    знаки препинания и эмодзи считаются отдельными токенами. Погрешность
+    порядка 10-15%, для бюджета этого достаточно.
+    """
+    if not text:
+        return 0
+    tokens = 0
+    for piece in TOKEN_PIECE_RE.findall(text):
+        first = piece[0]
+        if 'a' <= first.lower() <= 'z':
+            tokens += math.ceil(len(piece) / 4)
+        elif first.isalpha() or first.isdigit():
+            tokens += math.ceil(len(piece) / 3)
+        else:
+            tokens += 1
+    return tokens
+
+
+def format_excerpt(book, text):
+    return f"📖 Из книги '{book}':\n{text}"
+
+
+def format_context(excerpts):
+    """Контекст из книг для AI: excerpts - список (книга, текст) по убыванию релевантности"""
+    if not excerpts:
+        return ""
+    return "\n\n".join([CONTEXT_HEADER] + [format_excerpt(book, text) for book, text in excerpts])
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Начало текста, укладывающееся в max_tokens, с обрезкой по границе слова"""
+    words = text.split(' ')
+    low, high = 0, len(words)
+    # Бинарный поиск по числу слов: оценка токенов монотонна по длине
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(' '.join(words[:middle])) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return ' '.join(words[:low]).rstrip(' ,;:') + '...' if low else ""
+
+
+class PromptBudget:
+    """Сборка промпта DeepSeek в пределах бюджета токенов.
+
+    Системный промпт и вопрос пользователя входят всегда. Из оставшегося
+    бюджета история диалога сначала получает свою долю (новые сообщения
+    важнее старых), затем отрывки из книг по убыванию релевантности, а остаток
+    снова достается истории. Не поместившиеся отрывки отбрасываются, последний
+    подходящий может быть обрезан.
+    """
+
+    def __init__(self, budget=PROMPT_TOKEN_BUDGET, history_share=PROMPT_HISTORY_SHARE):
+        self.budget = budget
+        self.history_share = history_share
+        self.prompts = 0
+        self.trimmed = 0
+        self.totals = {'fixed': 0, 'books': 0, 'history': 0}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _message_tokens(text):
+        return estimate_tokens(text) + MESSAGE_OVERHEAD_TOKENS
+
+    def _take_history(self, chat_history, start, limit):
+        """Сколько последних сообщений (после уже взятых start) влезает в limit токенов"""
+        taken, used = start, 0
+        for role, content in reversed(chat_history[:len(chat_history) - start]):
+            tokens = self._message_tokens(content)
+            if used + tokens > limit:
+                break
+            taken += 1
+            used += tokens
+        return taken, used
+
+    def fit(self, fixed_texts, excerpts, chat_history):
+        """Отрывки и история, укладывающиеся в бюджет вместе с fixed_texts (промпт, вопрос)"""
+        chat_history = list(chat_history or [])
+        excerpts = list(excerpts or [])
+        fixed = sum(self._message_tokens(text) for text in fixed_texts)
+        free = max(0, self.budget - fixed)
+
+        # История: сначала гарантированная доля
+        history_count, history_tokens = self._take_history(chat_history, 0, int(free * self.history_share))
+
+        # Отрывки по релевантности в оставшееся место
+        books_limit = free - history_tokens - estimate_tokens(CONTEXT_HEADER)
+        kept, books_tokens, truncated = [], 0, False
+        for book, text in excerpts:
+            tokens = estimate_tokens(format_excerpt(book, text)) + 1
+            if books_tokens + tokens <= books_limit:
+                kept.append((book, text))
+                books_tokens += tokens
+                continue
+            room = books_limit - books_tokens - estimate_tokens(format_excerpt(book, "")) - 1
+            if room >= PROMPT_MIN_EXCERPT_TOKENS:
+                text = truncate_to_tokens(text, room)
+                kept.append((book, text))
+                books_tokens += estimate_tokens(format_excerpt(book, text)) + 1
+                truncated = True
+            break
+        if kept:
+            books_tokens += estimate_tokens(CONTEXT_HEADER)
+
+        # Остаток - более старой истории
+        more, more_tokens = self._take_history(chat_history, history_count, free - history_tokens - books_tokens)
+        history_count, history_tokens = more, history_tokens + more_tokens
+        history = chat_history[len(chat_history) - history_count:]
+
+        trimmed = truncated or len(kept) < len(excerpts) or history_count < len(chat_history)
+        with self._lock:
+            self.prompts += 1
+            self.trimmed += bool(trimmed)
+            self.totals['fixed'] += fixed
+            self.totals['books'] += books_tokens
+            self.totals['history'] += history_tokens
+
+        print(f"🔵 DEBUG: Токены промпта: промпт и вопрос {fixed}, книги {books_tokens} "
+              f"({len(kept)}/{len(excerpts)} отрывков), история {history_tokens} "
+              f"({history_count}/{len(chat_history)} сообщений), всего {fixed + books_tokens + history_tokens}/{self.budget}")
+        return kept, history
+
+    def stats(self):
+        with self._lock:
+            prompts = self.prompts or 1
+            return {
+                'prompts': self.prompts,
+                'trimmed': self.trimmed,
+                'budget': self.budget,
+                'fixed_avg': self.totals['fixed'] / prompts,
+                'books_avg': self.totals['books'] / prompts,
+                'history_avg': self.totals['history'] / prompts
+            }
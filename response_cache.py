@@ -0,0 +1,162 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from db_pool import get_pool, DB_PATH
+from database import apply_migrations
+
+logger = logging.getLogger(__name__)
+
+# Кэш ответов DeepSeek (0 - выключен)
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', '1') == '1'
+# Ответы кэшируются, только если в истории диалога не больше стольких сообщений
+RESPONSE_CACHE_MAX_HISTORY = int(os.getenv('RESPONSE_CACHE_MAX_HISTORY', 0))
+# Время жизни ответа в кэше (секунды)
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 7 * 24 * 3600))
+# Записей в памяти и в таблице SQLite
+RESPONSE_CACHE_MEMORY_SIZE = int(os.getenv('RESPONSE_CACHE_MEMORY_SIZE', 1000))
+RESPONSE_CACHE_MAX_ROWS = int(os.getenv('RESPONSE_CACHE_MAX_ROWS', 20000))
+
+WORD_RE = re.compile(r'\w+')
+
+
+def normalize_question(text):
+    """Вопрос без регистра, знаков препинания и лишних пробелов: "Мне тревожно!" == "мне  тревожно" """
+    return " ".join(WORD_RE.findall(text.lower().replace('ё', 'е')))
+
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+
+class ResponseCache:
+    """Кэш готовых ответов DeepSeek на одинаковые запросы.
+
+    Ключ - хэш нормализованных системного промпта, контекста из книг, истории
+    и вопроса пользователя. Горячие записи лежат в LRU в памяти, все - в таблице
+    response_cache, поэтому кэш переживает перезапуск бота. Устаревшие записи
+    (старше ttl) не отдаются, а таблица ограничена max_rows последними ответами.
+    """
+
+    def __init__(self, db_path=DB_PATH, ttl=RESPONSE_CACHE_TTL,
+                 memory_size=RESPONSE_CACHE_MEMORY_SIZE, max_rows=RESPONSE_CACHE_MAX_ROWS):
+        self.ttl = ttl
+        self.memory_size = memory_size
+        self.max_rows = max_rows
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._writes = 0
+        self._lock = threading.Lock()
+        self.pool = get_pool(db_path)
+        # Таблица response_cache создается миграцией схемы
+        apply_migrations(self.conn)
+
+    @property
+    def conn(self):
+        return self.pool.connection()
+
+    @staticmethod
+    def make_key(model, system_prompt, book_context, chat_history, user_message):
+        """Ключ кэша; None, если история слишком длинная для кэширования"""
+        if not RESPONSE_CACHE_ENABLED or len(chat_history or []) > RESPONSE_CACHE_MAX_HISTORY:
+            return None
+        payload = json.dumps([
+            model,
+            normalize_text(system_prompt),
+            normalize_text(book_context or ""),
+            [[role, normalize_text(content)] for role, content in chat_history or []],
+            normalize_question(user_message)
+        ], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _remember(self, key, created_at, response):
+        self._entries[key] = (created_at, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.memory_size:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        """Ответ из кэша или None"""
+        if key is None:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        # Чтение из базы - без блокировки: у каждого потока свое соединение
+        try:
+            row = self.conn.execute(
+                "SELECT response, created_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка чтения кэша ответов: {e}")
+            row = None
+
+        with self._lock:
+            if row is not None and now - row[1] < self.ttl:
+                self._remember(key, row[1], row[0])
+                self.hits += 1
+                self.disk_hits += 1
+                return row[0]
+
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def put(self, key, response):
+        if key is None or not response:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, response)
+            self._writes += 1
+            prune = self._writes % 100 == 0
+
+        conn = self.conn
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, response, created_at) VALUES (?, ?, ?)",
+                (key, response, now)
+            )
+            if prune:
+                self._prune(conn, now)
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка записи кэша ответов: {e}")
+
+    def _prune(self, conn, now):
+        """Удаление устаревших записей и всего, что не входит в max_rows последних"""
+        conn.execute("DELETE FROM response_cache WHERE created_at < ?", (now - self.ttl,))
+        conn.execute(
+            "DELETE FROM response_cache WHERE key IN "
+            "(SELECT key FROM response_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_rows,)
+        )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.conn.execute("DELETE FROM response_cache")
+            self.conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'hit_rate': self.hits / total if total else 0.0
+        }
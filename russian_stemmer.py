@@ -0,0 +1,136 @@
+from functools import lru_cache
+
+# Стеммер Портера для русского языка (алгоритм Snowball)
+VOWELS = "аеиоуыэюя"
+
+PERFECTIVE_GERUND_1 = ("вшись", "вши", "в")
+PERFECTIVE_GERUND_2 = ("ившись", "ывшись", "ивши", "ывши", "ив", "ыв")
+
+ADJECTIVE = (
+    "ими", "ыми", "его", "ого", "ему", "ому",
+    "ее", "ие", "ые", "ое", "ей", "ий", "ый", "ой", "ем", "им", "ым", "ом",
+    "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею"
+)
+
+PARTICIPLE_1 = ("ем", "нн", "вш", "ющ", "щ")
+PARTICIPLE_2 = ("ивш", "ывш", "ующ")
+
+REFLEXIVE = ("ся", "сь")
+
+VERB_1 = ("ешь", "нно", "ете", "йте", "ла", "на", "ли", "ем", "ло", "но", "ет", "ют", "ны", "ть", "й", "л", "н")
+VERB_2 = (
+    "ейте", "уйте", "ила", "ыла", "ена", "ите", "или", "ыли", "ило", "ыло", "ено",
+    "ует", "уют", "ены", "ить", "ыть", "ишь", "ей", "уй", "ил", "ыл", "им", "ым",
+    "ен", "ят", "ит", "ыт", "ую", "ю"
+)
+
+NOUN = (
+    "иями", "ями", "ами", "ией", "иям", "ием", "иях",
+    "ев", "ов", "ие", "ье", "еи", "ии", "ей", "ой", "ий", "ям", "ем", "ам", "ом",
+    "ах", "ях", "ию", "ью", "ия", "ья",
+    "а", "е", "и", "й", "о", "у", "ы", "ь", "ю", "я"
+)
+
+SUPERLATIVE = ("ейше", "ейш")
+DERIVATIONAL = ("ость", "ост")
+
+
+def _by_length(*groups):
+    """Окончания по убыванию длины с флагом "должно идти после а/я\""""
+    endings = []
+    for group, after_a in groups:
+        endings.extend((ending, after_a) for ending in group)
+    return sorted(endings, key=lambda item: len(item[0]), reverse=True)
+
+
+_PERFECTIVE_GERUND = _by_length((PERFECTIVE_GERUND_1, True), (PERFECTIVE_GERUND_2, False))
+_ADJECTIVE = _by_length((ADJECTIVE, False))
+_PARTICIPLE = _by_length((PARTICIPLE_1, True), (PARTICIPLE_2, False))
+_REFLEXIVE = _by_length((REFLEXIVE, False))
+_VERB = _by_length((VERB_1, True), (VERB_2, False))
+_NOUN = _by_length((NOUN, False))
+_SUPERLATIVE = _by_length((SUPERLATIVE, False))
+_DERIVATIONAL = _by_length((DERIVATIONAL, False))
+
+
+def _strip(region, endings):
+    """Удаление самого длинного подходящего окончания; None, если окончания нет"""
+    for ending, after_a in endings:
+        if region.endswith(ending):
+            rest = region[:-len(ending)]
+            if after_a and not rest.endswith(("а", "я")):
+                continue
+            return rest
+    return None
+
+
+def _regions(word):
+    """Начала областей RV и R2 (см. описание алгоритма Snowball)"""
+    rv = len(word)
+    for i, char in enumerate(word):
+        if char in VOWELS:
+            rv = i + 1
+            break
+
+    def next_region(start):
+        for i in range(start + 1, len(word)):
+            if word[i] not in VOWELS and word[i - 1] in VOWELS:
+                return i + 1
+        return len(word)
+
+    r1 = next_region(0)
+    r2 = next_region(r1)
+    return rv, r2
+
+
+@lru_cache(maxsize=200000)
+def stem(word):
+    """Основа русского слова; результат кэшируется для каждого уникального слова"""
+    word = word.lower().replace("ё", "е")
+    rv_start, r2_start = _regions(word)
+    prefix, rv = word[:rv_start], word[rv_start:]
+
+    # Шаг 1
+    stripped = _strip(rv, _PERFECTIVE_GERUND)
+    if stripped is not None:
+        rv = stripped
+    else:
+        stripped = _strip(rv, _REFLEXIVE)
+        if stripped is not None:
+            rv = stripped
+
+        stripped = _strip(rv, _ADJECTIVE)
+        if stripped is not None:
+            rv = stripped
+            participle = _strip(rv, _PARTICIPLE)
+            if participle is not None:
+                rv = participle
+        else:
+            stripped = _strip(rv, _VERB)
+            if stripped is None:
+                stripped = _strip(rv, _NOUN)
+            if stripped is not None:
+                rv = stripped
+
+    # Шаг 2
+    if rv.endswith("и"):
+        rv = rv[:-1]
+
+    # Шаг 3: словообразовательные окончания только в области R2
+    r2 = (prefix + rv)[r2_start:] if r2_start < len(prefix + rv) else ""
+    if _strip(r2, _DERIVATIONAL) is not None:
+        rv = _strip(rv, _DERIVATIONAL)
+
+    # Шаг 4
+    if rv.endswith("нн"):
+        rv = rv[:-1]
+    else:
+        stripped = _strip(rv, _SUPERLATIVE)
+        if stripped is not None:
+            rv = stripped
+            if rv.endswith("нн"):
+                rv = rv[:-1]
+        elif rv.endswith("ь"):
+            rv = rv[:-1]
+
+    return prefix + rv
@@ -0,0 +1,233 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import http_client
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и 1 в секунду на чат
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 30))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))
+# Сколько сообщений подряд можно отправить в чат без паузы
+SEND_CHAT_BURST = float(os.getenv('SEND_CHAT_BURST', 3))
+# Параллельных запросов к Telegram
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', 8))
+# Повторов после ответа 429 Too Many Requests
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', 3))
+
+# Очереди: ответы пользователям всегда уходят раньше массовых рассылок
+PRIORITY_REPLY = 0
+PRIORITY_BULK = 1
+
+
+class TokenBucket:
+    """Ограничение частоты: rate токенов в секунду, не больше burst про запас"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Через сколько секунд появится токен"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class SendRequest:
+    __slots__ = ('method', 'data', 'chat_id', 'priority', 'future', 'attempts', 'created')
+
+    def __init__(self, method, data, chat_id, priority):
+        self.method = method
+        self.data = data
+        self.chat_id = chat_id
+        self.priority = priority
+        self.future = Future()
+        self.attempts = 0
+        self.created = time.monotonic()
+
+
+class SendQueue:
+    """Очередь исходящих запросов к Telegram с учетом лимитов.
+
+    Отдельный поток выбирает следующий запрос: сначала из очереди ответов,
+    потом из очереди рассылок; внутри очереди чаты обслуживаются по кругу.
+    Запрос уходит, когда есть токены и в общем, и в чатовом ведре. В один чат
+    одновременно идет не больше одного запроса, поэтому сообщения чата
+    приходят по порядку. На 429 чат ставится на паузу retry_after и запрос
+    повторяется. Результат - Future с ответом Telegram (requests.Response).
+    """
+
+    def __init__(self, base_url, timeout=15, global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE,
+                 chat_burst=SEND_CHAT_BURST, workers=SEND_WORKERS):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._lanes = (OrderedDict(), OrderedDict())
+        self._pending = 0
+        self._busy = set()
+        self._paused = {}
+        self._waits = (deque(maxlen=1000), deque(maxlen=1000))
+        self._running = True
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max(1, workers), thread_name_prefix="telegram-send")
+        self._thread = threading.Thread(target=self._schedule, name="telegram-send-queue", daemon=True)
+        self._thread.start()
+
+    def submit(self, method, data, chat_id=None, priority=PRIORITY_REPLY):
+        """Постановка запроса в очередь; возвращает Future с ответом Telegram"""
+        request = SendRequest(method, data, chat_id, priority)
+        with self._cond:
+            if not self._running:
+                request.future.set_exception(RuntimeError("Очередь отправки остановлена"))
+                return request.future
+            lane = self._lanes[priority]
+            lane.setdefault(chat_id, deque()).append(request)
+            self._pending += 1
+            self._cond.notify()
+        return request.future
+
+    def call(self, method, data, chat_id=None, priority=PRIORITY_REPLY, timeout=120):
+        """Отправка с ожиданием результата"""
+        return self.submit(method, data, chat_id, priority).result(timeout)
+
+    def _bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._forget_idle_chats()
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _forget_idle_chats(self):
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items() if bucket.is_full(now)]:
+            if chat_id not in self._busy:
+                del self._chat_buckets[chat_id]
+        for chat_id in [chat_id for chat_id, until in self._paused.items() if until <= now]:
+            del self._paused[chat_id]
+
+    def _pick(self, now):
+        """Следующий запрос, который можно отправить сейчас, или время ожидания"""
+        if not self._pending:
+            return None, None
+        global_wait = self._global.wait_time(now)
+        if global_wait > 0:
+            return None, global_wait
+
+        best_wait = None
+        for lane in self._lanes:
+            for chat_id, queue in lane.items():
+                if chat_id in self._busy:
+                    continue
+                wait = max(self._paused.get(chat_id, 0) - now, self._bucket(chat_id).wait_time(now))
+                if wait > 0:
+                    best_wait = wait if best_wait is None else min(best_wait, wait)
+                    continue
+
+                request = queue.popleft()
+                if queue:
+                    lane.move_to_end(chat_id)
+                else:
+                    del lane[chat_id]
+                self._pending -= 1
+                self._bucket(chat_id).take(now)
+                self._global.take(now)
+                return request, 0
+        return None, best_wait
+
+    def _schedule(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._running and not self._pending:
+                        return
+                    request, wait = self._pick(time.monotonic())
+                    if request is not None:
+                        break
+                    self._cond.wait(wait)
+                self._busy.add(request.chat_id)
+                if request.attempts == 0:
+                    self._waits[request.priority].append(time.monotonic() - request.created)
+            self._executor.submit(self._perform, request)
+
+    def _perform(self, request):
+        request.attempts += 1
+        try:
+            response = http_client.post(f"{self.base_url}/{request.method}", json=request.data, timeout=self.timeout)
+        except Exception as e:
+            self._done(request, sent=False)
+            request.future.set_exception(e)
+            return
+
+        if response.status_code == 429 and request.attempts <= SEND_MAX_RETRIES:
+            # Telegram просит подождать: чат на паузу, запрос обратно в начало его очереди
+            delay = http_client.retry_after(response) or 1.0
+            logger.warning(f"Telegram 429 для чата {request.chat_id}: повтор через {delay:.0f} сек")
+            with self._cond:
+                self._paused[request.chat_id] = time.monotonic() + delay
+                lane = self._lanes[request.priority]
+                if request.chat_id in lane:
+                    lane[request.chat_id].appendleft(request)
+                else:
+                    lane[request.chat_id] = deque([request])
+                self._pending += 1
+                self.retried += 1
+                self._busy.discard(request.chat_id)
+                self._cond.notify()
+            return
+
+        self._done(request, sent=response.status_code == 200)
+        request.future.set_result(response)
+
+    def _done(self, request, sent):
+        with self._cond:
+            if sent:
+                self.sent += 1
+            else:
+                self.failed += 1
+            self._busy.discard(request.chat_id)
+            self._cond.notify()
+
+    def close(self, timeout=30):
+        """Остановка приема; уже поставленные запросы отправляются"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(timeout)
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        with self._cond:
+            waits = [sorted(lane_waits) for lane_waits in self._waits]
+            return {
+                'pending': self._pending,
+                'sent': self.sent,
+                'retried': self.retried,
+                'failed': self.failed,
+                'reply_wait_p99': waits[PRIORITY_REPLY][int(len(waits[PRIORITY_REPLY]) * 0.99)] if waits[PRIORITY_REPLY] else 0.0,
+                'bulk_wait_p99': waits[PRIORITY_BULK][int(len(waits[PRIORITY_BULK]) * 0.99)] if waits[PRIORITY_BULK] else 0.0
+            }
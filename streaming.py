@@ -0,0 +1,80 @@
+import os
+import json
+import time
+
+# Минимальный интервал между правками одного сообщения (лимиты Telegram на чат)
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.0))
+
+
+def parse_sse_line(line):
+    """Строка SSE-потока DeepSeek: (поток завершен, новый фрагмент текста или None)"""
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', errors='replace')
+    if not line.startswith('data:'):
+        return False, None
+
+    payload = line[5:].strip()
+    if payload == '[DONE]':
+        return True, None
+    try:
+        chunk = json.loads(payload)
+    except ValueError:
+        return False, None
+
+    choices = chunk.get('choices') or []
+    if not choices:
+        return False, None
+    return False, (choices[0].get('delta') or {}).get('content')
+
+
+class StreamingReply:
+    """Ответ DeepSeek, который показывается пользователю по мере генерации.
+
+    Фрагменты из потока копятся в буфере, а наружу отдается только текст,
+    который пора показать: первый фрагмент - сразу, дальше не чаще одной правки
+    в interval секунд. Все фрагменты между правками склеиваются в одну правку.
+    Интервал отсчитывается от каждой попытки, а не только от удачной; после
+    ошибки отправки или правки (бот заблокирован, сообщение удалено)
+    промежуточный показ прекращается, и ответ отправляется один раз в конце.
+    """
+
+    def __init__(self, interval=STREAM_EDIT_INTERVAL):
+        self.interval = interval
+        self.message_id = None
+        self.edits = 0
+        self._parts = []
+        self.failed = False
+        self._shown = ""
+        self._shown_at = None
+
+    @property
+    def text(self):
+        return "".join(self._parts)
+
+    def feed(self, content):
+        """Добавление фрагмента; возвращает текст для показа или None, если правку пора отложить"""
+        if not content:
+            return None
+        self._parts.append(content)
+
+        if self.failed:
+            return None
+        text = self.text
+        if not text.strip() or text == self._shown:
+            return None
+        now = time.monotonic()
+        if self._shown_at is not None and now - self._shown_at < self.interval:
+            return None
+        self._shown_at = now
+        return text
+
+    def shown(self, text, message_id=None):
+        """Отметка, что текст показан (message_id - сообщение, созданное первой отправкой)"""
+        if message_id is not None:
+            self.message_id = message_id
+        self._shown = text
+        self.edits += 1
+
+    def fail(self):
+        """Отметка, что отправка или правка не удалась: дальше текст копится без показа"""
+        self.failed = True
@@ -0,0 +1,113 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+# Сколько пользователей держать в памяти
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv('SUBSCRIPTION_CACHE_SIZE', 10000))
+# Через сколько секунд запись перечитывается из базы: изменения, сделанные
+# другим процессом (вебхук-сервер ЮKassa), станут видны не позже этого срока
+SUBSCRIPTION_CACHE_TTL = float(os.getenv('SUBSCRIPTION_CACHE_TTL', 60))
+
+
+class UserState:
+    """Подписка и счетчик сообщений пользователя за день"""
+    __slots__ = ('sub_type', 'expiry', 'date', 'count', 'loaded_at')
+
+    def __init__(self, sub_type, expiry, date, count):
+        self.sub_type = sub_type
+        self.expiry = expiry
+        self.date = date
+        self.count = count
+        self.loaded_at = time.monotonic()
+
+    def is_expired(self, now):
+        """Премиум, срок которого уже закончился"""
+        return self.sub_type == 'premium' and self.expiry is not None and now > self.expiry
+
+    def effective_type(self, now):
+        return 'free' if self.is_expired(now) else self.sub_type
+
+    def days_left(self, now):
+        if self.effective_type(now) != 'premium' or self.expiry is None:
+            return 0
+        return max(0, (self.expiry - now).days)
+
+
+class SubscriptionCache:
+    """Кэш состояния подписки пользователей со сквозной записью.
+
+    SubscriptionManager обновляет запись сразу после каждого изменения
+    в базе (сообщение посчитано, выдан премиум), а при прочих изменениях
+    сбрасывает ее. Загрузка из базы, начатая до сброса, в кэш не попадает:
+    для этого put сверяет номер поколения, полученный перед чтением.
+    """
+
+    def __init__(self, max_size=SUBSCRIPTION_CACHE_SIZE, ttl=SUBSCRIPTION_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def generation(self):
+        """Номер поколения - брать перед чтением из базы и передавать в put"""
+        with self._lock:
+            return self._generation
+
+    def get(self, user_id, today):
+        """Состояние пользователя на сегодня или None"""
+        with self._lock:
+            state = self._entries.get(user_id)
+            if state is not None and state.date == today and time.monotonic() - state.loaded_at < self.ttl:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return state
+            self.misses += 1
+            return None
+
+    def put(self, user_id, state, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[user_id] = state
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def set_count(self, user_id, date, count):
+        """Новое значение счетчика после записи в базу"""
+        with self._lock:
+            state = self._entries.get(user_id)
+            if state is not None and state.date == date:
+                # Ответы параллельных запросов могут прийти не по порядку
+                state.count = max(state.count, count)
+
+    def set_subscription(self, user_id, sub_type, expiry):
+        """Новая подписка после записи в базу"""
+        with self._lock:
+            self._generation += 1
+            state = self._entries.get(user_id)
+            if state is not None:
+                state.sub_type = sub_type
+                state.expiry = expiry
+
+    def invalidate(self, user_id=None):
+        """Сброс одного пользователя (None - всех)"""
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'hit_rate': self.hits / total if total else 0.0
+        }
@@ -0,0 +1,141 @@
+import os
+import hmac
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+from flask import request, jsonify
+
+import http_client
+
+logger = logging.getLogger(__name__)
+
+# Режим получения обновлений: polling - опрос getUpdates, webhook - Telegram сам присылает обновления
+TELEGRAM_MODE = os.getenv('TELEGRAM_MODE', 'polling')
+# Публичный адрес сервиса (на Render подставляется автоматически)
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL') or os.getenv('RENDER_EXTERNAL_URL', '')
+# Секрет, который Telegram присылает в заголовке X-Telegram-Bot-Api-Secret-Token.
+# Обязателен в режиме webhook и должен совпадать у всех экземпляров бота: каждый
+# setWebhook заменяет секрет, и экземпляры со своим секретом отклоняли бы все обновления
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET', '')
+# Сколько одновременных соединений Telegram может открыть к вебхуку (1-100)
+TELEGRAM_WEBHOOK_CONNECTIONS = int(os.getenv('TELEGRAM_WEBHOOK_CONNECTIONS', 40))
+# Сколько секунд вебхук ждет места в очереди, прежде чем попросить Telegram повторить позже
+TELEGRAM_WEBHOOK_SUBMIT_TIMEOUT = float(os.getenv('TELEGRAM_WEBHOOK_SUBMIT_TIMEOUT', 1))
+
+TELEGRAM_WEBHOOK_PATH = "/webhook/telegram"
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+
+class TelegramWebhook:
+    """Прием обновлений Telegram через вебхук.
+
+    Endpoint проверяет секретный заголовок, отбрасывает повторные доставки
+    и сразу отдает обновление в очередь бота (submit_update), отвечая 200.
+    Если очередь переполнена, отвечает 503 - Telegram повторит доставку позже.
+    """
+
+    def __init__(self, secret=TELEGRAM_WEBHOOK_SECRET):
+        self.secret = secret
+        self.bot = None
+        self.received = 0
+        self.rejected = 0
+        self.duplicates = 0
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+
+    def attach(self, bot):
+        """Бот, которому передаются обновления (None - прием приостановлен)"""
+        self.bot = bot
+
+    def register(self, app):
+        """Добавление endpoint в Flask-приложение"""
+        app.add_url_rule(TELEGRAM_WEBHOOK_PATH, 'telegram_webhook', self.handle_request, methods=['POST'])
+
+    def _is_duplicate(self, update_id):
+        with self._lock:
+            if update_id in self._recent:
+                return True
+            self._recent[update_id] = True
+            while len(self._recent) > 10000:
+                self._recent.popitem(last=False)
+            return False
+
+    def _forget(self, update_id):
+        with self._lock:
+            self._recent.pop(update_id, None)
+
+    def handle_request(self):
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not self.secret or not hmac.compare_digest(token, self.secret):
+            logger.error("❌ Вебхук Telegram: неверный секретный токен")
+            return jsonify({"error": "forbidden"}), 403
+
+        bot = self.bot
+        if bot is None:
+            return jsonify({"error": "bot is not ready"}), 503
+
+        update = request.get_json(silent=True)
+        if not isinstance(update, dict) or 'update_id' not in update:
+            return jsonify({"error": "bad update"}), 400
+
+        update_id = update['update_id']
+        if self._is_duplicate(update_id):
+            self.duplicates += 1
+            return jsonify({"ok": True}), 200
+
+        if not bot.submit_update(update, TELEGRAM_WEBHOOK_SUBMIT_TIMEOUT):
+            # Очередь переполнена: Telegram доставит обновление повторно
+            self._forget(update_id)
+            self.rejected += 1
+            return jsonify({"error": "busy"}), 503
+
+        self.received += 1
+        return jsonify({"ok": True}), 200
+
+    def set_webhook(self, base_url, public_url=TELEGRAM_WEBHOOK_URL):
+        """Регистрация вебхука в Telegram"""
+        if not public_url:
+            print("❌ Не задан TELEGRAM_WEBHOOK_URL - вебхук Telegram не установлен")
+            return False
+        if not self.secret:
+            print("❌ Не задан TELEGRAM_WEBHOOK_SECRET - вебхук Telegram не установлен")
+            return False
+
+        data = {
+            "url": public_url.rstrip('/') + TELEGRAM_WEBHOOK_PATH,
+            "secret_token": self.secret,
+            "max_connections": TELEGRAM_WEBHOOK_CONNECTIONS,
+            "allowed_updates": json.dumps(ALLOWED_UPDATES)
+        }
+        try:
+            response = http_client.post(f"{base_url}/setWebhook", data=data)
+            if response.status_code == 200 and response.json().get("ok"):
+                print(f"✅ Вебхук Telegram установлен: {data['url']}")
+                return True
+            logger.error(f"Ошибка установки вебхука Telegram: {response.text}")
+        except Exception as e:
+            logger.error(f"Ошибка установки вебхука Telegram: {e}")
+        return False
+
+    @staticmethod
+    def delete_webhook(base_url):
+        """Снятие вебхука: без этого getUpdates возвращает 409 Conflict"""
+        try:
+            response = http_client.post(f"{base_url}/deleteWebhook", data={"drop_pending_updates": "false"})
+            return response.status_code == 200
+        except Exception as e:
+            logger.error(f"Ошибка снятия вебхука Telegram: {e}")
+            return False
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+            'duplicates': self.duplicates
+        }
+
+
+# Один экземпляр на процесс: endpoint регистрируется в health server до создания бота
+telegram_webhook = TelegramWebhook()
@@ -0,0 +1,72 @@
+import time
+import threading
+import unittest
+
+from dispatcher import UpdateDispatcher
+from llm_scheduler import LLMScheduler
+
+# Длительность одного "запроса к DeepSeek" в тесте (секунды)
+LLM_CALL = 0.2
+
+
+def make_update(update_id, chat_id, text):
+    return {"update_id": update_id, "message": {"chat": {"id": chat_id}, "text": text}}
+
+
+class PremiumOvertakesFreeBacklogTest(unittest.TestCase):
+    """Когда бесплатные запросы заняли все места у DeepSeek, премиум-ответ
+    и меню не ждут их в очереди диспетчера"""
+
+    def setUp(self):
+        self.scheduler = LLMScheduler(max_concurrent=2, weight=4)
+        self.done = {}
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.dispatcher = UpdateDispatcher(self.handle, workers=4)
+
+    def tearDown(self):
+        self.dispatcher.shutdown()
+
+    def mark(self, name):
+        with self.lock:
+            self.done[name] = time.monotonic() - self.started
+
+    def call_llm(self, name):
+        time.sleep(LLM_CALL)
+        self.mark(name)
+
+    def handle(self, update):
+        text = update["message"]["text"]
+        if text == "/start":
+            self.mark(text)
+            return None
+        # Как answer_message: ответ DeepSeek уходит планировщику, поток свободен
+        return self.scheduler.submit(text.split("-")[0], self.call_llm, text)
+
+    def test_premium_and_menu_are_not_stuck_behind_free_requests(self):
+        for i in range(12):
+            self.dispatcher.submit(make_update(i, 100 + i, f"free-{i}"))
+        time.sleep(0.05)
+        self.dispatcher.submit(make_update(100, 1, "premium-1"))
+        self.dispatcher.submit(make_update(101, 2, "/start"))
+        self.dispatcher.shutdown()
+
+        # Меню обрабатывается сразу, не дожидаясь ни одного ответа DeepSeek
+        self.assertLess(self.done["/start"], LLM_CALL)
+        # Премиум получает первое освободившееся место: готов во второй волне
+        self.assertLess(self.done["premium-1"], 2 * LLM_CALL + 0.1)
+        free_done = sorted(value for name, value in self.done.items() if name.startswith("free"))
+        self.assertEqual(len(free_done), 12)
+        self.assertGreater(sum(1 for value in free_done if value > self.done["premium-1"]), 8)
+
+    def test_chat_order_is_kept_while_reply_is_pending(self):
+        self.dispatcher.submit(make_update(1, 7, "free-a"))
+        self.dispatcher.submit(make_update(2, 7, "/start"))
+        self.dispatcher.shutdown()
+
+        # Следующее обновление чата - только после ответа на предыдущее
+        self.assertGreater(self.done["/start"], self.done["free-a"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import random
+import unittest
+
+import vector_index
+from book_index import InvertedIndex
+from chunk_store import ChunkStore
+from knowledge_base import PsychologyKnowledgeBase
+
+WORDS = (
+    "тревога страх обида мама отец партнер ревность одиночество работа мотивация "
+    "стыд вина злость радость доверие границы отношения детство привязанность терапия"
+).split()
+
+
+def make_knowledge_base(paragraphs=120, seed=0):
+    """База знаний из одной синтетической книги без чтения файлов"""
+    rng = random.Random(seed)
+    text = "\n\n".join(
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 20))) + "."
+        for _ in range(paragraphs)
+    )
+    chunks = ChunkStore()
+    chunks.add_book("Книга.pdf", text)
+    chunks.freeze()
+    index = InvertedIndex()
+    for chunk_id in range(len(chunks)):
+        index.add(chunks.chunk_text(chunk_id))
+
+    kb = PsychologyKnowledgeBase(None, lazy=True)
+    kb.chunks = chunks
+    kb.index = index
+    kb.vectors = vector_index.VectorIndex.build(index, dim=16)
+    return kb
+
+
+@unittest.skipUnless(vector_index.is_available(), "numpy не установлен")
+class SemanticFallbackTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.kb = make_knowledge_base()
+
+    def test_nonsense_query_returns_no_excerpts(self):
+        for query in ("xyzzy", "кукарямба зюзя", "обидамама ревностьстрах"):
+            # Даже без порога близости: слов запроса нет в словаре книг
+            self.assertEqual(self.kb.vectors.search(query, 5, min_score=0), [], query)
+            self.assertEqual(self.kb._find_excerpts(query, 5), (), query)
+
+    def test_known_words_still_use_semantic_search(self):
+        self.assertTrue(self.kb.vectors.search("тревога xyzzy", 5, min_score=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+import os
+import json
+import math
+import time
+import zlib
+import logging
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:  # семантический поиск необязателен
+    np = None
+
+from book_index import tokenize
+from chunk_store import write_atomic
+
+logger = logging.getLogger(__name__)
+
+# Размерность векторов фрагментов
+SEMANTIC_DIM = int(os.getenv('SEMANTIC_DIM', 128))
+# Минимальная косинусная близость, ниже которой фрагмент считается нерелевантным.
+# По замерам на библиотеке бота лучшие фрагменты для реальных вопросов набирают
+# 0.35-0.62, а бессмыслица - до 0.6: отсекает ее не порог, а проверка словаря
+SEMANTIC_MIN_SCORE = float(os.getenv('SEMANTIC_MIN_SCORE', 0.35))
+
+VECTOR_FORMAT_VERSION = 1
+HASH_BITS = 15
+HASH_SIZE = 1 << HASH_BITS
+NGRAM_SIZE = 3
+NGRAM_WEIGHT = 0.5
+OVERSAMPLING = 16
+
+VECTORS_META_FILE = "vectors.json"
+VECTORS_DOCS_FILE = "vectors_docs.npy"
+VECTORS_TERMS_FILE = "vectors_terms.npy"
+
+
+def is_available():
+    return np is not None
+
+
+def _bucket(feature):
+    return zlib.crc32(feature.encode('utf-8')) & (HASH_SIZE - 1)
+
+
+def term_features(term):
+    """Хэшированные признаки основы: сама основа и ее символьные триграммы.
+
+    Триграммы дают близкие векторы разным формам одного корня,
+    которых стеммер не свел к одной основе ("тревог" и "тревожн").
+    """
+    features = [(_bucket(term), 1.0)]
+    padded = f"<{term}>"
+    for i in range(len(padded) - NGRAM_SIZE + 1):
+        features.append((_bucket(padded[i:i + NGRAM_SIZE]), NGRAM_WEIGHT))
+    return features
+
+
+class VectorIndex:
+    """Семантический поиск по фрагментам книг на основе LSA.
+
+    Фрагменты представлены хэшированными TF-IDF векторами, которые сжимаются
+    рандомизированным SVD до SEMANTIC_DIM измерений. Векторы всех фрагментов
+    лежат в одной непрерывной float32 матрице, поэтому поиск - это одно
+    матрично-векторное произведение. Матрицы сохраняются в .npy и открываются
+    через mmap, как и корпус книг.
+    """
+
+    def __init__(self, doc_vectors, term_vectors, inverted_index):
+        self.doc_vectors = doc_vectors
+        self.term_vectors = term_vectors
+        self.inverted_index = inverted_index
+
+    @staticmethod
+    def _idf(documents, df):
+        return math.log((documents + 1) / (df + 1)) + 1
+
+    @classmethod
+    def build(cls, inverted_index, dim=SEMANTIC_DIM, seed=0):
+        """Построение векторов фрагментов по инвертированному индексу"""
+        documents = len(inverted_index)
+        rank = min(dim + OVERSAMPLING, documents)
+        rng = np.random.default_rng(seed)
+
+        # Веса (1 + log tf) * idf и признаки для каждой основы словаря
+        terms = []
+        squares = np.zeros(documents, dtype=np.float64)
+        for token, posting in inverted_index.postings.items():
+            docs = np.frombuffer(posting, dtype=np.uint32)
+            tf = np.frombuffer(inverted_index.frequencies[token], dtype=np.uint32)
+            weights = (1 + np.log(tf)) * cls._idf(documents, len(docs))
+            features = term_features(token)
+            squares[docs] += weights ** 2 * sum(weight ** 2 for _, weight in features)
+            terms.append((docs, weights, features))
+
+        norms = np.sqrt(squares)
+        norms[norms == 0] = 1
+
+        # Рандомизированный SVD: Y = X * Omega, Q = orth(Y), B = Q^T * X
+        omega = rng.standard_normal((HASH_SIZE, rank), dtype=np.float32)
+        sample = np.zeros((documents, rank), dtype=np.float32)
+        for docs, weights, features in terms:
+            projection = sum(weight * omega[bucket] for bucket, weight in features)
+            sample[docs] += (weights / norms[docs]).astype(np.float32)[:, None] * projection
+        del omega
+
+        basis, _ = np.linalg.qr(sample)
+        del sample
+
+        reduced = np.zeros((rank, HASH_SIZE), dtype=np.float32)
+        for docs, weights, features in terms:
+            column = basis[docs].T @ (weights / norms[docs]).astype(np.float32)
+            for bucket, weight in features:
+                reduced[:, bucket] += weight * column
+
+        u, sigma, vt = np.linalg.svd(reduced, full_matrices=False)
+        dim = min(dim, len(sigma))
+
+        doc_vectors = basis @ (u[:, :dim] * sigma[:dim])
+        doc_vectors /= np.maximum(np.linalg.norm(doc_vectors, axis=1, keepdims=True), 1e-9)
+        term_vectors = vt[:dim].T
+
+        return cls(
+            np.ascontiguousarray(doc_vectors, dtype=np.float32),
+            np.ascontiguousarray(term_vectors, dtype=np.float32),
+            inverted_index
+        )
+
+    def save(self, directory, signature):
+        os.makedirs(directory, exist_ok=True)
+        for name, matrix in ((VECTORS_DOCS_FILE, self.doc_vectors), (VECTORS_TERMS_FILE, self.term_vectors)):
+            path = os.path.join(directory, name)
+            with open(path + ".tmp", 'wb') as f:
+                np.save(f, matrix)
+            os.replace(path + ".tmp", path)
+        meta = {'version': VECTOR_FORMAT_VERSION, 'signature': signature, 'dim': int(self.doc_vectors.shape[1])}
+        write_atomic(os.path.join(directory, VECTORS_META_FILE), json.dumps(meta).encode('utf-8'))
+
+    @classmethod
+    def open(cls, directory, signature, inverted_index):
+        """Открытие сохраненных матриц через mmap; None, если их нет или они устарели"""
+        meta_path = os.path.join(directory, VECTORS_META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('version') != VECTOR_FORMAT_VERSION or meta.get('signature') != signature:
+                return None
+            doc_vectors = np.load(os.path.join(directory, VECTORS_DOCS_FILE), mmap_mode='r')
+            term_vectors = np.load(os.path.join(directory, VECTORS_TERMS_FILE), mmap_mode='r')
+            if doc_vectors.shape[0] != len(inverted_index):
+                return None
+            return cls(doc_vectors, term_vectors, inverted_index)
+        except (OSError, ValueError) as e:
+            logger.error(f"Ошибка загрузки векторов книг: {e}")
+            return None
+
+    @classmethod
+    def load_or_build(cls, directory, signature, inverted_index):
+        vectors = cls.open(directory, signature, inverted_index)
+        if vectors is not None:
+            return vectors
+
+        started = time.time()
+        vectors = cls.build(inverted_index)
+        try:
+            vectors.save(directory, signature)
+        except OSError as e:
+            logger.error(f"Ошибка записи векторов книг: {e}")
+        print(f"🧭 Семантический индекс построен за {time.time() - started:.2f} сек")
+        return vectors
+
+    def query_vector(self, query):
+        """Вектор запроса в том же пространстве, что и фрагменты.
+
+        None, если ни одной основы запроса нет в словаре книг: по одним
+        триграммам незнакомых слов любая бессмыслица находит "похожие"
+        фрагменты с близостью не ниже, чем у настоящих вопросов.
+        """
+        counts = Counter(tokenize(query))
+        if not any(token in self.inverted_index.postings for token in counts):
+            return None
+
+        documents = len(self.inverted_index)
+        vector = np.zeros(self.term_vectors.shape[1], dtype=np.float32)
+        for token, count in counts.items():
+            posting = self.inverted_index.postings.get(token)
+            weight = (1 + math.log(count)) * self._idf(documents, len(posting) if posting is not None else 0)
+            for bucket, feature_weight in term_features(token):
+                vector += weight * feature_weight * self.term_vectors[bucket]
+
+        length = np.linalg.norm(vector)
+        if not length:
+            return None
+        return vector / length
+
+    def search(self, query, top_k=5, min_score=SEMANTIC_MIN_SCORE):
+        """Ближайшие по косинусу фрагменты: список (score, doc_id), лучшие первыми"""
+        vector = self.query_vector(query)
+        if vector is None or not len(self.doc_vectors):
+            return []
+
+        scores = self.doc_vectors @ vector
+        top_k = min(top_k, len(scores))
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(float(scores[i]), int(i)) for i in candidates if scores[i] >= min_score]
@@ -71,7 +71,8 @@ def init_bot():
     global bot
     try:
         from bot_deepseek import DeepSeekPsychoBot
-        bot = DeepSeekPsychoBot()
+        # Вебхук-серверу нужен только payment_handler - книги не загружаем
+        bot = DeepSeekPsychoBot(with_knowledge_base=False)
         logger.info("✅ Бот инициализирован в вебхук-сервере")
     except Exception as e:
         logger.error(f"❌ Ошибка инициализации бота: {e}")